@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the size and serialization time of session cart data in the original
+format against the compact (and compressed) format, per cart line.
+"""
+
+import copy
+
+from util import setup, timeit, report
+
+
+def main():
+    teardown = setup()
+
+    from django.contrib.sessions.serializers import JSONSerializer
+    from django.test import RequestFactory
+    from django.contrib.sessions.backends.db import SessionStore
+
+    from shoptools.cart.session import \
+        SessionCart, encode_cart_data, decode_cart_data
+    from shoptools.contrib.catalogue.models import Product
+
+    serializer = JSONSerializer()
+    products = [Product.objects.create(name='Product %s' % i, price=10,
+                                       shipping_cost=0)
+                for i in range(200)]
+
+    rows = []
+    for count in (1, 10, 50, 200):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        cart = SessionCart(request)
+        for i, product in enumerate(products[:count]):
+            options = {'Colour': 'Red'} if i % 2 else {}
+            cart.add(product, options=options)
+
+        # the in-memory format is the original session format
+        original = copy.deepcopy(cart._data)
+        compact = encode_cart_data(original)
+        compressed = encode_cart_data(original, compress=True)
+
+        for name, payload in (('original', original),
+                              ('compact', compact),
+                              ('compressed', compressed)):
+            size = len(serializer.dumps({'cart': payload}))
+            dump_time = timeit(lambda: serializer.dumps({'cart': payload}))
+            if name == 'original':
+                encode_time = 0
+            else:
+                compress = name == 'compressed'
+                encode_time = timeit(
+                    lambda: encode_cart_data(original, compress=compress))
+            decode_time = timeit(lambda: decode_cart_data(payload))
+            rows.append((
+                count, name, size, '%.1f' % (size / count),
+                '%.1f' % ((dump_time + encode_time) * 1e6 / count),
+                '%.1f' % (decode_time * 1e6 / count),
+            ))
+
+    report(rows, ('lines', 'format', 'bytes', 'bytes/line',
+                  'write us/line', 'decode us/line'))
+    teardown()
+
+
+if __name__ == '__main__':
+    main()
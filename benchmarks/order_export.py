@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Compare exporting orders to csv one order at a time (fetching each order's
+addresses, lines, discounts and subtotal individually, as the export used
+to) against the chunked, prefetching streaming export.
+"""
+
+import csv
+import time
+
+from util import setup, report
+
+
+ORDERS = 2000
+LINES = 3
+
+
+def main():
+    teardown = setup()
+
+    from django.db import connection
+
+    from shoptools.checkout.export import Echo, get_row, stream_csv
+    from shoptools.checkout.models import Order, OrderLine, Address
+    from shoptools.contrib.catalogue.models import Product
+
+    products = [Product.objects.create(name='Product %s' % i, price=10,
+                                       shipping_cost=0)
+                for i in range(LINES)]
+    orders = Order.objects.bulk_create(Order() for i in range(ORDERS))
+    if orders[0].pk is None:
+        orders = list(Order.objects.all())
+    Address.objects.bulk_create(
+        Address(order=order, first_name='Test', email='test@example.com')
+        for order in orders)
+    OrderLine.objects.bulk_create(
+        OrderLine(parent_object=order, item=product, quantity=2, _total=20,
+                  _description=product.name)
+        for order in orders for product in products)
+
+    def naive():
+        writer = csv.writer(Echo())
+        for obj in Order.objects.all():
+            yield writer.writerow(get_row(obj))
+
+    queries = []
+
+    def count_queries(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    rows = []
+    for name, export in (('per order', naive),
+                         ('streaming', lambda: stream_csv(
+                             Order.objects.all()))):
+        del queries[:]
+        with connection.execute_wrapper(count_queries):
+            start = time.perf_counter()
+            for line in export():
+                pass
+            elapsed = time.perf_counter() - start
+        rows.append((name, ORDERS, len(queries),
+                     '%.0f' % (ORDERS / elapsed)))
+
+    report(rows, ('method', 'orders', 'queries', 'rows/s'))
+    teardown()
+
+
+if __name__ == '__main__':
+    main()
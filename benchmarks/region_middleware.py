@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Time RegionMiddleware.process_request for visitors without a location
+cookie (i.e. crawlers, which are located on every request), visitors with
+one, and skipped paths, against the previous approach of opening a new GeoIP
+reader and querying for the region on every request.
+
+GeoIP lookups are only included when geoip2 is installed and GEOIP_PATH
+points at a country database.
+"""
+
+from util import setup, timeit, report
+
+
+def main():
+    teardown = setup()
+
+    import json
+
+    from django.db import connection
+    from django.test import RequestFactory
+    from django.test.utils import CaptureQueriesContext
+
+    from shoptools import settings as shoptools_settings
+    from shoptools.contrib.regions.middleware import RegionMiddleware
+    from shoptools.contrib.regions.models import Currency, Region, Country
+    from shoptools.contrib.regions.util import GeoIP2, get_ip
+
+    try:
+        GeoIP2 and GeoIP2()
+    except Exception:
+        geoip = False
+    else:
+        geoip = bool(GeoIP2)
+
+    currency = Currency.objects.create()
+    codes = ['NZ', 'AU', 'FR', 'DE', 'GB', 'US', 'CA', 'JP']
+    for i, code in enumerate(codes):
+        region = Region.objects.create(name='Region %s' % i,
+                                       currency=currency, is_default=not i)
+        Country.objects.create(region=region, country=code)
+
+    def naive(request):
+        # RegionMiddleware.process_request before the shared reader and
+        # in-memory region map
+        country_code = None
+        if geoip:
+            try:
+                country_code = GeoIP2().country(
+                    get_ip(request))['country_code']
+            except Exception:
+                pass
+        try:
+            Region.objects.get(countries__country=country_code)
+        except Region.DoesNotExist:
+            Region.get_default()
+
+    middleware = RegionMiddleware()
+    factory = RequestFactory()
+    cookie = json.dumps({'country_code': 'FR', 'region_id': 1})
+
+    def make_request(path='/', with_cookie=False):
+        request = factory.get(path, REMOTE_ADDR='81.2.69.160')
+        if with_cookie:
+            request.COOKIES[shoptools_settings.LOCATION_COOKIE_NAME] = cookie
+        return request
+
+    cases = (
+        ('previous, no cookie', lambda: naive(make_request())),
+        ('no cookie', lambda: middleware.process_request(make_request())),
+        ('cookie', lambda: middleware.process_request(
+            make_request(with_cookie=True))),
+        ('skipped path', lambda: middleware.process_request(
+            make_request('/static/site.css'))),
+        ('request only', lambda: make_request()),
+    )
+
+    rows = []
+    for name, func in cases:
+        func()  # warm up caches
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        rows.append((name, len(queries),
+                     '%.1f' % (timeit(func, repeat=2000) * 1e6)))
+
+    report(rows, ('case', 'queries', 'us/request'))
+    if not geoip:
+        print('\nGeoIP unavailable, so country lookups were not timed')
+    teardown()
+
+
+if __name__ == '__main__':
+    main()
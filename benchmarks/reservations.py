@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Hammer a single item's stock from many threads at once, comparing stock
+reservations (a conditional decrement) against the naive read-check-write
+approach. Reports throughput, and how many units were oversold.
+
+SQLite serialises writes, so for realistic numbers point the example project
+at postgres or mysql.
+"""
+
+import threading
+
+from util import setup, report
+
+
+STOCK = 200
+THREADS = 16
+ATTEMPTS = 25  # per thread, so demand is twice the available stock
+
+
+def main():
+    teardown = setup(threaded=True)
+
+    import time
+
+    from django.db import connection, transaction, OperationalError
+
+    from shoptools.checkout.models import Order
+    from shoptools.contrib.catalogue.models import Product
+    from shoptools.contrib.reservations.models import Stock
+    from shoptools.contrib.reservations.util import reserve
+
+    product = Product.objects.create(name='Hot product', price=10,
+                                     shipping_cost=0)
+
+    def naive(order, stock):
+        with transaction.atomic():
+            record = Stock.objects.get(pk=stock.pk)
+            if record.available < 1:
+                return False
+            # widen the race window, as a real request would between the
+            # check and the write
+            time.sleep(0)
+            Stock.objects.filter(pk=stock.pk).update(
+                available=record.available - 1)
+            return True
+
+    def reservation(order, stock):
+        return not reserve(order)
+
+    def run(name, claim):
+        stock = Stock.objects.create(item=product, available=STOCK)
+        orders = []
+        for i in range(THREADS * ATTEMPTS):
+            order = Order.objects.create()
+            order.add(product)
+            orders.append(order)
+
+        results = {'claimed': 0, 'retries': 0}
+        lock = threading.Lock()
+
+        def worker(orders):
+            for order in orders:
+                while True:
+                    try:
+                        claimed = claim(order, stock)
+                        break
+                    except OperationalError:
+                        # i.e. sqlite "database is locked"
+                        with lock:
+                            results['retries'] += 1
+                if claimed:
+                    with lock:
+                        results['claimed'] += 1
+            connection.close()
+
+        threads = [threading.Thread(target=worker,
+                                    args=(orders[i::THREADS], ))
+                   for i in range(THREADS)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        stock.refresh_from_db()
+        sold = STOCK - stock.available
+        rows.append((
+            name, len(orders), results['claimed'], sold,
+            results['claimed'] - sold, results['retries'],
+            '%.0f' % (len(orders) / elapsed),
+        ))
+        Stock.objects.filter(pk=stock.pk).delete()
+
+    rows = []
+    run('naive', naive)
+    run('reservation', reservation)
+
+    report(rows, ('method', 'attempts', 'claimed', 'stock taken',
+                  'oversold', 'retries', 'attempts/s'))
+    teardown()
+
+
+if __name__ == '__main__':
+    main()
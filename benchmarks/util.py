@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup for the benchmark scripts in this directory. Each script runs
+against the example project in examples/full, using a throwaway test
+database, i.e.
+
+    python benchmarks/cart_session.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'examples', 'full')
+
+
+def setup(threaded=False, **settings_overrides):
+    """Configure django using the example project settings, and create a
+       test database. Returns a function which tears the database down.
+
+       Pass threaded=True if the benchmark uses the database from several
+       threads - an in-memory sqlite database can't be shared between them,
+       so a temporary file is used instead. """
+
+    sys.path.insert(0, EXAMPLE_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'full.settings')
+
+    import django
+    from django.conf import settings
+    for key, val in settings_overrides.items():
+        setattr(settings, key, val)
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    if threaded and connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(
+            tempfile.mkdtemp(), 'benchmark.sqlite3')
+        connection.settings_dict['OPTIONS'].setdefault('timeout', 60)
+    connection.creation.create_test_db(verbosity=0)
+
+    def teardown():
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    return teardown
+
+
+def timeit(func, repeat=100):
+    """Return the mean time in seconds for a call to func. """
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(rows, headers):
+    """Print a simple fixed-width table. """
+
+    widths = [max(len(str(v)) for v in col) for col in zip(headers, *rows)]
+    fmt = '  '.join('%%%ds' % w for w in widths)
+    print(fmt % tuple(headers))
+    for row in rows:
+        print(fmt % tuple(row))
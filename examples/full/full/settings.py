@@ -24,7 +24,8 @@ INSTALLED_APPS = [
     'shoptools.contrib.regions',
     'shoptools.contrib.shipping',
     'shoptools.contrib.vouchers',
-    'shoptools.contrib.favourites'
+    'shoptools.contrib.favourites',
+    'shoptools.contrib.reservations',
 ]
 
 MIDDLEWARE = [
@@ -96,6 +97,7 @@ SHOPTOOLS_REGIONS_MODULE = 'shoptools.contrib.regions'
 SHOPTOOLS_SHIPPING_MODULE = 'shoptools.contrib.shipping'
 SHOPTOOLS_VOUCHERS_MODULE = 'shoptools.contrib.vouchers'
 SHOPTOOLS_FAVOURITES_MODULE = 'shoptools.contrib.favourites'
+SHOPTOOLS_RESERVATIONS_MODULE = 'shoptools.contrib.reservations'
 
 AUTHENTICATION_BACKENDS = (
     'shoptools.contrib.accounts.auth_backends.EmailBackend',
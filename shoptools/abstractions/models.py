@@ -1,9 +1,11 @@
 import decimal
 import json
+from contextlib import contextmanager
 
 # from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.utils.text import mark_safe
@@ -12,7 +14,8 @@ from django.utils.translation import gettext_lazy as _
 from django_countries.fields import CountryField
 
 from shoptools.util import \
-    get_shipping_module, get_vouchers_module, validate_options
+    get_shipping_module, get_vouchers_module, get_reservations_module, \
+    validate_options
 
 
 # TODO
@@ -26,6 +29,64 @@ from shoptools.util import \
 # shipping_cost, we should check using hasattr and ignore if they're not there
 
 
+class CartPricing(object):
+    """Pricing snapshot for a cart at a given version. Each value is calculated
+       on first access and reused thereafter, so templates can refer to
+       cart.subtotal, cart.total etc as often as they like without repricing
+       the cart. A new snapshot is created whenever the cart is changed. """
+
+    def __init__(self, cart, version):
+        self.cart = cart
+        self.version = version
+
+    @cached_property
+    def lines(self):
+        return self.cart.get_lines()
+
+    @cached_property
+    def subtotal(self):
+        return self.cart.calculate_subtotal()
+
+    @cached_property
+    def shipping_quote(self):
+        return self.cart.calculate_shipping_quote()
+
+    @cached_property
+    def shipping_cost(self):
+        return self.cart.calculate_shipping_cost()
+
+    @cached_property
+    def discounts(self):
+        """Tuple of (discounts, invalid_codes). """
+        return self.cart.calculate_discounts()
+
+    @cached_property
+    def total_discount(self):
+        discounts, invalid = self.discounts
+        return sum(d.amount for d in discounts)
+
+    @cached_property
+    def total(self):
+        return self.subtotal + decimal.Decimal(self.shipping_cost) \
+            - self.total_discount
+
+
+class ShippingQuote(object):
+    """A cart's shipping, as resolved once per cart version by the shipping
+       module's get_quote: the options available (and their choices, of the
+       form (option_id, title)), the option in effect, its cost and any
+       errors. """
+
+    def __init__(self, options=(), choices=(), option=None, option_id=None,
+                 cost=0, errors=()):
+        self.options = tuple(options)
+        self.choices = list(choices)
+        self.option = option
+        self.option_id = option_id
+        self.cost = cost
+        self.errors = list(errors)
+
+
 class ICart(object):
     """Define interface for "cart" objects, which may be a session-based
        "cart" or a db-saved "order".
@@ -39,14 +100,47 @@ class ICart(object):
 
        and may implement the following (optional):
 
-           subtotal
-           total
            get_shipping_option
            set_shipping_option
+           select_shipping_option
            get_voucher_codes
 
+       Subclasses must call changed() whenever the cart's contents, shipping
+       option or vouchers are modified, so that cached pricing is discarded.
        """
 
+    def get_version(self):
+        """Return a counter which increases each time the cart is changed. """
+        return getattr(self, '_cart_version', 0)
+
+    def changed(self):
+        self._cart_version = self.get_version() + 1
+
+    @contextmanager
+    def deferred_save(self):
+        """Save the cart once at the end of the block, rather than after each
+           change, i.e. when applying a batch of changes. Carts which don't
+           save their contents as a whole needn't override this. """
+        yield
+
+    @property
+    def pricing(self):
+        """Return the CartPricing snapshot for the current cart version. """
+
+        version = self.get_version()
+        pricing = getattr(self, '_pricing', None)
+        if pricing is None or pricing.version != version:
+            pricing = self._pricing = CartPricing(self, version)
+        return pricing
+
+    @property
+    def subtotal(self):
+        return self.pricing.subtotal
+
+    @property
+    def total(self):
+        return self.pricing.total
+
     def add(self, instance, quantity=1, options={}):
         return self.update_quantity(instance, quantity, add=True,
                                     options=options)
@@ -56,16 +150,33 @@ class ICart(object):
 
     def get_errors(self):
         """Validate each cart line item. Subclasses may override this method
-           to perform whole-cart validation. Return a list of error strings
+           to perform whole-cart validation. Return a list of error strings.
+           The result is cached until the cart is next changed.
         """
 
+        cached = getattr(self, '_errors_cache', None)
+        if cached and cached[0] == self.get_version():
+            return list(cached[1])
+
         errors = []
-        for line in self.get_lines():
-            errors += line.get_errors()
+        for line_errors in validate_lines(self.get_lines()):
+            errors += line_errors
 
         errors += self.shipping_errors()
 
-        return errors
+        reservations_module = get_reservations_module()
+        if reservations_module:
+            errors += reservations_module.cart_errors(self)
+
+        # validation may have modified the cart, i.e. set a shipping option,
+        # so cache against the current version
+        self._errors_cache = (self.get_version(), errors)
+        return list(errors)
+
+    def count_unvalidated(self):
+        """Item count for display, which may include invalid lines if that's
+           cheaper to calculate. Defaults to count(). """
+        return self.count()
 
     @property
     def is_valid(self):
@@ -108,16 +219,52 @@ class ICart(object):
         """Delete all cart lines. """
         raise NotImplementedError()
 
+    def calculate_subtotal(self):
+        return decimal.Decimal(
+            sum(line.total if line.total else 0
+                for line in self.pricing.lines))
+
     @property
     def shipping_cost(self):
+        return self.pricing.shipping_cost
+
+    @property
+    def shipping_quote(self):
+        """The ShippingQuote for the current cart version, or None if the
+           shipping module doesn't provide quotes. """
+        return self.pricing.shipping_quote
+
+    def calculate_shipping_quote(self):
+        shipping_module = get_shipping_module()
+        if not (shipping_module and hasattr(shipping_module, 'get_quote')):
+            return None
+
+        quote = shipping_module.get_quote(self)
+        if quote.option_id and quote.option_id != self.get_shipping_option():
+            self.select_shipping_option(quote.option_id)
+        return quote
+
+    def select_shipping_option(self, option_id):
+        """Set a shipping option chosen automatically, i.e. when none has
+           been chosen yet. Subclasses may defer saving it until the cart is
+           next saved, rather than writing on every read. """
+        self.set_shipping_option(option_id)
+
+    def calculate_shipping_cost(self):
         shipping_module = get_shipping_module()
         if shipping_module:
+            quote = self.shipping_quote
+            if quote is not None:
+                return quote.cost
             return shipping_module.calculate(self)
         return 0
 
     def shipping_errors(self):
         shipping_module = get_shipping_module()
 
+        if shipping_module and hasattr(shipping_module, 'get_quote'):
+            return list(self.shipping_quote.errors)
+
         if shipping_module and hasattr(shipping_module, 'available_options'):
             shipping_options = list(shipping_module.available_options(self))
 
@@ -165,22 +312,27 @@ class ICart(object):
 
     @property
     def total_discount(self):
-        discounts, invalid = self.calculate_discounts()
-        return sum(d.amount for d in discounts)
+        return self.pricing.total_discount
 
+    @transaction.atomic
     def save_to(self, obj):
         assert isinstance(obj, AbstractOrder)
 
-        [l.delete() for l in obj.get_lines()]
+        obj.set_request(self.request)
+
+        # replace the existing lines in bulk
+        line_cls = obj.get_line_cls()
+        lines = []
         for cart_line in self.get_lines():
-            line = obj.get_line_cls()()
-            line.parent_object = obj
+            line = line_cls(parent_object=obj, quantity=cart_line.quantity)
             line.item = cart_line.item
             line.options = cart_line.options
-            line.quantity = cart_line.quantity
-            line.save()
+            lines.append(line)
+        line_cls.prepare_lines(lines)
 
-        obj.set_request(self.request)
+        obj.get_line_queryset().delete()
+        line_cls.objects.bulk_create(lines)
+        obj.changed()
 
         if hasattr(obj, 'set_shipping_option') and \
            hasattr(self, 'get_shipping_option'):
@@ -195,8 +347,48 @@ class ICart(object):
             voucher_module = get_vouchers_module()
             vouchers = self.get_voucher_codes() if voucher_module else None
             if vouchers:
-                [d.delete() for d in obj.discount_set.all()]
+                # replaces any existing discounts
                 voucher_module.save_discounts(obj, vouchers)
+                obj.changed()
+
+
+def call_batched(lines, batch_method, line_method, default=None):
+    """Group lines by item class, and call the named batch classmethod once
+       for each group, falling back to calling line_method on each item if
+       the class doesn't implement it. Returns a list of results in the same
+       order as lines, with default for lines without an item. """
+
+    results = [default] * len(lines)
+    groups = {}
+    for i, line in enumerate(lines):
+        if line.item is not None:
+            groups.setdefault(type(line.item), []).append(i)
+
+    for item_cls, indexes in groups.items():
+        group = [lines[i] for i in indexes]
+        if hasattr(item_cls, batch_method):
+            group_results = getattr(item_cls, batch_method)(group)
+        else:
+            group_results = [getattr(line.item, line_method)(line)
+                             for line in group]
+        for i, result in zip(indexes, group_results):
+            results[i] = result
+
+    return results
+
+
+def price_lines(lines):
+    """Return a list of line totals for the given lines, in the same order,
+       using the item classes' cart_line_totals. """
+
+    return call_batched(lines, 'cart_line_totals', 'cart_line_total')
+
+
+def validate_lines(lines):
+    """Return a list of error lists for the given lines, in the same order,
+       using the item classes' cart_lines_errors. """
+
+    return call_batched(lines, 'cart_lines_errors', 'cart_errors', [])
 
 
 class IShippable(object):
@@ -215,8 +407,22 @@ class ICartLine(object):
        parent_object
        key
 
+    Lines returned together by get_lines() share a batch, which is priced in
+    one go on first access via calculate_total.
     """
 
+    pricing_batch = None
+
+    def calculate_total(self):
+        """Return the item's total for this line, pricing the rest of the
+           line's batch at the same time. """
+
+        if '_calculated_total' not in self.__dict__:
+            batch = self.pricing_batch or [self]
+            for line, total in zip(batch, price_lines(batch)):
+                line._calculated_total = total
+        return self._calculated_total
+
     def get_errors(self):
         """Validate this line's item. Return a list of error strings"""
         return self.item.cart_errors(self) if self.item else []
@@ -262,6 +468,15 @@ class ICartItem(object):
         # https://docs.djangoproject.com/en/1.8/topics/http/sessions/#session-serialization
         raise NotImplementedError()
 
+    @classmethod
+    def cart_line_totals(cls, lines):
+        """Return totals for a list of lines whose items are all instances of
+           this class, in the same order. Override this to price a whole cart
+           at once, i.e. with a single price list query, rather than per
+           line. """
+
+        return [line.item.cart_line_total(line) for line in lines]
+
     def purchase(self, line):
         """Called on successful purchase. """
         pass
@@ -271,6 +486,15 @@ class ICartItem(object):
            stock. """
         return []
 
+    @classmethod
+    def cart_lines_errors(cls, lines):
+        """Return a list of error lists for a list of lines whose items are
+           all instances of this class, in the same order. Override this to
+           validate a whole cart at once, i.e. with a single stock query,
+           rather than per line. """
+
+        return [line.item.cart_errors(line) for line in lines]
+
     def cart_description(self):
         """Describes the item in the checkout admin. Needed because it needs
            to store a description of the item as purchased, even if it is
@@ -341,6 +565,7 @@ class AbstractOrder(models.Model, ICart):
             # may have been created on the fly if it didn't exist
             if line.pk:
                 line.delete()
+                self.changed()
             return (True, None)
 
         # verify the order line object before saving
@@ -349,6 +574,7 @@ class AbstractOrder(models.Model, ICart):
             return (False, errors)
 
         line.save()
+        self.changed()
         return (True, None)
 
     def update_options(self, pk, options):
@@ -359,6 +585,7 @@ class AbstractOrder(models.Model, ICart):
 
         line.options = validate_options(line.item, options)
         line.save()
+        self.changed()
         return (True, None)
 
     def get_line(self, instance, options, create=False):
@@ -367,7 +594,7 @@ class AbstractOrder(models.Model, ICart):
 
         # app_label, model = ctype.split('.')
         ctype_obj = ContentType.objects.get_for_model(instance)
-        lines = self.get_line_cls().objects.filter(parent_object=self)
+        lines = self.get_line_queryset()
         options = json.dumps(validate_options(instance, options))
         lookup = {
             'parent_object': self,
@@ -392,25 +619,58 @@ class AbstractOrder(models.Model, ICart):
 
     def get_lines(self):
         """This method should always be used to get lines, rather than
-           directly via orm. """
-
-        lines = self.get_line_cls().objects.filter(parent_object=self) \
-            .order_by('pk')
+           directly via orm. Items are prefetched, with one query per content
+           type, and the result is cached until the order is next changed. """
+
+        version = self.get_version()
+        cached = getattr(self, '_lines_cache', None)
+        if cached and cached[0] == version:
+            return list(cached[1])
+
+        lines = self.get_line_queryset().order_by('pk') \
+            .prefetch_related('item')
+        # read the prefetched item from the field cache, since accessing a
+        # deleted item through the descriptor queries for it again
+        item_field = self.get_line_cls()._meta.get_field('item')
         rv = []
         for line in lines:
-            if line.item:
+            if item_field.get_cached_value(line, default=None) is not None:
                 # parent_object may have been instantiated with a request,
                 # so attach it to the line
                 line.parent_object = self
+                line.pricing_batch = rv
                 rv.append(line)
-        return rv
+
+        self._lines_cache = (version, rv)
+        return list(rv)
+
+    def get_line_queryset(self):
+        """Unvalidated lines for this order, i.e. including those whose item
+           has been deleted. Use get_lines() unless that doesn't matter. """
+
+        return self.get_line_cls().objects.filter(parent_object=self)
 
     def empty(self):
-        return not self.count()
+        if not self.pk:
+            return True
+        return not self.get_lines()
 
     def count(self):
+        if not self.pk:
+            return 0
         return sum(line.quantity for line in self.get_lines())
 
+    def count_unvalidated(self):
+        """Sum the quantities of all lines in the db, without loading them or
+           their items - so lines whose item was deleted are included. Cheap
+           enough for i.e. an item count badge, but use count() to check
+           what can be bought. """
+
+        if not self.pk:
+            return 0
+        return self.get_line_queryset().aggregate(
+            count=models.Sum('quantity'))['count'] or 0
+
     def clear(self):
         # this doesn't have to delete the Order, it could hang around and
         # the lines could just be deleted
@@ -419,11 +679,7 @@ class AbstractOrder(models.Model, ICart):
 
         # return self.get_lines().delete()
         self.delete()
-
-    @property
-    def subtotal(self):
-        return decimal.Decimal(
-            sum(line.total if line.total else 0 for line in self.get_lines()))
+        self.changed()
 
 
 class AbstractOrderLine(models.Model, ICartLine):
@@ -460,6 +716,13 @@ class AbstractOrderLine(models.Model, ICartLine):
     def key(self):
         return self.pk
 
+    @classmethod
+    def prepare_lines(cls, lines):
+        """Called with a list of new, unsaved lines before they are created
+           in bulk (which bypasses save()). Subclasses which calculate values
+           on save should also do so here. """
+        pass
+
     class Meta:
         abstract = True
         # NOTE I'm relying on the jsonfield ordering its keys consistently
@@ -470,7 +733,7 @@ class AbstractOrderLine(models.Model, ICartLine):
     def total(self):
         if not self.item:
             return None
-        line_total = self.item.cart_line_total(self)
+        line_total = self.calculate_total()
         if line_total is None:
             return None
         return decimal.Decimal(line_total)
@@ -1,3 +1,7 @@
+import json
+
+from django.core.exceptions import ObjectDoesNotExist
+
 from shoptools.util import unpack_instance_key
 
 
@@ -11,6 +15,9 @@ def cart_action(params=[]):
        if there were errors (i.e. an item is sold out), or None if the request
        is invalid, (i.e. missing a required parameter)
 
+       Actions may also return a third value, a dict of additional data to
+       include in ajax responses.
+
        params is a list of tuples of the form (field, cast_func, required)
     """
 
@@ -50,6 +57,15 @@ def cart_action(params=[]):
     return inner
 
 
+def get_item(ctype, pk):
+    """Look up the item for an action, returning None if it's invalid. """
+
+    try:
+        return unpack_instance_key(ctype, pk)
+    except (TypeError, ValueError, ObjectDoesNotExist):
+        return None
+
+
 @cart_action(params=(
     ('ctype', str, True),
     ('pk', str, True),
@@ -58,7 +74,9 @@ def cart_action(params=[]):
 def quantity(cart, ctype, pk, quantity, **options):
     """Update an item's quantity in the cart. """
 
-    instance = unpack_instance_key(ctype, pk)
+    instance = get_item(ctype, pk)
+    if instance is None:
+        return (False, ['Invalid item'])
     return cart.update_quantity(instance, quantity, options=options)
 
 
@@ -80,10 +98,25 @@ def options(cart, key, **options):
 def add(cart, ctype, pk, quantity=1, **options):
     """Add an item to the cart. """
 
-    instance = unpack_instance_key(ctype, pk)
+    instance = get_item(ctype, pk)
+    if instance is None:
+        return (False, ['Invalid item'])
     return cart.add(instance, quantity, options=options)
 
 
+@cart_action(params=(
+    ('ctype', str, True),
+    ('pk', str, True),
+))
+def remove(cart, ctype, pk, **options):
+    """Remove an item from the cart. """
+
+    instance = get_item(ctype, pk)
+    if instance is None:
+        return (False, ['Invalid item'])
+    return cart.remove(instance, options=options)
+
+
 @cart_action()
 def clear(cart, confirm):
     """Remove everything from the cart. """
@@ -103,3 +136,60 @@ def set_voucher_codes(cart, codes=''):
     codes = [c for c in map(str.strip, codes.split(',')) if c]
     cart.set_voucher_codes(codes)
     return (True, None)
+
+
+BATCH_ACTIONS = {
+    'add': add,
+    'quantity': quantity,
+    'options': options,
+    'remove': remove,
+}
+
+
+@cart_action(params=(
+    ('operations', json.loads, True),
+))
+def batch(cart, operations):
+    """Apply a list of operations to the cart in a single request, i.e. for
+       quick order forms. operations is a json-encoded list of dicts, each
+       containing an "action" (a key of BATCH_ACTIONS) and that action's
+       params, e.g.
+
+           [{"action": "add", "ctype": "catalogue.product", "pk": 1,
+             "quantity": 2},
+            {"action": "remove", "ctype": "catalogue.product", "pk": 3}]
+
+       Operations are applied in order, and a failed operation doesn't
+       prevent the remaining ones from being applied. The outcome of each
+       is returned as "results", a list of {"action", "success", "errors"}
+       dicts in the same order as the operations. cart_view sends each
+       operation's signal, as for the single action.
+    """
+
+    if not isinstance(operations, list) or \
+            not all(isinstance(op, dict) for op in operations):
+        return (None, ['operations is invalid'])
+
+    results = []
+    all_errors = []
+    with cart.deferred_save():
+        for op in operations:
+            # params are cast to strings, as they would be if posted by a form
+            params = dict((k, str(v)) for k, v in op.items())
+            name = params.pop('action', None)
+            if name in BATCH_ACTIONS:
+                success, errors = BATCH_ACTIONS[name](params, cart)
+            else:
+                success, errors = (None, ['%s is not a valid action' % name])
+
+            if isinstance(errors, str):
+                errors = [errors]
+            results.append({
+                'action': name,
+                'success': bool(success),
+                'errors': errors,
+            })
+            all_errors += errors or []
+
+    success = all(result['success'] for result in results)
+    return (success, all_errors, {'results': results})
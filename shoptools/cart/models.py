@@ -51,6 +51,13 @@ class SavedCart(AbstractOrder, IShippable):
 
         self._shipping_option = option_id
         self.save()
+        self.changed()
+
+    def select_shipping_option(self, option_id):
+        """Set an automatically chosen option_id, without saving - it's
+           saved along with the next change to the cart. """
+
+        self._shipping_option = option_id
 
     def get_shipping_option(self):
         """Get shipping option for this cart, if any. """
@@ -62,6 +69,7 @@ class SavedCart(AbstractOrder, IShippable):
     def set_voucher_codes(self, codes):
         self._voucher_codes = ','.join(codes)
         self.save()
+        self.changed()
         return True
 
     def get_absolute_url(self):
@@ -74,10 +82,6 @@ class SavedCart(AbstractOrder, IShippable):
         else:
             return "Cart, %s" % (self.created, )
 
-    @property
-    def total(self):
-        return self.subtotal + self.shipping_cost - self.total_discount
-
     # AbstractOrder integration
     def get_line_cls(self):
         return SavedCartLine
@@ -1,17 +1,28 @@
-import decimal
+import base64
 import json
 import copy
+import zlib
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils.module_loading import import_string
 
 from shoptools.abstractions.models import \
     ICart, ICartItem, ICartLine, IShippable
 from shoptools.util import \
     validate_options, get_regions_module, create_instance_key, \
-    unpack_instance_key
+    unpack_instance_key, unpack_instance_keys
 from shoptools import settings as shoptools_settings
 
 
 KEY_SEPARATOR = '|'
 
+# Version of the compact format used to store cart data in the session. Data
+# without a version is the original format, which is also the format used in
+# memory - see encode_cart_data
+SESSION_FORMAT_VERSION = 2
+COMPRESSED_PREFIX = 'z:'
+
 
 def create_line_key(instance, options):
     """Create a unique (string) key for a model instance and optional options
@@ -35,14 +46,160 @@ def unpack_line_key(key):
     return (instance, options)
 
 
+def unpack_line_keys(keys):
+    """Batch version of unpack_line_key. Returns a dict mapping each key to
+       an (instance, options) tuple, fetching the instances with one query
+       per content type. """
+
+    bits = dict((key, key.split(KEY_SEPARATOR)) for key in keys)
+    instances = unpack_instance_keys(
+        tuple(key_bits[:-1]) for key_bits in bits.values())
+
+    return dict(
+        (key, (instances[tuple(key_bits[:-1])], json.loads(key_bits[-1])))
+        for key, key_bits in bits.items())
+
+
+def _get_ctype_id(ctype):
+    return ContentType.objects.get_by_natural_key(*ctype.split('.')).id
+
+
+def _get_ctype(ctype_id):
+    content_type = ContentType.objects.get_for_id(ctype_id)
+    return '%s.%s' % (content_type.app_label, content_type.model)
+
+
+def _encode_pk(pk):
+    """Store pks as ints where they round-trip, i.e. not '007'. """
+
+    pk = str(pk)
+    try:
+        if str(int(pk)) == pk:
+            return int(pk)
+    except ValueError:
+        pass
+    return pk
+
+
+def encode_cart_data(data, compress=False):
+    """Convert cart data to the compact format stored in the session. Content
+       types are stored by id rather than name, and options are stored once
+       rather than also being embedded in the line key, i.e.
+
+           {
+               'v': 2,
+               'l': [[ctype_id, pk, quantity, options], ...],
+               'vc': ['VOUCHER'],
+               'so': shipping_option_id,
+               'o': [ctype_id, pk],
+           }
+
+       options is omitted from lines that don't have any, as are the other
+       keys if they're not set. If compress is True, the result is zlib
+       compressed and base64 encoded to a string, since sessions may be json
+       serialized. """
+
+    ctype_ids = {}
+    lines = []
+    for line in data['lines']:
+        ctype, pk = line['key'].split(KEY_SEPARATOR, 2)[:2]
+        if ctype not in ctype_ids:
+            ctype_ids[ctype] = _get_ctype_id(ctype)
+        encoded = [ctype_ids[ctype], _encode_pk(pk), line['quantity']]
+        if line['options']:
+            encoded.append(line['options'])
+        lines.append(encoded)
+
+    payload = {'v': SESSION_FORMAT_VERSION, 'l': lines}
+    if data.get('vouchers'):
+        payload['vc'] = data['vouchers']
+    if data.get('shipping_option') is not None:
+        payload['so'] = data['shipping_option']
+    if data.get('order_obj'):
+        ctype, pk = data['order_obj']
+        payload['o'] = [_get_ctype_id(ctype), pk]
+
+    if compress:
+        packed = zlib.compress(
+            json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        return COMPRESSED_PREFIX + base64.b64encode(packed).decode('ascii')
+
+    return payload
+
+
+def decode_cart_data(payload):
+    """Convert cart data stored in the session, in any format, back to the
+       in-memory format, i.e.
+
+           {
+               'lines': [{'key': key, 'quantity': 1, 'options': {}}, ...],
+               'vouchers': ['VOUCHER'],
+               'shipping_option': shipping_option_id,
+               'order_obj': (ctype, pk),
+           }
+
+       Lines whose content type no longer exists are dropped. """
+
+    if payload is None:
+        return None
+
+    if isinstance(payload, str):
+        assert payload.startswith(COMPRESSED_PREFIX)
+        packed = base64.b64decode(payload[len(COMPRESSED_PREFIX):])
+        payload = json.loads(zlib.decompress(packed).decode('utf-8'))
+
+    # original format - stored as-is
+    if 'v' not in payload:
+        return payload
+
+    ctypes = {}
+    lines = []
+    for encoded in payload['l']:
+        ctype_id, pk, quantity = encoded[:3]
+        options = encoded[3] if len(encoded) > 3 else {}
+        if ctype_id not in ctypes:
+            try:
+                ctypes[ctype_id] = _get_ctype(ctype_id)
+            except ContentType.DoesNotExist:
+                ctypes[ctype_id] = None
+        if ctypes[ctype_id] is None:
+            continue
+        key = KEY_SEPARATOR.join((
+            ctypes[ctype_id], str(pk),
+            json.dumps(options, sort_keys=True) if options else '{}'))
+        lines.append({'key': key, 'quantity': quantity, 'options': options})
+
+    data = {'lines': lines}
+    if 'vc' in payload:
+        data['vouchers'] = payload['vc']
+    if 'so' in payload:
+        data['shipping_option'] = payload['so']
+    if 'o' in payload:
+        ctype_id, pk = payload['o']
+        try:
+            data['order_obj'] = (_get_ctype(ctype_id), pk)
+        except ContentType.DoesNotExist:
+            pass
+    return data
+
+
+# Marker for a line whose item hasn't been looked up yet, since None is a
+# valid (deleted) item
+UNRESOLVED = object()
+
+
 class SessionCartLine(dict, ICartLine):
     """Thin wrapper around dict providing some convenience methods for
        accessing computed information about the line, according to ICartLine.
+
+       The item may be passed in if it's already known, otherwise it is looked
+       up from the key on first access, and cached on the line.
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, item=UNRESOLVED, **kwargs):
         assert sorted(kwargs.keys()) == ['key', 'options', 'parent_object',
                                          'quantity']
+        self._item = item
         return super(SessionCartLine, self).__init__(**kwargs)
 
     def __setitem__(self, *args):
@@ -50,12 +207,13 @@ class SessionCartLine(dict, ICartLine):
 
     @property
     def item(self):
-        instance, options = unpack_line_key(self.key)
-        return instance
+        if self._item is UNRESOLVED:
+            self._item, options = unpack_line_key(self.key)
+        return self._item
 
     options = property(lambda s: s['options'])
     quantity = property(lambda s: s['quantity'])
-    total = property(lambda s: s.item.cart_line_total(s))
+    total = property(lambda s: s.calculate_total())
     description = property(lambda s: s.item.cart_description())
     parent_object = property(lambda s: s['parent_object'])
     key = property(lambda s: s['key'])
@@ -64,13 +222,41 @@ class SessionCartLine(dict, ICartLine):
 class SessionCart(ICart, IShippable):
     """Default session-saved cart class. To implement multiple "carts" in one
        site using this class, pass a distinct session_key to the constructor
-       for each. """
+       for each.
+
+       Cart data is kept in the session by default, or elsewhere depending
+       on the SHOPTOOLS_CART_STORE setting (see shoptools.cart.storage). It's
+       stored in a compact format (see encode_cart_data), and decoded once per
+       request; SessionCart instances for the same request and session_key
+       share the decoded data, and its version, so a change made through
+       one is seen by the others. """
 
     def __init__(self, request, session_key=None):
         self.request = request
         self.session_key = \
             session_key or shoptools_settings.DEFAULT_SESSION_KEY
-        self._data = self.request.session.get(self.session_key, None)
+        self.store = self.get_store_cls()(request, self.session_key)
+        self._load()
+        self._index = None
+        self._index_version = None
+        self._save_deferred = False
+        self._save_pending = False
+
+    @property
+    def _data(self):
+        return self._request_data()[self.session_key]
+
+    def get_version(self):
+        return self._request_versions().get(self.session_key, 0)
+
+    def changed(self):
+        versions = self._request_versions()
+        version = versions.get(self.session_key, 0)
+        versions[self.session_key] = version + 1
+        # changes made through this instance keep its line index up to date
+        # (or discard it), so it's only stale after changes made elsewhere
+        if self._index_version == version:
+            self._index_version = version + 1
 
     def get_voucher_codes(self):
         if self._data is None:
@@ -84,14 +270,23 @@ class SessionCart(ICart, IShippable):
 
         self._init_session_cart()
         self._data["vouchers"] = list(codes)
-        self.request.session.modified = True
+        self._save()
+        self.changed()
 
     def set_shipping_option(self, option_id):
         """Saves the provided option_id to this SessionCart."""
 
         self._init_session_cart()
         self._data['shipping_option'] = option_id
-        self.request.session.modified = True
+        self._save()
+        self.changed()
+
+    def select_shipping_option(self, option_id):
+        """Set an automatically chosen option_id, without saving - it's
+           saved along with the next change to the cart. """
+
+        self._init_session_cart()
+        self._data['shipping_option'] = option_id
 
     def get_shipping_option(self):
         """Get shipping options for this cart, if any. """
@@ -102,8 +297,10 @@ class SessionCart(ICart, IShippable):
 
     def update_quantity(self, instance, quantity=1, add=False, options={}):
         assert isinstance(quantity, int)
+        assert isinstance(instance, ICartItem)
         options = validate_options(instance, options)
-        index = self._line_index(instance, options)
+        key = create_line_key(instance, options)
+        index = self._line_index(key)
 
         # quantity may be additive or a straight update
         # TODO kill the add argument. cart.add should do this extra calculation
@@ -116,29 +313,31 @@ class SessionCart(ICart, IShippable):
                 # fail silently
                 return (True, None)
             del self._data["lines"][index]
-            self.request.session.modified = True
+            self._index = None
+            self._save()
+            self.changed()
             return (True, None)
 
         if index is None:
             # Add to cart if not in there already
             data = {
-                'key': create_line_key(instance, options),
+                'key': key,
                 'quantity': quantity,
                 'options': options
             }
-            line = self.make_line_obj(data)
+            line = self.make_line_obj(data, item=instance)
             errors = line.get_errors()
             if errors:
                 return (False, errors)
 
             # Append line if no errors
             self._init_session_cart()
-            self._data["lines"].append(data)
+            self._append_line(data)
         else:
             # Already in the cart, so update the existing line
             data = copy.deepcopy(self._data["lines"][index])
             data['quantity'] = quantity
-            line = self.make_line_obj(data)
+            line = self.make_line_obj(data, item=instance)
             errors = line.get_errors()
             if errors:
                 return (False, errors)
@@ -146,62 +345,86 @@ class SessionCart(ICart, IShippable):
             # Update data if no errors
             self._data["lines"][index] = data
 
-        self.request.session.modified = True
+        self._save()
+        self.changed()
         return (True, None)
 
     def update_options(self, key, options):
         # TODO make this less convoluted
         instance, old_options = unpack_line_key(key)
-        old_options = validate_options(instance, old_options)
-        old_index = self._line_index(instance, old_options)
+        old_index = self._line_index(
+            create_line_key(instance, old_options))
 
         if old_index is None:
             return (False, ['Invalid options'])
 
         # Create new cart line
-        old_line = self.get_line(instance, old_options)
+        old_line = self._data["lines"][old_index]
         new_options = validate_options(instance, options)
         new_data = {
             'key': create_line_key(instance, new_options),
-            'quantity': old_line.quantity,
+            'quantity': old_line['quantity'],
             'options': new_options
         }
-        new_line = self.make_line_obj(new_data)
+        new_line = self.make_line_obj(new_data, item=instance)
         errors = new_line.get_errors()
         if errors:
             return (False, errors)
 
         # Swap out lines if no errors
-        self._data["lines"].append(new_data)
+        self._append_line(new_data)
         del self._data["lines"][old_index]
+        self._index = None
 
-        self.request.session.modified = True
+        self._save()
+        self.changed()
         return (True, None)
 
+    def get_store_cls(self):
+        return import_string(shoptools_settings.CART_STORE)
+
     def get_line_cls(self):
         """Subclasses should override this if SessionCartLine is also
            subclassed. """
         return SessionCartLine
 
-    def make_line_obj(self, data):
-        return self.get_line_cls()(parent_object=self, **data)
+    def make_line_obj(self, data, item=UNRESOLVED):
+        return self.get_line_cls()(parent_object=self, item=item, **data)
 
     def get_line(self, instance, options={}):
-        index = self._line_index(instance, options)
+        assert isinstance(instance, ICartItem)
+        index = self._line_index(create_line_key(instance, options))
         if index is None:
             return None
-        return self.make_line_obj(self._data["lines"][index])
+        return self.make_line_obj(self._data["lines"][index], item=instance)
 
     def get_lines(self):
+        """Return the cart lines, cached until the cart is next changed. """
+
         # TODO consistent ordering
         rv = []
         if self._data is None:
             return rv
+
+        version = self.get_version()
+        cached = getattr(self, '_lines_cache', None)
+        if cached and cached[0] == version:
+            return list(cached[1])
+
+        # resolve all the line items up front, so the cost of rendering the
+        # cart doesn't depend on the number of lines
+        unpacked = unpack_line_keys(
+            set(line['key'] for line in self._data["lines"]))
+
         for line in self._data["lines"]:
-            line = self.make_line_obj(line)
+            instance, options = unpacked[line['key']]
+            line = self.make_line_obj(line, item=instance)
             if line.item:
+                line.pricing_batch = rv
                 rv.append(line)
-        return rv
+
+        self._lines_cache = (version, rv)
+        return list(rv)
 
     def count(self):
         if self._data is None:
@@ -218,20 +441,10 @@ class SessionCart(ICart, IShippable):
         return (shoptools_settings.DEFAULT_CURRENCY_CODE,
                 shoptools_settings.DEFAULT_CURRENCY_SYMBOL)
 
-    @property
-    def subtotal(self):
-        if self._data is None:
-            return decimal.Decimal(0)
-        return decimal.Decimal(
-            sum(line.total if line.total else 0 for line in self.get_lines()))
-
-    @property
-    def total(self):
-        return self.subtotal + self.shipping_cost - self.total_discount
-
     def set_order_obj(self, obj):
         self._data['order_obj'] = create_instance_key(obj)
-        self.request.session.modified = True
+        self._save()
+        self.changed()
 
     def get_order_obj(self):
         if self._data is None:
@@ -250,8 +463,10 @@ class SessionCart(ICart, IShippable):
 
     def clear(self):
         if self._data is not None:
-            del self.request.session[self.session_key]
-            self._data = None
+            self.store.delete()
+            self._request_data()[self.session_key] = None
+            self._index = None
+            self.changed()
 
     def save_to(self, obj):
         super(SessionCart, self).save_to(obj)
@@ -262,18 +477,78 @@ class SessionCart(ICart, IShippable):
     # Private methods
     def _init_session_cart(self):
         if self._data is None:
-            data = {'lines': []}
-            self._data = self.request.session[self.session_key] = data
-
-    def _line_index(self, instance, options):
-        """Returns the line index for a given ctype/pk/options, if it's
-           already in the cart, or None otherwise."""
+            self._request_data()[self.session_key] = {'lines': []}
+
+    def _request_data(self):
+        if not hasattr(self.request, 'shoptools_cart_data'):
+            self.request.shoptools_cart_data = {}
+        return self.request.shoptools_cart_data
+
+    def _request_versions(self):
+        if not hasattr(self.request, 'shoptools_cart_versions'):
+            self.request.shoptools_cart_versions = {}
+        return self.request.shoptools_cart_versions
+
+    def _load(self):
+        request_data = self._request_data()
+        if self.session_key not in request_data:
+            request_data[self.session_key] = decode_cart_data(
+                self.store.load())
+        return request_data[self.session_key]
+
+    @contextmanager
+    def deferred_save(self):
+        if self._save_deferred:
+            yield
+            return
+
+        self._save_deferred = True
+        self._save_pending = False
+        try:
+            yield
+        finally:
+            self._save_deferred = False
+            if self._save_pending:
+                self._save()
+
+    def _save(self):
+        if self._save_deferred:
+            self._save_pending = True
+            return
+        self.store.save(encode_cart_data(
+            self._data,
+            compress=shoptools_settings.CART_SESSION_COMPRESS))
+
+    def _line_index(self, key):
+        """Returns the line index for a given line key, if it's already in the
+           cart, or None otherwise. """
 
-        assert isinstance(instance, ICartItem)
+        if self._data is None:
+            return None
 
-        if self._data is not None:
-            for i in range(len(self._data["lines"])):
-                key = create_line_key(instance, options)
-                if self._data["lines"][i]["key"] == key:
-                    return i
-        return None
+        lines = self._data["lines"]
+
+        # The key -> index map is built on demand, and rebuilt if the lines
+        # have been changed from elsewhere, i.e. another SessionCart instance
+        # for the same session
+        index = self._index
+        if index is None or self._index_version != self.get_version() or \
+                len(index) != len(lines):
+            index = self._build_index()
+
+        i = index.get(key)
+        if i is not None and (i >= len(lines) or lines[i]["key"] != key):
+            i = self._build_index().get(key)
+        return i
+
+    def _build_index(self):
+        self._index = dict(
+            (line["key"], i) for i, line in enumerate(self._data["lines"]))
+        self._index_version = self.get_version()
+        return self._index
+
+    def _append_line(self, data):
+        lines = self._data["lines"]
+        if self._index is not None and len(self._index) == len(lines):
+            self._index[data["key"]] = len(lines)
+        lines.append(data)
@@ -1,6 +1,7 @@
 from django.dispatch import Signal
 
 
-all_actions = ('add', 'quantity', 'options', 'clear', 'set_voucher_codes')
+all_actions = ('add', 'quantity', 'options', 'remove', 'clear',
+               'set_voucher_codes', 'batch')
 for action in all_actions:
     locals()[action] = Signal(providing_args=['success', 'request'])
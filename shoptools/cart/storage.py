@@ -0,0 +1,65 @@
+import re
+import uuid
+
+from django.core.cache import caches
+
+from shoptools import settings as shoptools_settings
+
+
+class SessionCartStore(object):
+    """Stores cart data directly in the session. This is the default, but it
+       means the whole session is rewritten every time the cart changes. """
+
+    def __init__(self, request, key):
+        self.request = request
+        self.key = key
+
+    def load(self):
+        return self.request.session.get(self.key, None)
+
+    def save(self, payload):
+        self.request.session[self.key] = payload
+
+    def delete(self):
+        self.request.session.pop(self.key, None)
+
+
+class CacheCartStore(SessionCartStore):
+    """Stores cart data in a django cache (i.e. redis or memcached) with a
+       timeout, so cart changes don't rewrite the session. Only a random cart
+       id is kept in the session, which is written once per visitor.
+
+       Configured via SHOPTOOLS_CART_CACHE_ALIAS and
+       SHOPTOOLS_CART_CACHE_TIMEOUT.
+    """
+
+    cache_key_prefix = 'shoptools-cart:'
+    cart_id_re = re.compile(r'^[0-9a-f]{32}$')
+
+    @property
+    def cache(self):
+        return caches[shoptools_settings.CART_CACHE_ALIAS]
+
+    def get_cache_key(self, create=False):
+        cart_id = self.request.session.get(self.key, None)
+        # the session may hold cart data from SessionCartStore, i.e. after
+        # switching stores, which is treated as no cart
+        if not (isinstance(cart_id, str) and self.cart_id_re.match(cart_id)):
+            cart_id = None
+        if not cart_id and create:
+            cart_id = self.request.session[self.key] = uuid.uuid4().hex
+        return self.cache_key_prefix + cart_id if cart_id else None
+
+    def load(self):
+        cache_key = self.get_cache_key()
+        return self.cache.get(cache_key) if cache_key else None
+
+    def save(self, payload):
+        self.cache.set(self.get_cache_key(create=True), payload,
+                       shoptools_settings.CART_CACHE_TIMEOUT)
+
+    def delete(self):
+        # leave the cart id in the session, to avoid a session write
+        cache_key = self.get_cache_key()
+        if cache_key:
+            self.cache.delete(cache_key)
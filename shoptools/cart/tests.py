@@ -1,9 +1,330 @@
-from django.test import TestCase
+import json
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import TestCase, RequestFactory
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+from shoptools.contrib.catalogue.models import Product
+from shoptools.contrib.regions import cache as regions_cache
+from shoptools.contrib.regions.models import Currency, Region
+
+from . import actions, signals
+from .session import SessionCart, encode_cart_data, decode_cart_data
+from .storage import CacheCartStore, SessionCartStore
+
+
+def make_request():
+    request = RequestFactory().get('/')
+    request.session = SessionStore()
+    return request
+
+
+def make_products(count):
+    return [Product.objects.create(name='Product %s' % i, price=10,
+                                   shipping_cost=0)
+            for i in range(count)]
 
 
 class CartTestCase(TestCase):
     def setUp(self):
+        regions_cache.clear_all()
         pass
 
     def test_sample(self):
         self.assertEqual(1, 1)
+
+
+class SessionCartTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        self.request = make_request()
+        self.cart = SessionCart(self.request)
+        self.products = make_products(5)
+        ContentType.objects.get_for_model(Product)
+
+    def test_get_lines_queries(self):
+        for product in self.products:
+            self.cart.add(product, 2)
+
+        with self.assertNumQueries(1):
+            lines = self.cart.get_lines()
+            for line in lines:
+                line.item
+                line.total
+                line.description
+
+        self.assertEqual(len(lines), 5)
+        self.assertEqual([line.item for line in lines], self.products)
+
+    def test_get_lines_deleted_item(self):
+        for product in self.products:
+            self.cart.add(product)
+
+        self.products[0].delete()
+        self.assertEqual(len(self.cart.get_lines()), 4)
+
+    def test_pricing_snapshot(self):
+        for product in self.products:
+            self.cart.add(product)
+
+        self.assertEqual(self.cart.subtotal, 50)
+        self.cart.total
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.cart.subtotal
+                self.cart.shipping_cost
+                self.cart.total_discount
+                self.cart.total
+
+        # mutating the cart discards the snapshot
+        self.cart.add(self.products[0])
+        self.assertEqual(self.cart.subtotal, 60)
+        self.cart.remove(self.products[0])
+        self.assertEqual(self.cart.total, 40)
+
+    def test_shared_version(self):
+        # carts for the same request share their data and version, so cached
+        # pricing and lines are discarded for all of them
+        other_cart = SessionCart(self.request)
+        self.assertEqual(self.cart.subtotal, 0)
+        self.assertEqual(self.cart.get_lines(), [])
+
+        other_cart.add(self.products[0])
+        self.assertEqual(self.cart.subtotal, 10)
+        self.assertEqual(len(self.cart.get_lines()), 1)
+        self.assertEqual(self.cart.count(), 1)
+
+        other_cart.clear()
+        self.assertEqual(self.cart.subtotal, 0)
+        self.assertEqual(self.cart.get_lines(), [])
+
+    def test_batch_pricing(self):
+        for product in self.products:
+            self.cart.add(product, 2)
+
+        calls = []
+
+        def cart_line_totals(cls, lines):
+            calls.append(len(lines))
+            return [5 * line.quantity for line in lines]
+
+        with mock.patch.object(Product, 'cart_line_totals',
+                               classmethod(cart_line_totals), create=True):
+            lines = self.cart.get_lines()
+            self.assertEqual([line.total for line in lines], [10] * 5)
+            self.assertEqual(self.cart.subtotal, 50)
+
+        self.assertEqual(calls, [5])
+
+    def test_batch_validation(self):
+        for product in self.products:
+            self.cart.add(product)
+
+        calls = []
+
+        def cart_lines_errors(cls, lines):
+            calls.append(len(lines))
+            return [['%s is out of stock' % line.item] for line in lines]
+
+        with mock.patch.object(Product, 'cart_lines_errors',
+                               classmethod(cart_lines_errors), create=True):
+            errors = self.cart.get_errors()
+            self.assertEqual(errors[:5], ['Product %s is out of stock' % i
+                                          for i in range(5)])
+            self.assertEqual(self.cart.get_errors(), errors)
+            self.assertFalse(self.cart.is_valid)
+            self.assertEqual(calls, [5])
+
+            self.cart.remove(self.products[0])
+            self.cart.get_errors()
+            self.assertEqual(calls, [5, 4])
+
+    def test_line_index(self):
+        product = self.products[0]
+        for colour in ('Red', 'Blue'):
+            self.cart.add(product, options={'Colour': colour})
+        for other in self.products[1:]:
+            self.cart.add(other)
+
+        self.cart.add(product, 2, options={'Colour': 'Blue'})
+        self.assertEqual(
+            self.cart.get_line(product, {'Colour': 'Blue'}).quantity, 3)
+
+        self.cart.remove(product, options={'Colour': 'Red'})
+        self.assertIsNone(self.cart.get_line(product, {'Colour': 'Red'}))
+        self.assertEqual(self.cart.get_line(self.products[4]).quantity, 1)
+
+        line = self.cart.get_line(product, {'Colour': 'Blue'})
+        self.cart.update_options(line.key, {'Colour': 'Red'})
+        self.assertIsNone(self.cart.get_line(product, {'Colour': 'Blue'}))
+        self.assertEqual(
+            self.cart.get_line(product, {'Colour': 'Red'}).quantity, 3)
+
+        # another instance sharing the session sees the same lines
+        other_cart = SessionCart(self.request)
+        other_cart.add(self.products[1])
+        self.assertEqual(self.cart.get_line(self.products[1]).quantity, 2)
+        self.assertEqual(self.cart.count(), 8)
+
+        # including a line whose key changed, with the same number of lines
+        line = other_cart.get_line(product, {'Colour': 'Red'})
+        other_cart.update_options(line.key, {'Colour': 'Green'})
+        self.cart.add(product, options={'Colour': 'Green'})
+        self.assertEqual(
+            self.cart.get_line(product, {'Colour': 'Green'}).quantity, 4)
+        self.assertEqual(len(self.cart.get_lines()), 5)
+
+    def test_session_encoding(self):
+        self.cart.add(self.products[0], options={'Colour': 'Red'})
+        self.cart.add(self.products[1], 3)
+        self.cart.set_voucher_codes(['ABC'])
+        data = self.cart._data
+
+        stored = self.request.session[self.cart.session_key]
+        self.assertEqual(stored['v'], 2)
+        self.assertEqual(decode_cart_data(stored), data)
+        self.assertEqual(
+            decode_cart_data(encode_cart_data(data, compress=True)), data)
+
+        # a new request reads the stored data
+        request = make_request()
+        request.session = self.request.session
+        self.assertEqual(SessionCart(request).count(), 4)
+
+        # string pks are kept as strings unless they're plain integers
+        for pk, encoded in (('007', '007'), ('12', 12), ('-3', -3),
+                            ('abc', 'abc'), ('²', '²')):
+            key = 'catalogue.product|%s|{}' % pk
+            data = {'lines': [{'key': key, 'quantity': 1, 'options': {}}]}
+            stored = encode_cart_data(data)
+            self.assertEqual(stored['l'][0][1], encoded)
+            self.assertEqual(decode_cart_data(stored)['lines'][0]['key'],
+                             key)
+
+    def test_legacy_session_format(self):
+        product = self.products[0]
+        request = make_request()
+        request.session['cart'] = {
+            'lines': [{
+                'key': 'catalogue.product|%s|{"Colour": "Red"}' % product.pk,
+                'quantity': 2,
+                'options': {'Colour': 'Red'},
+            }],
+        }
+
+        cart = SessionCart(request)
+        self.assertEqual(cart.get_line(product, {'Colour': 'Red'}).quantity,
+                         2)
+        cart.add(product, options={'Colour': 'Red'})
+        self.assertEqual(request.session['cart']['v'], 2)
+
+    def test_cache_store(self):
+        class CacheSessionCart(SessionCart):
+            def get_store_cls(self):
+                return CacheCartStore
+
+        cart = CacheSessionCart(self.request)
+        cart.add(self.products[0])
+        cart_id = self.request.session['cart']
+        self.request.session.modified = False
+
+        cart.add(self.products[1], 2)
+        self.assertFalse(self.request.session.modified)
+
+        request = make_request()
+        request.session = self.request.session
+        self.assertEqual(CacheSessionCart(request).count(), 3)
+
+        cart.clear()
+        request = make_request()
+        request.session = self.request.session
+        self.assertEqual(CacheSessionCart(request).count(), 0)
+        self.assertEqual(self.request.session['cart'], cart_id)
+
+        # cart data left in the session by SessionCartStore is ignored
+        for payload in (encode_cart_data({'lines': []}),
+                        encode_cart_data({'lines': []}, compress=True),
+                        {'lines': []}):
+            request = make_request()
+            request.session['cart'] = payload
+            cart = CacheSessionCart(request)
+            self.assertEqual(cart.count(), 0)
+            cart.add(self.products[0])
+            other_request = make_request()
+            other_request.session = request.session
+            self.assertEqual(CacheSessionCart(other_request).count(), 1)
+
+
+class CartViewsTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        self.products = make_products(3)
+        Region.objects.create(name='New Zealand', is_default=True,
+                              currency=Currency.objects.create())
+
+    def test_batch(self):
+        operations = [
+            {'action': 'add', 'ctype': 'catalogue.product',
+             'pk': product.pk, 'quantity': 2}
+            for product in self.products
+        ] + [
+            {'action': 'quantity', 'ctype': 'catalogue.product',
+             'pk': self.products[0].pk, 'quantity': 0},
+            {'action': 'add', 'ctype': 'catalogue.product', 'pk': 0},
+            {'action': 'explode'},
+        ]
+
+        # the cart is saved once, not after each operation
+        with mock.patch.object(SessionCartStore, 'save', autospec=True,
+                               side_effect=SessionCartStore.save) as save:
+            response = self.client.post(
+                reverse('cart_batch'), {'operations': json.dumps(operations)},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(save.call_count, 1)
+        data = json.loads(response.content.decode())
+
+        self.assertFalse(data['success'])
+        self.assertEqual([r['success'] for r in data['results']],
+                         [True, True, True, True, False, False])
+        self.assertEqual(data['cart']['count'], 4)
+
+    def test_batch_signals(self):
+        sent = []
+
+        def receiver(signal, success, **kwargs):
+            sent.append((signal, success))
+
+        for signal in (signals.add, signals.remove, signals.batch):
+            signal.connect(receiver)
+            self.addCleanup(signal.disconnect, receiver)
+
+        operations = [
+            {'action': 'add', 'ctype': 'catalogue.product',
+             'pk': self.products[0].pk},
+            {'action': 'remove', 'ctype': 'catalogue.product', 'pk': 0},
+            {'action': 'sold_out'},
+        ]
+        sold_out = mock.Mock(return_value=(False, 'Sold out'))
+        with mock.patch.dict(actions.BATCH_ACTIONS, {'sold_out': sold_out}):
+            response = self.client.post(
+                reverse('cart_batch'),
+                {'operations': json.dumps(operations)},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(response.content.decode())
+
+        # each operation's signal is sent, as for single actions
+        self.assertEqual(sent, [(signals.add, True), (signals.remove, False),
+                                (signals.batch, False)])
+        # errors returned as a string aren't split into characters
+        self.assertEqual(data['results'][2]['errors'], ['Sold out'])
+        self.assertEqual(data['errors'], ['Invalid item', 'Sold out'])
+
+    def test_batch_invalid(self):
+        response = self.client.post(reverse('cart_batch'),
+                                    {'operations': '{"action": "add"}'})
+        self.assertEqual(response.status_code, 400)
@@ -8,6 +8,12 @@ from . import actions
 from . import signals
 
 
+def send_signal(name, cart, success, request):
+    signal = getattr(signals, name, None)
+    if signal:
+        signal.send(sender=cart.__class__, success=success, request=request)
+
+
 def cart_view(action=None):
     """Decorator supplies request and current cart as arguments to the action
        function. Returns appropriate errors if the request method is not POST,
@@ -23,6 +29,7 @@ def cart_view(action=None):
 
         cart = get_cart(request)
         success = True
+        extra_data = {}
 
         post_params = request.POST.dict()
 
@@ -35,15 +42,21 @@ def cart_view(action=None):
 
         if action:
             # don't allow multiple values for each get param
-            success, errors = action(post_params, cart)
+            rv = action(post_params, cart)
+            success, errors = rv[:2]
+            if len(rv) > 2:
+                extra_data = rv[2]
 
             if success is None:
                 return HttpResponseBadRequest()
 
-        signal = getattr(signals, action.__name__, None)
-        if signal:
-            signal.send(
-                sender=cart.__class__, success=success, request=request)
+            # batch operations send their own actions' signals
+            for result in extra_data.get('results', []):
+                if result['action'] in actions.BATCH_ACTIONS:
+                    send_signal(result['action'], cart, result['success'],
+                                request)
+
+        send_signal(action.__name__, cart, success, request)
 
         if request.is_ajax():
             data = {
@@ -51,6 +64,7 @@ def cart_view(action=None):
                 'errors': errors,
                 'cart': cart.as_dict(),
             }
+            data.update(extra_data)
             if get_html_snippet:
                 data['html_snippet'] = get_html_snippet(request, cart, errors)
 
@@ -74,6 +88,7 @@ def cart_view(action=None):
 # TODO rename - confusing
 get_cart = cart_view()
 
-all_actions = ('add', 'quantity', 'options', 'clear', 'set_voucher_codes')
+all_actions = ('add', 'quantity', 'options', 'remove', 'clear',
+               'set_voucher_codes', 'batch')
 for action in all_actions:
     locals()[action] = cart_view(getattr(actions, action))
@@ -1,14 +1,16 @@
 from datetime import date
 from django.contrib import admin
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django import forms
+from django.utils import timezone
 from django.utils.text import mark_safe
 
 from shoptools.util import get_payment_module, get_vouchers_module
 
-from .models import Order, OrderLine, Address
-from .export import generate_csv
-from .emails import send_dispatch_email
+from .models import Order, OrderLine, Address, OrderTask
+from .export import stream_csv
+from .tasks import enqueue_many
+from .util import mark_shipped
 
 payment_mod = get_payment_module()
 payment_inlines = getattr(payment_mod, "get_checkout_inlines",
@@ -41,6 +43,16 @@ class OrderLineInline(admin.TabularInline):
         return False
 
 
+class OrderTaskInline(admin.TabularInline):
+    model = OrderTask
+    fields = ('name', 'status', 'attempts', 'run_after', 'error_message')
+    readonly_fields = fields
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class AddOrderLineForm(forms.ModelForm):
     item = forms.CharField(
         widget=forms.TextInput(attrs={'class': 'variant-autocomplete'}))
@@ -87,7 +99,8 @@ class OrderAdmin(admin.ModelAdmin):
     inlines = [
         AddressInline,
         OrderLineInline,
-        AddOrderLineInline
+        AddOrderLineInline,
+        OrderTaskInline,
     ] + voucher_inlines + payment_inlines
     save_on_top = True
     search_fields = ('id', 'addresses__first_name', 'addresses__last_name',
@@ -95,15 +108,22 @@ class OrderAdmin(admin.ModelAdmin):
                      'addresses__address', 'addresses__city',
                      'addresses__state', 'addresses__postcode',
                      'addresses__suburb')
-    actions = ('csv_export', 'resend_dispatch_email')
+    actions = ('csv_export', 'mark_shipped', 'resend_dispatch_email')
     readonly_fields = ('created', 'checkout_completed', '_shipping_cost', 'id',
                        'amount_paid', 'currency_code', )
 
+    def mark_shipped(self, request, queryset):
+        count = mark_shipped(queryset)
+        self.message_user(request, "Orders marked as shipped: %s" % count)
+    mark_shipped.short_description = 'Mark selected paid orders as shipped'
+
     def resend_dispatch_email(self, request, queryset):
-        for order in queryset:
-            send_dispatch_email(order)
+        # a unique key, so earlier dispatch emails don't prevent a resend
+        count = enqueue_many(
+            queryset.values_list('pk', flat=True), 'dispatch_email',
+            key='dispatch_email:%s' % timezone.now().timestamp())
 
-        self.message_user(request, "Emails sent: %s" % queryset.count())
+        self.message_user(request, "Emails queued: %s" % count)
 
     # def dispatch(self, request, order_pk):
     #     return
@@ -117,12 +137,10 @@ class OrderAdmin(admin.ModelAdmin):
     def csv_export(self, request, queryset):
         filename = 'order_export_' + date.today().strftime('%Y%m%d')
 
-        # response = HttpResponse()
-        response = HttpResponse(content_type='text/csv')
+        response = StreamingHttpResponse(stream_csv(queryset),
+                                         content_type='text/csv')
         response['Content-Disposition'] = \
             "attachment; filename=%s.csv" % filename
-
-        generate_csv(queryset, response)
         return response
 
     def has_add_permission(self, request):
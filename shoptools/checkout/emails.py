@@ -8,21 +8,50 @@ email_module = get_email_module()
 TEMPLATE_DIR = 'checkout/emails/'
 
 
-def send_email_receipt(order):
+class EmailFailed(Exception):
+    pass
+
+
+def send_email(email_type, recipients, order, connection=None,
+               fail_silently=True):
+    # only pass the connection if given, for custom email modules which
+    # don't accept one
+    extra = {'connection': connection} if connection else {}
+    sent = email_module.send_email(email_type, TEMPLATE_DIR, recipients,
+                                   related_obj=order,
+                                   fail_silently=fail_silently, order=order,
+                                   **extra)
+    # custom email modules may report failure rather than raising
+    if sent is False and not fail_silently:
+        raise EmailFailed('%s email to %s failed' % (
+            email_type, ', '.join(recipients)))
+
+
+def send_email_receipt(order, connection=None, fail_silently=True,
+                       notify_managers=True):
     if email_module and hasattr(email_module, 'send_email'):
-        email_module.send_email('receipt', TEMPLATE_DIR, [order.email],
-                                related_obj=order, fail_silently=True,
-                                order=order)
-        manager_emails = getattr(settings, 'CHECKOUT_MANAGERS', [])
-        if manager_emails:
-            email_module.send_email('notification', TEMPLATE_DIR,
-                                    [t[1] for t in manager_emails],
-                                    related_obj=order, fail_silently=True,
-                                    order=order)
-
-
-def send_dispatch_email(order):
+        send_email('receipt', [order.email], order, connection=connection,
+                   fail_silently=fail_silently)
+    if notify_managers:
+        send_manager_notification(order, connection=connection,
+                                  fail_silently=fail_silently)
+
+
+def get_manager_emails():
+    # either (name, email) pairs, like settings.MANAGERS, or just addresses
+    return [m if isinstance(m, str) else m[1]
+            for m in getattr(settings, 'CHECKOUT_MANAGERS', [])]
+
+
+def send_manager_notification(order, connection=None, fail_silently=True):
+    manager_emails = get_manager_emails()
+    if manager_emails and email_module and \
+            hasattr(email_module, 'send_email'):
+        send_email('notification', manager_emails, order,
+                   connection=connection, fail_silently=fail_silently)
+
+
+def send_dispatch_email(order, connection=None, fail_silently=True):
     if email_module and hasattr(email_module, 'send_email'):
-        email_module.send_email('dispatch', TEMPLATE_DIR, [order.email],
-                                related_obj=order, fail_silently=True,
-                                order=order)
+        send_email('dispatch', [order.email], order, connection=connection,
+                   fail_silently=fail_silently)
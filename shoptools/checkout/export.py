@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
-# import os
+import os
 import csv
-# import datetime
+import gzip
+import json
+from collections import OrderedDict
 
 from django.db import models
 
@@ -19,6 +21,8 @@ def getval(obj, getter):
             val = getattr(val, attr)
             if callable(val):
                 val = val()
+            if val is None:
+                break
     if val is True:
         val = 'yes'
     elif val is False:
@@ -56,27 +60,117 @@ LINE_FIELDS = (
 )
 
 
-def generate_csv(qs, file_object):
-    csvfile = csv.writer(file_object)
+# orders fetched per query when exporting
+CHUNK_SIZE = 500
+
+
+class Echo(object):
+    """File-like object which returns what's written to it, so csv.writer
+       output can be streamed. """
+
+    def write(self, value):
+        return value
+
+
+def prefetch_orders(qs):
+    """Prefetch everything the export fields need, so each order costs no
+       extra queries. """
+
+    lookups = ['addresses', 'lines']
+    if hasattr(qs.model, 'discount_set'):
+        lookups.append('discount_set')
+    return qs.prefetch_related(*lookups)
 
+
+def iterate_orders(qs, chunk_size=CHUNK_SIZE):
+    """Yield the orders in qs, in order, fetching chunk_size at a time with
+       prefetched relations. prefetch_related doesn't work with iterator(),
+       so the primary keys are fetched up front and the orders fetched in
+       chunks by pk. """
+
+    pks = list(qs.values_list('pk', flat=True))
+    manager = qs.model._default_manager
+    for i in range(0, len(pks), chunk_size):
+        chunk = pks[i:i + chunk_size]
+        objs = prefetch_orders(manager.all()).in_bulk(chunk)
+        for pk in chunk:
+            if pk in objs:
+                yield objs[pk]
+
+
+def get_header(lines_max):
     header = [f[0] for f in ORDER_FIELDS]
+    for i in range(1, lines_max + 1):
+        header += [(f[0] + ' (%s)' % i) for f in LINE_FIELDS]
+    return header
+
+
+def get_row(obj):
+    row = [getval(obj, getter) for name, getter in ORDER_FIELDS]
+    for line in obj.lines.all():
+        for name, getter in LINE_FIELDS:
+            row.append(getval(line, getter))
+    return row
+
+
+def generate_rows(qs, chunk_size=CHUNK_SIZE):
+    """Yield the header and a row per order, without loading the whole
+       queryset into memory. """
 
     # calculate max number of lines
     lines_max = qs.annotate(line_count=models.Count('lines'))\
                   .aggregate(lines_max=models.Max('line_count'))['lines_max']
 
-    for i in range(1, lines_max + 1):
-        header += [(f[0] + ' (%s)' % i) for f in LINE_FIELDS]
-
-    csvfile.writerow(header)
+    yield get_header(lines_max or 0)
 
-    for obj in qs:
-        row = []
-        for name, getter in ORDER_FIELDS:
-            row.append(getval(obj, getter))
+    for obj in iterate_orders(qs, chunk_size):
+        yield get_row(obj)
 
-        for line in obj.lines.all():
-            for name, getter in LINE_FIELDS:
-                row.append(getval(line, getter))
 
+def generate_csv(qs, file_object):
+    csvfile = csv.writer(file_object)
+    for row in generate_rows(qs):
         csvfile.writerow(row)
+
+
+def stream_csv(qs):
+    """Return an iterator of csv lines, for a StreamingHttpResponse. """
+
+    csvfile = csv.writer(Echo())
+    return (csvfile.writerow(row) for row in generate_rows(qs))
+
+
+def get_record(obj):
+    """Return an ordered dict of an order's export fields, with its lines
+       nested, for json output. """
+
+    record = OrderedDict((name, getval(obj, getter))
+                         for name, getter in ORDER_FIELDS)
+    record['Lines'] = [OrderedDict((name, getval(line, getter))
+                                   for name, getter in LINE_FIELDS)
+                       for line in obj.lines.all()]
+    return record
+
+
+def write_export(qs, filename, format='csv'):
+    """Write the orders in qs to a gzipped csv or json lines ('jsonl') file.
+       The file is written under a temporary name and renamed when
+       complete, so a partial export never appears under the final name.
+       Returns the number of orders written. """
+
+    count = 0
+    tmp_filename = filename + '.tmp'
+    with gzip.open(tmp_filename, 'wt', newline='') as f:
+        if format == 'jsonl':
+            for obj in iterate_orders(qs):
+                f.write(json.dumps(get_record(obj)) + '\n')
+                count += 1
+        else:
+            csvfile = csv.writer(f)
+            rows = generate_rows(qs)
+            csvfile.writerow(next(rows))
+            for row in rows:
+                csvfile.writerow(row)
+                count += 1
+    os.replace(tmp_filename, filename)
+    return count
@@ -0,0 +1,150 @@
+import json
+import math
+import multiprocessing
+import os
+from datetime import timedelta
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from shoptools.checkout.export import write_export
+from shoptools.checkout.models import Order
+
+
+STATE_FILENAME = 'export-state.json'
+
+
+def changed_orders(since, until):
+    qs = Order.objects.filter(updated__lte=until)
+    if since:
+        qs = qs.filter(updated__gt=since)
+    return qs
+
+
+def export_partition(partition):
+    """Export one id range of the run's orders. Runs in a worker process. """
+
+    since, until = [parse_datetime(v) if v else None
+                    for v in (partition['since'], partition['until'])]
+    qs = changed_orders(since, until) \
+        .filter(pk__gte=partition['start'], pk__lte=partition['end']) \
+        .order_by('pk')
+    count = write_export(qs, partition['filename'], partition['format'])
+    return partition['filename'], count
+
+
+class Command(BaseCommand):
+    help = 'Export orders changed since the last run to gzipped csv or ' \
+           'json lines files, split by id range across processes. Progress ' \
+           'is kept in a state file in the output directory, so an ' \
+           'interrupted run is resumed by running the command again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            default='csv')
+        parser.add_argument('--processes', type=int,
+                            default=min(os.cpu_count() or 1, 4))
+        parser.add_argument('--partition-size', type=int, default=10000,
+                            help='Approximate number of orders per file')
+        parser.add_argument('--lag', type=int, default=60,
+                            help='Seconds to lag behind the current time, '
+                                 'so transactions in progress aren\'t missed')
+
+    def handle(self, output_dir, **options):
+        if options['partition_size'] < 1:
+            raise CommandError('--partition-size must be at least 1')
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.state_path = os.path.join(output_dir, STATE_FILENAME)
+        state = self.load_state()
+
+        if state.get('run'):
+            run = state['run']
+            if options['verbosity'] > 1:
+                self.stdout.write('Resuming export until %s' % run['until'])
+        else:
+            run = state['run'] = self.plan_run(
+                state.get('watermark'), output_dir, options)
+            self.save_state(state)
+
+        pending = [p for p in run['partitions'] if not p['done']]
+        for filename, count in self.run_partitions(pending,
+                                                   options['processes']):
+            for partition in run['partitions']:
+                if partition['filename'] == filename:
+                    partition['done'] = True
+            self.save_state(state)
+            if options['verbosity'] > 1:
+                self.stdout.write('Wrote %s orders to %s' % (count, filename))
+
+        state['watermark'] = run['until']
+        state['run'] = None
+        self.save_state(state)
+
+    def plan_run(self, watermark, output_dir, options):
+        """Split the orders changed since the watermark into id ranges of
+           roughly partition_size orders each. """
+
+        since = parse_datetime(watermark) if watermark else None
+        until = timezone.now() - timedelta(seconds=options['lag'])
+        stats = changed_orders(since, until).aggregate(
+            start=models.Min('pk'), end=models.Max('pk'),
+            count=models.Count('pk'))
+
+        partitions = []
+        if stats['count']:
+            chunks = math.ceil(stats['count'] / options['partition_size'])
+            step = math.ceil((stats['end'] - stats['start'] + 1) / chunks)
+            for start in range(stats['start'], stats['end'] + 1, step):
+                end = min(start + step - 1, stats['end'])
+                filename = 'orders-%s-%s-%s.%s.gz' % (
+                    until.strftime('%Y%m%dT%H%M%S'), start, end,
+                    options['format'])
+                partitions.append({
+                    'since': watermark,
+                    'until': until.isoformat(),
+                    'start': start,
+                    'end': end,
+                    'format': options['format'],
+                    'filename': os.path.join(output_dir, filename),
+                    'done': False,
+                })
+
+        return {'until': until.isoformat(), 'partitions': partitions}
+
+    def run_partitions(self, partitions, processes):
+        if processes <= 1 or len(partitions) <= 1:
+            for partition in partitions:
+                yield export_partition(partition)
+            return
+
+        # forked workers mustn't share the parent's database connections
+        connections.close_all()
+        # fork where possible, so workers inherit django's setup and
+        # settings. Elsewhere, i.e. on Windows, workers start afresh and need
+        # django set up before they can import models
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        with context.Pool(min(processes, len(partitions)),
+                          initializer=django.setup) as pool:
+            for result in pool.imap_unordered(export_partition, partitions):
+                yield result
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        # write then rename, so a crash can't leave a corrupt state file
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
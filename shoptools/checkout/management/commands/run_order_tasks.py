@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from shoptools.checkout.tasks import run_due_tasks
+
+
+class Command(BaseCommand):
+    help = 'Run due order tasks, i.e. retries of failed emails. Run this ' \
+           'regularly, i.e. every minute via cron.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Maximum number of tasks to run')
+
+    def handle(self, **options):
+        succeeded, failed = run_due_tasks(limit=options['limit'])
+        if options['verbosity'] > 1:
+            self.stdout.write('%s tasks succeeded, %s failed' % (
+                succeeded, failed))
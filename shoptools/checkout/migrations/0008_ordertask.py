@@ -0,0 +1,33 @@
+# Generated by Django 2.1.15 on 2026-10-18 02:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0007_auto_20180808_0200'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('key', models.CharField(max_length=191, unique=True)),
+                ('data', models.TextField(blank=True, default='')),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (2, 'Running'), (3, 'Done'), (4, 'Failed')], default=1)),
+                ('status_updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('error_message', models.TextField(blank=True, default='')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='checkout.Order')),
+            ],
+            options={
+                'ordering': ('run_after', 'id'),
+            },
+        ),
+    ]
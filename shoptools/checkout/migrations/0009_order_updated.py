@@ -0,0 +1,18 @@
+# Generated by Django 2.1.15 on 2026-10-18 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0008_ordertask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
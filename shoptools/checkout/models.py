@@ -1,6 +1,7 @@
 import decimal
+import json
 
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 try:
     from django.urls import reverse
@@ -9,13 +10,13 @@ except ImportError:
 
 from shoptools import settings as shoptools_settings
 from shoptools.abstractions.models import \
-    AbstractOrderLine, AbstractOrder, AbstractAddress
-from shoptools.util import make_uuid, get_shipping_module
+    AbstractOrderLine, AbstractOrder, AbstractAddress, price_lines
+from shoptools.util import \
+    make_uuid, get_shipping_module, get_reservations_module
 
-from .emails import send_email_receipt, send_dispatch_email
 from .signals import \
-    checkout_post_payment_pre_success, checkout_post_payment_post_success, \
-    checkout_post_payment_pre_failure, checkout_post_payment_post_failure
+    checkout_post_payment_pre_success, checkout_post_payment_pre_failure, \
+    checkout_post_payment_post_failure
 
 
 class Order(AbstractOrder):
@@ -47,6 +48,8 @@ class Order(AbstractOrder):
         default=shoptools_settings.DEFAULT_CURRENCY_SYMBOL)
 
     created = models.DateTimeField(default=timezone.now)
+    # bulk updates must set this explicitly, see util.mark_shipped
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     checkout_completed = models.DateTimeField(blank=True, null=True)
     status = models.PositiveSmallIntegerField(
         choices=STATUS_CHOICES, default=STATUS_NEW)
@@ -68,14 +71,19 @@ class Order(AbstractOrder):
     dispatched = models.DateTimeField(null=True, editable=False)
     success_page_viewed = models.BooleanField(default=False, editable=False)
 
+    @transaction.atomic
     def save(self, *args, **kwargs):
         super(Order, self).save(*args, **kwargs)
         if self.status == self.STATUS_SHIPPED and not self.dispatched:
-            # Only send the email if the update actually does something,
-            # to guard against race conditions
+            # Only queue the email if the update actually does something,
+            # to guard against race conditions. It's sent once the
+            # transaction commits.
+            now = timezone.now()
             if Order.objects.filter(pk=self.pk, dispatched__isnull=True) \
-                            .update(dispatched=timezone.now()):
-                send_dispatch_email(self)
+                            .update(dispatched=now, updated=now):
+                self.dispatched = now
+                from .tasks import enqueue
+                enqueue(self, 'dispatch_email')
 
     def set_request(self, request):
         self.request = request
@@ -87,6 +95,7 @@ class Order(AbstractOrder):
         if shipping_module:
             self._shipping_cost = shipping_module.calculate(self)
         self.save()
+        self.changed()
 
     def get_shipping_option(self):
         return self._shipping_option
@@ -94,10 +103,22 @@ class Order(AbstractOrder):
     def get_currency(self):
         return (self.currency_code, self.currency_symbol)
 
-    @property
-    def shipping_cost(self):
+    def calculate_shipping_cost(self):
         return self._shipping_cost
 
+    def calculate_subtotal(self):
+        # line totals are saved with each line, so sum them in the db, or in
+        # python if the lines have been prefetched
+        if not self.pk:
+            return decimal.Decimal(0)
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'lines' in prefetched:
+            return sum((line._total for line in prefetched['lines']),
+                       decimal.Decimal(0))
+        subtotal = self.lines.aggregate(
+            subtotal=models.Sum('_total'))['subtotal']
+        return subtotal or decimal.Decimal(0)
+
     @property
     def name(self):
         return self.billing_address.name
@@ -124,11 +145,6 @@ class Order(AbstractOrder):
     def __str__(self):
         return 'Order #%s' % (self.pk)
 
-    @property
-    def total(self):
-        return self.subtotal + decimal.Decimal(self.shipping_cost) \
-            - self.total_discount
-
     def get_line_cls(self):
         return OrderLine
 
@@ -137,6 +153,13 @@ class Order(AbstractOrder):
             'address_type': address_type,
             'order': self,
         }
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'addresses' in prefetched:
+            for address in prefetched['addresses']:
+                if address.address_type == address_type:
+                    return address
+            return Address(**params) if create else None
+
         try:
             return Address.objects.get(**params)
         except Address.DoesNotExist:
@@ -194,15 +217,14 @@ class Order(AbstractOrder):
             self.save()
 
         if complete:
-            send_email_receipt(self)
-
-            for line in self.get_lines():
-                item = line.item
-                if hasattr(item, 'purchase'):
-                    item.purchase(line)
+            reservations_module = get_reservations_module()
+            if reservations_module:
+                reservations_module.commit(self)
 
-        checkout_post_payment_post_success.send(
-            sender=Order, transaction=transaction, **kwargs)
+        # emails, purchase hooks and the post success signal run after the
+        # current transaction commits, outside the payment response
+        from .tasks import payment_succeeded
+        payment_succeeded(self, complete, transaction, **kwargs)
 
     def transaction_failed(self, transaction=None, interactive=None,
                            status_updated=None):
@@ -213,6 +235,10 @@ class Order(AbstractOrder):
         self.status = self.STATUS_PAYMENT_FAILED
         self.save()
 
+        reservations_module = get_reservations_module()
+        if reservations_module:
+            reservations_module.release(self)
+
         checkout_post_payment_post_failure.send(
             sender=Order, transaction=transaction, interactive=interactive,
             status_updated=status_updated)
@@ -240,11 +266,16 @@ class OrderLine(AbstractOrderLine):
         self._description = val
     description = property(lambda s: s._description, set_description)
 
+    @classmethod
+    def prepare_lines(cls, lines):
+        # save the total and description as at the time of purchase
+        for line, total in zip(lines, price_lines(lines)):
+            line.total = total
+            line.description = line.item.cart_description()
+
     def save(self, *args, **kwargs):
         if self.pk is None:
-            self.total = self.item.cart_line_total(self)
-
-            self.description = self.item.cart_description()
+            self.prepare_lines([self])
 
         return super(OrderLine, self).save(*args, **kwargs)
 
@@ -276,3 +307,46 @@ class Address(AbstractAddress):
     def __str__(self):
         return '%s address for %s' % (
             self.get_address_type_display(), self.order)
+
+
+class OrderTask(models.Model):
+    """A side effect of an order changing state, i.e. sending the receipt
+       email, which runs after the current transaction commits. The key is
+       unique, so a task is only ever queued (and run) once. See
+       checkout.tasks. """
+
+    STATUS_PENDING = 1
+    STATUS_RUNNING = 2
+    STATUS_DONE = 3
+    STATUS_FAILED = 4
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE,
+                              related_name='tasks')
+    name = models.CharField(max_length=100)
+    key = models.CharField(max_length=191, unique=True)
+    data = models.TextField(default='', blank=True)
+    status = models.PositiveSmallIntegerField(default=STATUS_PENDING,
+                                              choices=STATUS_CHOICES)
+    status_updated = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now, db_index=True)
+    error_message = models.TextField(default='', blank=True)
+
+    class Meta:
+        ordering = ('run_after', 'id')
+
+    def __str__(self):
+        return '%s for %s' % (self.name, self.order)
+
+    def get_data(self):
+        return json.loads(self.data) if self.data else {}
+
+    def set_data(self, data):
+        self.data = json.dumps(data) if data else ''
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""Side effects of an order changing state - emails, item purchase hooks and
+   signals - are queued as OrderTask records and run once the current
+   database transaction commits, so they don't hold up the response or run
+   for a transaction which is rolled back.
+
+   SHOPTOOLS_CHECKOUT_TASK_RUNNER controls how tasks run after commit:
+
+   - 'thread' (the default) runs them in a background thread pool
+   - 'sync' runs them immediately after commit, in the current thread
+   - 'worker' leaves them for the run_order_tasks management command
+
+   Failed tasks are retried with exponential backoff by run_order_tasks, so
+   run it regularly whichever runner is used.
+"""
+
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core import mail
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from shoptools import settings as shoptools_settings
+from shoptools.util import create_instance_key, unpack_instance_key, \
+    make_uuid
+
+from .emails import send_email_receipt, send_manager_notification, \
+    send_dispatch_email, get_manager_emails
+from .models import Order, OrderTask
+from .signals import checkout_post_payment_post_success
+
+
+TASKS = {}
+
+# tasks per batch, for bulk inserts and mail connections
+BATCH_SIZE = 100
+
+_executor = None
+
+
+def register(name, mail=False):
+    """Register a task function, which will be called with the order and the
+       task's data as keyword arguments. Tasks which send email should pass
+       mail=True, and accept a connection keyword argument - when tasks are
+       run in batches, a single mail connection is shared between them. """
+
+    def decorator(func):
+        func.uses_mail_connection = mail
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+def enqueue(order, name, key=None, **data):
+    """Queue a task for the order, to run after the current transaction
+       commits. key identifies the task within the order and defaults to the
+       task name - if a task with the same key has already been queued,
+       this does nothing. Data must be json-serializable. Returns True if the
+       task was queued. """
+
+    task = OrderTask(order=order, name=name,
+                     key='%s:%s' % (order.pk, key or name))
+    task.set_data(data)
+    if not save_task(task):
+        return False
+
+    transaction.on_commit(lambda: dispatch(task.pk))
+    return True
+
+
+def record(order, name, key=None):
+    """Record a task which is run in process instead of being queued, i.e.
+       because its arguments can't be stored, so that it still only runs
+       once per key. Returns True if it hasn't already been recorded, in
+       which case the caller should run it. """
+
+    now = timezone.now()
+    task = OrderTask(order=order, name=name,
+                     key='%s:%s' % (order.pk, key or name),
+                     status=OrderTask.STATUS_DONE, status_updated=now,
+                     attempts=1)
+    return save_task(task)
+
+
+def save_task(task):
+    try:
+        with transaction.atomic():
+            task.save()
+    except IntegrityError:
+        return False
+    return True
+
+
+def enqueue_many(order_ids, name, key=None, **data):
+    """Queue a task for many orders at once, with a bulk insert. Orders which
+       already have a task with the same key are skipped. Unlike enqueue, the
+       tasks are left for run_order_tasks, which sends batches of emails over
+       one connection. Returns the number of tasks queued. """
+
+    keys = {pk: '%s:%s' % (pk, key or name) for pk in order_ids}
+    existing = set()
+    key_list = list(keys.values())
+    for i in range(0, len(key_list), BATCH_SIZE):
+        existing.update(OrderTask.objects.order_by().filter(
+            key__in=key_list[i:i + BATCH_SIZE]).values_list('key', flat=True))
+
+    tasks = []
+    for pk, task_key in keys.items():
+        if task_key not in existing:
+            task = OrderTask(order_id=pk, name=name, key=task_key)
+            task.set_data(data)
+            tasks.append(task)
+
+    OrderTask.objects.bulk_create(tasks, batch_size=BATCH_SIZE)
+    return len(tasks)
+
+
+def dispatch(pk):
+    runner = shoptools_settings.CHECKOUT_TASK_RUNNER
+    if runner == 'sync':
+        run_task(pk)
+    elif runner == 'thread':
+        get_executor().submit(run_task_in_thread, pk)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            shoptools_settings.CHECKOUT_TASK_THREADS)
+    return _executor
+
+
+def run_task_in_thread(pk):
+    try:
+        run_task(pk)
+    finally:
+        # each thread has its own connection, which django won't close
+        connection.close()
+
+
+def run_task(pk, mail_connection=None):
+    """Run a pending task, if it's due. The task is claimed with a
+       conditional update first, so it can't be run twice concurrently.
+       Returns True if the task succeeded. """
+
+    now = timezone.now()
+    claimed = OrderTask.objects \
+        .filter(pk=pk, status=OrderTask.STATUS_PENDING, run_after__lte=now) \
+        .update(status=OrderTask.STATUS_RUNNING, status_updated=now,
+                attempts=F('attempts') + 1)
+    if not claimed:
+        return False
+
+    task = OrderTask.objects.select_related('order').get(pk=pk)
+    func = TASKS.get(task.name)
+    kwargs = task.get_data()
+    if mail_connection and getattr(func, 'uses_mail_connection', False):
+        kwargs['connection'] = mail_connection
+    try:
+        func(task.order, **kwargs)
+    except Exception:
+        log = logging.getLogger('shoptools')
+        log.error('Order task failed', extra={
+            'traceback': traceback.format_exc()
+        })
+        task.error_message = traceback.format_exc()
+        if task.attempts >= shoptools_settings.CHECKOUT_TASK_MAX_ATTEMPTS:
+            task.status = OrderTask.STATUS_FAILED
+        else:
+            task.status = OrderTask.STATUS_PENDING
+            task.run_after = timezone.now() + timedelta(
+                seconds=shoptools_settings.CHECKOUT_TASK_RETRY_DELAY *
+                2 ** (task.attempts - 1))
+    else:
+        task.status = OrderTask.STATUS_DONE
+        task.error_message = ''
+
+    task.status_updated = timezone.now()
+    task.save()
+    return task.status == OrderTask.STATUS_DONE
+
+
+def run_due_tasks(limit=None, batch_size=BATCH_SIZE):
+    """Run all due tasks, i.e. retries and tasks left for a worker. Tasks are
+       run in batches, each of which shares one mail connection. Tasks
+       which have been running for longer than
+       SHOPTOOLS_CHECKOUT_TASK_TIMEOUT are assumed to have died with their
+       process, and are run again. Returns a tuple of (succeeded, failed)
+       counts. """
+
+    now = timezone.now()
+    stale = now - timedelta(seconds=shoptools_settings.CHECKOUT_TASK_TIMEOUT)
+    OrderTask.objects \
+        .filter(status=OrderTask.STATUS_RUNNING, status_updated__lt=stale) \
+        .update(status=OrderTask.STATUS_PENDING)
+
+    due = OrderTask.objects \
+        .filter(status=OrderTask.STATUS_PENDING, run_after__lte=now) \
+        .values_list('pk', flat=True)
+    if limit:
+        due = due[:limit]
+
+    due = list(due)
+    succeeded = failed = 0
+    for i in range(0, len(due), batch_size):
+        with mail.get_connection() as mail_connection:
+            for pk in due[i:i + batch_size]:
+                if run_task(pk, mail_connection):
+                    succeeded += 1
+                else:
+                    failed += 1
+    return succeeded, failed
+
+
+def payment_succeeded(order, complete, payment=None, **kwargs):
+    """Queue the side effects of a successful payment for the order. payment
+       is the payment module's transaction, if any. """
+
+    if complete:
+        # separate tasks, so a failure sending one isn't retried by
+        # sending the other again
+        enqueue(order, 'receipt')
+        if get_manager_emails():
+            enqueue(order, 'notification')
+        for line in order.get_lines():
+            enqueue(order, 'purchase', key='purchase:%s' % line.pk,
+                    line_id=line.pk)
+
+    if hasattr(payment, '_meta'):
+        payment_key = create_instance_key(payment)
+        enqueue(order, 'post_payment_success',
+                key='post_payment_success:%s:%s' % payment_key,
+                transaction=payment_key, kwargs=kwargs)
+        return
+
+    # the signal is sent once per payment, so it can only be deduplicated
+    # if the payment has an id - otherwise, every call sends it
+    payment_id = getattr(payment, 'pk', None) or \
+        getattr(payment, 'id', None) or make_uuid().hex
+    key = 'post_payment_success:%s' % payment_id
+    if payment is None:
+        enqueue(order, 'post_payment_success', key=key, kwargs=kwargs)
+    elif record(order, 'post_payment_success', key=key):
+        # the payment module's transaction isn't a model instance, so can't
+        # be stored with a task - send the signal with the original object
+        # once the current transaction commits
+        transaction.on_commit(
+            lambda: send_post_payment_success(payment, kwargs))
+
+
+def send_post_payment_success(payment, kwargs):
+    try:
+        checkout_post_payment_post_success.send(
+            sender=Order, transaction=payment, **kwargs)
+    except Exception:
+        log = logging.getLogger('shoptools')
+        log.error('Post payment success signal failed', extra={
+            'traceback': traceback.format_exc()
+        })
+
+
+@register('receipt', mail=True)
+def receipt_task(order, connection=None):
+    # failures raise, so the task is retried
+    send_email_receipt(order, connection=connection, fail_silently=False,
+                       notify_managers=False)
+
+
+@register('notification', mail=True)
+def notification_task(order, connection=None):
+    send_manager_notification(order, connection=connection,
+                              fail_silently=False)
+
+
+@register('dispatch_email', mail=True)
+def dispatch_email_task(order, connection=None):
+    send_dispatch_email(order, connection=connection, fail_silently=False)
+
+
+@register('purchase')
+def purchase_task(order, line_id):
+    line = order.lines.get(pk=line_id)
+    item = line.item
+    if hasattr(item, 'purchase'):
+        item.purchase(line)
+
+
+@register('post_payment_success')
+def post_payment_success_task(order, transaction=None, kwargs={}):
+    checkout_post_payment_post_success.send(
+        sender=Order,
+        transaction=unpack_instance_key(*transaction) if transaction
+        else None,
+        **kwargs)
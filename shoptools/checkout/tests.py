@@ -1,9 +1,480 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from smtplib import SMTPException
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from shoptools import settings as shoptools_settings
+from shoptools.abstractions.models import validate_lines
+from shoptools.cart.session import SessionCart
+from shoptools.contrib.catalogue.models import Product
+from shoptools.contrib.regions import cache as regions_cache
+from shoptools.contrib.reservations import util as reservations
+from shoptools.contrib.reservations.models import Stock, Reservation
+
+from . import emails, tasks
+from .export import stream_csv
+from .models import Order, OrderTask, Address
+from .signals import checkout_post_payment_post_success
+from .util import mark_shipped
+
+
+def make_products(count):
+    return [Product.objects.create(name='Product %s' % i, price=10,
+                                   shipping_cost=0)
+            for i in range(count)]
 
 
 class CheckoutTestCase(TestCase):
     def setUp(self):
+        regions_cache.clear_all()
         pass
 
     def test_sample(self):
         self.assertEqual(1, 1)
+
+
+class OrderTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        self.products = make_products(5)
+        self.order = Order.objects.create()
+
+    def test_aggregates(self):
+        self.assertTrue(self.order.empty())
+        for product in self.products:
+            self.order.add(product, 2)
+
+        order = Order.objects.get(pk=self.order.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(order.count_unvalidated(), 10)
+        with self.assertNumQueries(1):
+            self.assertEqual(order.subtotal, 100)
+
+        self.assertTrue(Order().empty())
+        self.assertEqual(Order().count(), 0)
+        self.assertEqual(Order().count_unvalidated(), 0)
+
+        # count and empty only include lines whose item still exists, so an
+        # order of deleted items isn't valid
+        for product in self.products:
+            product.delete()
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.count_unvalidated(), 10)
+        self.assertEqual(order.count(), 0)
+        self.assertTrue(order.empty())
+        self.assertFalse(order.is_valid)
+
+    def test_get_lines_queries(self):
+        for product in self.products:
+            self.order.add(product)
+
+        ContentType.objects.get_for_model(Product)
+        order = Order.objects.get(pk=self.order.pk)
+        with self.assertNumQueries(2):
+            for line in order.get_lines():
+                line.item
+            order.get_lines()
+
+        order.remove(self.products[0])
+        self.assertEqual(len(order.get_lines()), 4)
+
+        # deleted items are dropped without a query each
+        self.products[1].delete()
+        self.products[2].delete()
+        order = Order.objects.get(pk=self.order.pk)
+        with self.assertNumQueries(2):
+            lines = order.get_lines()
+            validate_lines(lines)
+            self.assertEqual([line.item for line in lines],
+                             self.products[3:])
+
+    def test_save_to(self):
+        def save_cart(products):
+            request = RequestFactory().get('/')
+            request.session = SessionStore()
+            cart = SessionCart(request)
+            for product in products:
+                cart.add(product, 3)
+
+            order = Order.objects.create()
+            order.add(self.products[0])
+            for model in (Product, Order):
+                ContentType.objects.get_by_natural_key(
+                    model._meta.app_label, model._meta.model_name)
+            with CaptureQueriesContext(connection) as queries:
+                cart.save_to(order)
+            return order, len(queries)
+
+        # load the region data and shipping rates first
+        save_cart(self.products[:1])
+        order, small_queries = save_cart(self.products[:2])
+        order, large_queries = save_cart(self.products)
+        self.assertEqual(small_queries, large_queries)
+
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.count(), 15)
+        self.assertEqual(order.subtotal, 150)
+        self.assertEqual([line.description for line in order.get_lines()],
+                         [product.name for product in self.products])
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        self.products = make_products(3)
+
+    def make_orders(self, count):
+        for i in range(count):
+            order = Order.objects.create()
+            Address.objects.create(order=order, first_name='Test',
+                                   email='test@example.com')
+            for product in self.products:
+                order.add(product, 2)
+
+    def export(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(csv.reader(stream_csv(Order.objects.all())))
+        return rows, len(queries)
+
+    def test_stream_csv(self):
+        self.make_orders(2)
+        ContentType.objects.get_for_model(Order)
+        rows, small_queries = self.export()
+
+        self.make_orders(10)
+        rows, large_queries = self.export()
+        self.assertEqual(small_queries, large_queries)
+
+        self.assertEqual(len(rows), 13)
+        header, row = rows[:2]
+        row = dict(zip(header, row))
+        self.assertEqual(row['Billing Email'], 'test@example.com')
+        self.assertEqual(row['Subtotal'], '60.00')
+        self.assertEqual(row['Item Total (3)'], '20.00')
+
+    def test_empty(self):
+        rows, queries = self.export()
+        self.assertEqual(len(rows), 1)
+
+
+class IncrementalExportTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.orders = [Order.objects.create() for i in range(5)]
+
+    def export(self, **options):
+        options.setdefault('processes', 1)
+        options.setdefault('partition_size', 2)
+        call_command('export_orders', self.output_dir, lag=0, **options)
+        return sorted(f for f in os.listdir(self.output_dir)
+                      if f.endswith('.gz'))
+
+    def read(self, filename):
+        with gzip.open(os.path.join(self.output_dir, filename), 'rt') as f:
+            return [json.loads(line) for line in f]
+
+    def test_incremental(self):
+        files = self.export(format='jsonl')
+        self.assertEqual(len(files), 3)
+        self.assertEqual(sum(len(self.read(f)) for f in files), 5)
+
+        # nothing has changed
+        self.assertEqual(self.export(format='jsonl'), files)
+
+        self.orders[2].delivery_notes = 'Leave at the door'
+        self.orders[2].save()
+        new_files = sorted(set(self.export(format='jsonl')) - set(files))
+        self.assertEqual(len(new_files), 1)
+        records = self.read(new_files[0])
+        self.assertEqual([r['Invoice Number'] for r in records],
+                         [self.orders[2].invoice_number])
+
+    def test_partition_size(self):
+        with self.assertRaises(CommandError):
+            self.export(partition_size=0)
+
+    def test_resume(self):
+        from shoptools.checkout.management.commands import export_orders
+
+        written = []
+
+        def fail_after_first(partition):
+            if written:
+                raise RuntimeError
+            written.append(partition['filename'])
+            return real_export(partition)
+
+        real_export = export_orders.export_partition
+        with mock.patch.object(export_orders, 'export_partition',
+                               fail_after_first):
+            with self.assertRaises(RuntimeError):
+                self.export()
+        self.assertEqual(len(self.export()), 3)
+
+        with open(os.path.join(self.output_dir, 'export-state.json')) as f:
+            state = json.load(f)
+        self.assertIsNone(state['run'])
+        self.assertTrue(state['watermark'])
+
+
+class ReservationTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        self.product = make_products(1)[0]
+        self.stock = Stock.objects.create(item=self.product, available=5)
+
+    def make_order(self, quantity):
+        order = Order.objects.create()
+        order.add(self.product, quantity)
+        return order
+
+    def available(self):
+        self.stock.refresh_from_db()
+        return self.stock.available
+
+    def test_reserve(self):
+        order = self.make_order(3)
+        self.assertEqual(reservations.reserve(order), [])
+        self.assertEqual(self.available(), 2)
+
+        # re-reserving replaces the existing reservation
+        self.assertEqual(reservations.reserve(order), [])
+        self.assertEqual(self.available(), 2)
+
+        # the order's own reservation doesn't count against it
+        self.assertEqual(reservations.cart_errors(order), [])
+
+        other = self.make_order(3)
+        self.assertEqual(len(reservations.cart_errors(other)), 1)
+        self.assertEqual(len(reservations.reserve(other)), 1)
+        self.assertEqual(self.available(), 2)
+        self.assertFalse(other.reservations.exists())
+
+    def test_failed_payment(self):
+        order = self.make_order(3)
+        reservations.reserve(order)
+        order.transaction_failed()
+        self.assertEqual(self.available(), 5)
+        self.assertEqual(reservations.release(order), 0)
+
+    def test_successful_payment(self):
+        order = self.make_order(3)
+        reservations.reserve(order)
+        reservations.commit(order)
+        self.assertEqual(self.available(), 2)
+        self.assertEqual(order.reservations.get().status,
+                         Reservation.STATUS_COMMITTED)
+        self.assertEqual(reservations.release_expired(
+            timezone.now() + timedelta(days=1)), 0)
+
+    def test_expiry(self):
+        order = self.make_order(3)
+        reservations.reserve(order)
+        later = timezone.now() + timedelta(days=1)
+        self.assertEqual(reservations.release_expired(later), 1)
+        self.assertEqual(reservations.release_expired(later), 0)
+        self.assertEqual(self.available(), 5)
+
+        # stock is taken again if the order is paid for after expiry
+        reservations.commit(order)
+        self.assertEqual(self.available(), 2)
+        self.assertEqual(order.reservations.get().status,
+                         Reservation.STATUS_COMMITTED)
+
+
+class OrderTaskTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        self.products = make_products(2)
+        self.order = Order.objects.create()
+        for product in self.products:
+            self.order.add(product)
+        Address.objects.create(order=self.order, email='test@example.com')
+
+    @override_settings(CHECKOUT_MANAGERS=[])
+    def test_payment_succeeded(self):
+        with mock.patch.object(Product, 'purchase', create=True) as purchase, \
+                mock.patch.object(tasks, 'send_email_receipt') as receipt:
+            self.order.transaction_succeeded()
+            # nothing runs until the transaction commits
+            self.assertEqual(purchase.call_count, 0)
+            self.assertEqual(receipt.call_count, 0)
+
+            self.assertEqual(tasks.run_due_tasks(), (4, 0))
+            self.assertEqual(purchase.call_count, 2)
+            self.assertEqual(receipt.call_count, 1)
+            self.assertEqual(receipt.call_args[0], (self.order, ))
+
+            # tasks only run once
+            self.assertEqual(tasks.run_due_tasks(), (0, 0))
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.STATUS_PAID)
+
+    @override_settings(CHECKOUT_MANAGERS=[('Manager', 'shop@example.com')])
+    def test_manager_notification(self):
+        self.order.transaction_succeeded()
+        self.assertEqual(
+            set(self.order.tasks.values_list('name', flat=True)),
+            {'receipt', 'notification', 'purchase', 'post_payment_success'})
+
+        # the receipt and notification are retried independently
+        def send_email(email_type, *args, **kwargs):
+            if email_type == 'notification':
+                raise SMTPException
+            sent.append(email_type)
+
+        sent = []
+        with mock.patch.object(emails.email_module, 'send_email',
+                               side_effect=send_email):
+            self.assertEqual(tasks.run_due_tasks(), (4, 1))
+            OrderTask.objects.update(run_after=timezone.now())
+            self.assertEqual(tasks.run_due_tasks(), (0, 1))
+        self.assertEqual(sent, ['receipt'])
+
+    @override_settings(CHECKOUT_MANAGERS=[])
+    def test_payment_object(self):
+        # payment modules' transactions needn't be model instances, e.g.
+        # examples/basic/payment_stub.py
+        payment = SimpleNamespace(id='txn-1', amount=self.order.total)
+        received = []
+
+        def receiver(sender, transaction, **kwargs):
+            received.append(transaction)
+
+        checkout_post_payment_post_success.connect(receiver)
+        self.addCleanup(checkout_post_payment_post_success.disconnect,
+                        receiver)
+
+        callbacks = []
+        with mock.patch.object(tasks.transaction, 'on_commit',
+                               side_effect=callbacks.append), \
+                mock.patch.object(shoptools_settings,
+                                  'CHECKOUT_TASK_RUNNER', 'worker'), \
+                mock.patch.object(tasks, 'send_email_receipt'):
+            self.order.transaction_succeeded(payment)
+            tasks.payment_succeeded(self.order, False, payment)
+            self.assertEqual(tasks.run_due_tasks(), (3, 0))
+            self.assertEqual(received, [])
+
+            # the signal is sent once per payment, on commit, with the
+            # original object
+            for callback in callbacks:
+                callback()
+            self.assertEqual(received, [payment])
+
+            # a further partial payment, and payments without an id, are
+            # each sent
+            other = SimpleNamespace(id='txn-2', amount=1)
+            anonymous = SimpleNamespace(amount=1)
+            del callbacks[:]
+            tasks.payment_succeeded(self.order, False, other)
+            tasks.payment_succeeded(self.order, False, anonymous)
+            tasks.payment_succeeded(self.order, False, anonymous)
+            for callback in callbacks:
+                callback()
+        self.assertEqual(received, [payment, other, anonymous, anonymous])
+
+    def test_no_payment(self):
+        # without a payment object, each call queues the signal
+        with mock.patch.object(tasks, 'send_email_receipt'):
+            self.order.transaction_succeeded()
+            tasks.payment_succeeded(self.order, False)
+        self.assertEqual(self.order.tasks.filter(
+            name='post_payment_success').count(), 2)
+
+    def test_idempotency(self):
+        self.assertTrue(tasks.enqueue(self.order, 'receipt'))
+        self.assertFalse(tasks.enqueue(self.order, 'receipt'))
+        self.assertEqual(self.order.tasks.count(), 1)
+
+    def test_dispatch(self):
+        orders = [Order.objects.create(status=Order.STATUS_PAID)
+                  for i in range(5)]
+        Order.objects.create(status=Order.STATUS_NEW)
+
+        # savepoint, select, update, check existing tasks, insert, release
+        with self.assertNumQueries(6):
+            self.assertEqual(mark_shipped(Order.objects.all()), 5)
+        self.assertEqual(mark_shipped(Order.objects.all()), 0)
+        self.assertEqual(
+            Order.objects.filter(status=Order.STATUS_SHIPPED).count(), 5)
+
+        # i.e. the admin changelist, after searching
+        paid = Order.objects.create(status=Order.STATUS_PAID)
+        for product in self.products:
+            paid.add(product)
+        self.assertEqual(mark_shipped(Order.objects.filter(
+            lines__quantity=1).distinct()), 1)
+        orders.append(paid)
+
+        # saving a shipped order queues its email, once
+        self.order.status = Order.STATUS_SHIPPED
+        self.order.save()
+        self.order.save()
+
+        with mock.patch.object(tasks, 'send_dispatch_email') as send:
+            self.assertEqual(tasks.run_due_tasks(batch_size=4), (7, 0))
+
+        self.assertEqual(set(c[0][0] for c in send.call_args_list),
+                         set(orders + [self.order]))
+        # one mail connection per batch
+        connections = [c[1]['connection'] for c in send.call_args_list]
+        self.assertEqual(len(set(connections)), 2)
+
+    def test_email_failure(self):
+        # emails sent by tasks fail loudly, so they're retried
+        tasks.enqueue(self.order, 'receipt')
+        task = self.order.tasks.get()
+        with mock.patch.object(emails.email_module, 'send_email',
+                               side_effect=SMTPException) as send:
+            self.assertEqual(tasks.run_due_tasks(), (0, 1))
+        self.assertFalse(send.call_args[1]['fail_silently'])
+
+        OrderTask.objects.update(run_after=timezone.now())
+        with mock.patch.object(emails.email_module, 'send_email',
+                               return_value=False):
+            self.assertEqual(tasks.run_due_tasks(), (0, 1))
+        task.refresh_from_db()
+        self.assertEqual(task.status, OrderTask.STATUS_PENDING)
+        self.assertEqual(task.attempts, 2)
+        self.assertIn('EmailFailed', task.error_message)
+
+    def test_retry(self):
+        calls = []
+
+        @tasks.register('test_failure')
+        def fail(order):
+            calls.append(order)
+            raise ValueError
+
+        tasks.enqueue(self.order, 'test_failure')
+        task = self.order.tasks.get()
+        for attempt in range(1, 6):
+            self.assertEqual(tasks.run_due_tasks(), (0, 1))
+            task.refresh_from_db()
+            self.assertEqual(task.attempts, attempt)
+
+            # not retried until the delay has passed
+            self.assertEqual(tasks.run_due_tasks(), (0, 0))
+            OrderTask.objects.update(run_after=timezone.now())
+
+        self.assertEqual(task.status, OrderTask.STATUS_FAILED)
+        self.assertEqual(len(calls), 5)
+        self.assertIn('ValueError', task.error_message)
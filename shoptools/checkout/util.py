@@ -1,9 +1,14 @@
+from django.db import transaction
 from django.template.loader import render_to_string
+from django.utils import timezone
 
 from shoptools.util import \
     get_regions_module, get_shipping_module, get_vouchers_module
 from shoptools.cart.util import get_cart
 
+from .models import Order
+from .tasks import enqueue_many
+
 
 def get_html_snippet(request, cart=None, errors=[]):
     """
@@ -44,3 +49,26 @@ def get_html_snippet(request, cart=None, errors=[]):
 
     return render_to_string('checkout/snippets/html_snippet.html', ctx,
                             request=request)
+
+
+@transaction.atomic
+def mark_shipped(queryset):
+    """Mark the paid orders in queryset as shipped with a single UPDATE, and
+       queue their dispatch emails in the same transaction, for the
+       run_order_tasks command to send. Returns the number of orders
+       updated. """
+
+    # lock through a pk subquery, since the admin's queryset may be
+    # distinct() from searching or filtering, which can't be locked
+    pks = list(Order.objects
+               .filter(pk__in=queryset.order_by().values('pk'),
+                       status=Order.STATUS_PAID, dispatched__isnull=True)
+               .select_for_update().values_list('pk', flat=True))
+    if not pks:
+        return 0
+
+    now = timezone.now()
+    Order.objects.filter(pk__in=pks).update(status=Order.STATUS_SHIPPED,
+                                            dispatched=now, updated=now)
+    enqueue_many(pks, 'dispatch_email')
+    return len(pks)
@@ -14,7 +14,8 @@ from django.contrib.admin.views.decorators import staff_member_required
 from shoptools.cart import get_cart
 from shoptools.util import \
     get_accounts_module, get_shipping_module, get_regions_module, \
-    get_vouchers_module, get_payment_module, get_email_module
+    get_vouchers_module, get_payment_module, get_email_module, \
+    get_reservations_module
 
 from .forms import OrderForm, OrderMetaForm, CheckoutUserForm, AddressForm
 from .models import Order, Address
@@ -265,6 +266,13 @@ def checkout(request, cart, order=None):
             # save any cart lines to the order, overwriting any existing lines
             cart.save_to(order)
 
+            # claim stock for the order until it's paid for. If something
+            # has sold out since the cart was validated, the cart view will
+            # show what's unavailable
+            reservations_module = get_reservations_module()
+            if reservations_module and reservations_module.reserve(order):
+                return redirect('checkout_cart')
+
             # and off we go to pay, if necessary
             payment_module = get_payment_module()
             checkout_pre_payment.send(sender=Order, request=request)
@@ -44,7 +44,7 @@ def email_content(email_type, template_dir, **context):
 
 
 def create_message(email_type, template_dir, recipients, cc=[], bcc=[],
-                   **context_dict):
+                   connection=None, **context_dict):
     reply_to = context_dict.get('reply_to',
                                 getattr(settings, 'EMAIL_REPLY_TO', []))
     if reply_to:
@@ -54,7 +54,8 @@ def create_message(email_type, template_dir, recipients, cc=[], bcc=[],
                                         **context_dict)
 
     message = EmailMultiAlternatives(subject, text, from_email, recipients,
-                                     cc=cc, bcc=bcc, reply_to=reply_to)
+                                     cc=cc, bcc=bcc, reply_to=reply_to,
+                                     connection=connection)
     if html:
         message.attach_alternative(html, 'text/html')
     return message
@@ -129,9 +130,12 @@ def create_email_record_from_message(message, email_type, related_obj=None):
 
 
 def send_email(email_type, template_dir, recipients, related_obj=None, cc=[],
-               bcc=[], fail_silently=False, **context_dict):
+               bcc=[], fail_silently=False, connection=None, **context_dict):
+    """Render and send an email, recording it as an Email. Pass an open mail
+       connection to reuse it when sending many emails. """
+
     message = create_message(email_type, template_dir, recipients, cc=[],
-                             bcc=[], **context_dict)
+                             bcc=[], connection=connection, **context_dict)
     email_record = create_email_record_from_message(
         message, email_type, related_obj=related_obj)
 
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""Regions, countries and currencies change rarely but are looked up many
+   times per request, so each process keeps them all in memory. Saving or
+   deleting any of them bumps a version number in the shared django cache
+   (SHOPTOOLS_REGIONS_CACHE_ALIAS), and each process reloads when it sees
+   the version change - checked at most every
+   SHOPTOOLS_REGIONS_CACHE_CHECK_INTERVAL seconds. ProcessCache is also
+   used for other region-related data, i.e. shipping rates.
+
+   The cached instances are shared between requests, so must not be
+   modified.
+"""
+
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+from shoptools import settings as shoptools_settings
+from shoptools.util import make_uuid
+
+from .models import Currency, Region, Country
+
+
+VERSION_KEY = 'shoptools-regions:version'
+
+
+def get_cache():
+    return caches[shoptools_settings.REGIONS_CACHE_ALIAS]
+
+
+class ProcessCache(object):
+    """Holds the result of calling load() for the life of the process, until
+       the version stored under version_key in the shared cache changes. """
+
+    instances = []
+
+    def __init__(self, version_key, load):
+        self.version_key = version_key
+        self.load = load
+        self.lock = threading.Lock()
+        self.data = None
+        self.version = None
+        self.checked = 0
+        ProcessCache.instances.append(self)
+
+    def get_version(self):
+        version = get_cache().get(self.version_key)
+        if version is None:
+            # i.e. evicted, or never set
+            get_cache().add(self.version_key, make_uuid().hex, None)
+            version = get_cache().get(self.version_key)
+        return version
+
+    def get(self):
+        """Return the data for this process, reloading it if another process
+           has invalidated it since it was loaded. """
+
+        now = time.monotonic()
+        data = self.data
+        interval = shoptools_settings.REGIONS_CACHE_CHECK_INTERVAL
+        if data is not None and now - self.checked < interval:
+            return data
+
+        with self.lock:
+            version = self.get_version()
+            if self.data is None or version != self.version:
+                self.data = self.load()
+                self.version = version
+            self.checked = now
+            return self.data
+
+    def clear(self):
+        """Discard this process's data, e.g. between tests. """
+
+        self.data = None
+
+    def invalidate(self):
+        """Discard the data in this process now, so it sees its own changes,
+           and in all processes once the current transaction commits, so no
+           process can reload the old data under the new version. """
+
+        def bump():
+            get_cache().set(self.version_key, make_uuid().hex, None)
+            self.clear()
+
+        self.clear()
+        transaction.on_commit(bump)
+
+
+def clear_all():
+    """Discard every ProcessCache's data in this process, e.g. between tests,
+       whose changes are rolled back without invalidating the caches. """
+
+    for process_cache in ProcessCache.instances:
+        process_cache.clear()
+
+
+class RegionData(object):
+    def __init__(self):
+        currencies = {c.pk: c for c in Currency.objects.all()}
+        self.regions = list(Region.objects.all())
+        self.by_id = {}
+        for region in self.regions:
+            region.currency = currencies[region.currency_id]
+            self.by_id[region.pk] = region
+
+        self.countries = {}
+        self.region_countries = {region.pk: [] for region in self.regions}
+        for country in Country.objects.all():
+            country.region = self.by_id[country.region_id]
+            self.countries[country.country.code] = country
+            self.region_countries[country.region_id].append(country)
+        self.region_ids = {code: country.region_id
+                           for code, country in self.countries.items()}
+
+        # as Region.get_default
+        defaults = sorted(self.regions, key=lambda r: (not r.is_default,
+                                                       r.pk))
+        self.default = defaults[0] if defaults else None
+
+
+region_data = ProcessCache(VERSION_KEY, RegionData)
+get_data = region_data.get
+clear = region_data.clear
+invalidate = region_data.invalidate
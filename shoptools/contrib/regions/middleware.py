@@ -8,7 +8,25 @@ from .util import get_cookie, get_country_code, get_region_id, COOKIE_MAX_AGE
 
 
 class RegionMiddleware(MiddlewareMixin):
+    skip_paths = tuple(shoptools_settings.REGIONS_MIDDLEWARE_SKIP_PATHS)
+
+    def __init__(self, *args, **kwargs):
+        super(RegionMiddleware, self).__init__(*args, **kwargs)
+        self.skip_prefixes = tuple(p for p in self.skip_paths
+                                   if p.endswith('/'))
+        self.skip_exact = set(p for p in self.skip_paths
+                              if not p.endswith('/'))
+
+    def skip(self, request):
+        # path_info excludes SCRIPT_NAME, so the paths are the same however
+        # the site is mounted
+        path = request.path_info
+        return path in self.skip_exact or path.startswith(self.skip_prefixes)
+
     def process_request(self, request):
+        if self.skip(request):
+            return
+
         info = get_cookie(request)
 
         updated = False
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from django.db import models
+from django.core.signals import setting_changed
+from django.db.models.signals import post_save, post_delete
 
 from django_countries.fields import CountryField
 
@@ -85,3 +87,23 @@ class Country(models.Model):
             'name': self.get_country_display(),
             'code': self.country.code,
         }
+
+
+def invalidate_cache(sender, **kwargs):
+    from .cache import invalidate
+    invalidate()
+
+
+for model in (Currency, Region, Country):
+    post_save.connect(invalidate_cache, sender=model)
+    post_delete.connect(invalidate_cache, sender=model)
+
+
+def clear_cache(setting, **kwargs):
+    # i.e. tests overriding CACHES, where the shared version is kept
+    if setting == 'CACHES' or setting.startswith('SHOPTOOLS_REGIONS_CACHE'):
+        from .cache import clear_all
+        clear_all()
+
+
+setting_changed.connect(clear_cache)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import socket
 import json
+import threading
+from functools import lru_cache
 
 try:
     from django.contrib.gis.geoip2 import GeoIP2
@@ -10,12 +12,15 @@ else:
     from geoip2.errors import AddressNotFoundError
 
 from shoptools import settings as shoptools_settings
-from .models import Region, Country
+from .cache import get_data
 from .forms import RegionSelectionForm
 
 
 COOKIE_MAX_AGE = 52*7*24*60*60  # 1 year
 
+_geoip = None
+_geoip_lock = threading.Lock()
+
 
 def get_ip(request):
     return request.GET.get('REMOTE_ADDR', request.META.get(
@@ -23,25 +28,39 @@ def get_ip(request):
 
 
 def get_region_id(country_code=None):
-    if country_code:
-        try:
-            region = Region.objects.get(countries__country=country_code)
-        except Region.DoesNotExist:
-            pass
-        else:
-            return region.id
+    data = get_data()
+    if country_code in data.region_ids:
+        return data.region_ids[country_code]
+    if data.default:
+        return data.default.id
+
 
-    region = Region.get_default()
-    if region:
-        return region.id
+def get_geoip():
+    """Return a GeoIP2 reader shared by the whole process, with the database
+       memory-mapped rather than opened and parsed for each lookup. """
+
+    global _geoip
+    if _geoip is None:
+        with _geoip_lock:
+            if _geoip is None:
+                _geoip = GeoIP2(cache=GeoIP2.MODE_MMAP)
+    return _geoip
 
 
 def get_country_code(request):
     if not GeoIP2:
         return None
+    return lookup_country_code(get_ip(request))
+
+
+@lru_cache(maxsize=shoptools_settings.GEOIP_CACHE_SIZE)
+def lookup_country_code(ip):
+    """Country code for an IP address, remembering recent addresses since
+       clients without cookies (i.e. crawlers) are looked up every
+       request. """
 
     try:
-        country = GeoIP2().country(get_ip(request))
+        country = get_geoip().country(ip)
     except (AddressNotFoundError, socket.gaierror, UnicodeError):
         # Extra long IP addresses (ie. incorrect ones) can generate a
         # UnicodeError within GeoIP in some versions of Python.
@@ -74,21 +93,18 @@ def get_int(val):
 
 
 def available_regions(request):
-    return [(r.id, r.option_text) for r in Region.objects.all()]
+    return [(r.id, r.option_text) for r in get_data().regions]
 
 
 def get_region(request):
-    """Get region instance from the session region id. """
+    """Get region instance from the session region id. The instance is
+       shared between requests (see cache.py), so mustn't be modified. """
     info = get_cookie(request)
 
     region_id = get_int(info.get('region_id'))
 
-    if region_id:
-        try:
-            return Region.objects.get(id=region_id)
-        except Region.DoesNotExist:
-            pass
-    return Region.get_default()
+    data = get_data()
+    return data.by_id.get(region_id) or data.default
 
 
 def set_region(request, response, region_id):
@@ -99,7 +115,7 @@ def set_region(request, response, region_id):
 
     info = get_cookie(request)
 
-    if region_id and Region.objects.filter(id=region_id):
+    if region_id and region_id in get_data().by_id:
         info["region_id"] = region_id
         set_cookie(request, response, info)
         return True
@@ -112,10 +128,7 @@ def get_country(request, response):
     info = get_cookie(request)
     country_code = info.get('country_code')
     if country_code:
-        try:
-            return Country.objects.get(country=country_code)
-        except Country.DoesNotExist:
-            pass
+        return get_data().countries.get(country_code)
     return None
 
 
@@ -123,7 +136,7 @@ def set_country(request, response, country_code):
     """Set region instance."""
     info = get_cookie(request)
 
-    if country_code and Country.objects.filter(country=country_code):
+    if country_code and country_code in get_data().countries:
         info["country_code"] = country_code
         set_cookie(request, response, info)
         return True
@@ -0,0 +1,19 @@
+
+def cart_errors(cart):
+    from .util import cart_errors
+    return cart_errors(cart)
+
+
+def reserve(order):
+    from .util import reserve
+    return reserve(order)
+
+
+def commit(order):
+    from .util import commit
+    return commit(order)
+
+
+def release(order):
+    from .util import release
+    return release(order)
@@ -0,0 +1,21 @@
+from django.contrib import admin
+
+from .models import Stock, Reservation
+
+
+@admin.register(Stock)
+class StockAdmin(admin.ModelAdmin):
+    list_display = ('item', 'content_type', 'available')
+    list_filter = ('content_type', )
+
+
+@admin.register(Reservation)
+class ReservationAdmin(admin.ModelAdmin):
+    list_display = ('order', 'stock', 'quantity', 'status', 'created',
+                    'expires')
+    list_filter = ('status', )
+    readonly_fields = ('order', 'stock', 'quantity', 'status', 'created',
+                       'expires')
+
+    def has_add_permission(self, request):
+        return False
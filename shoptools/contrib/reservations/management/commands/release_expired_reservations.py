@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from shoptools.contrib.reservations.util import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Return stock held by expired reservations. Run this regularly, ' \
+           'i.e. every minute via cron.'
+
+    def handle(self, **options):
+        released = release_expired()
+        if options['verbosity'] > 1:
+            self.stdout.write('Released %s reservations' % released)
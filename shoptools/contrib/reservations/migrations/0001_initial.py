@@ -0,0 +1,52 @@
+# Generated by Django 2.1.15 on 2026-10-18 02:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('checkout', '0007_auto_20180808_0200'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Held'), (2, 'Committed'), (3, 'Released'), (4, 'Expired')], default=1)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='checkout.Order')),
+            ],
+            options={
+                'ordering': ('-created', '-id'),
+            },
+        ),
+        migrations.CreateModel(
+            name='Stock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('available', models.IntegerField(default=0)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name_plural': 'stock',
+            },
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='stock',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='reservations.Stock'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stock',
+            unique_together={('content_type', 'object_id')},
+        ),
+    ]
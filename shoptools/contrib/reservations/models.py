@@ -0,0 +1,57 @@
+from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes.fields import GenericForeignKey
+
+from shoptools.checkout.models import Order
+
+
+class Stock(models.Model):
+    """Available stock for a purchasable item. Items without a Stock record
+       are unlimited. The available count is only ever changed via a single
+       conditional UPDATE, so concurrent checkouts can't oversell and the row
+       is only locked for the duration of that statement. """
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    item = GenericForeignKey('content_type', 'object_id')
+    available = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+        verbose_name_plural = 'stock'
+
+    def __str__(self):
+        return u'%s: %s available' % (self.item, self.available)
+
+
+class Reservation(models.Model):
+    # held reservations are returned to stock when they expire, unless the
+    # order is paid for first
+    STATUS_HELD = 1
+    STATUS_COMMITTED = 2
+    STATUS_RELEASED = 3
+    STATUS_EXPIRED = 4
+
+    STATUS_CHOICES = [
+        (STATUS_HELD, 'Held'),
+        (STATUS_COMMITTED, 'Committed'),
+        (STATUS_RELEASED, 'Released'),
+        (STATUS_EXPIRED, 'Expired'),
+    ]
+
+    order = models.ForeignKey(Order, related_name='reservations',
+                              on_delete=models.CASCADE)
+    stock = models.ForeignKey(Stock, related_name='reservations',
+                              on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES,
+                                              default=STATUS_HELD)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ('-created', '-id')
+
+    def __str__(self):
+        return u'%s x %s for %s' % (
+            self.quantity, self.stock.item, self.order)
@@ -0,0 +1,184 @@
+from collections import OrderedDict
+from datetime import timedelta
+from functools import reduce
+import operator
+
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from shoptools import settings as shoptools_settings
+from shoptools.checkout.models import Order
+
+from .models import Stock, Reservation
+
+
+def get_stock(lines):
+    """Return a dict of Stock records for the given cart lines, keyed by
+       (content type id, object id). Uses a single query. """
+
+    keys = set()
+    for line in lines:
+        if line.item:
+            ctype = ContentType.objects.get_for_model(line.item)
+            keys.add((ctype.id, line.item.pk))
+
+    if not keys:
+        return {}
+
+    by_ctype = {}
+    for ctype_id, pk in keys:
+        by_ctype.setdefault(ctype_id, []).append(pk)
+    query = reduce(operator.or_, (
+        Q(content_type_id=ctype_id, object_id__in=pks)
+        for ctype_id, pks in by_ctype.items()))
+
+    return {(s.content_type_id, s.object_id): s
+            for s in Stock.objects.filter(query)}
+
+
+def get_quantities(lines):
+    """Total the quantities required per Stock record, since the same item
+       may appear on several lines with different options. Ordered by Stock
+       pk, so concurrent reservations always lock rows in the same order. """
+
+    stock = get_stock(lines)
+    required = {}
+    for line in lines:
+        if not line.item:
+            continue
+        ctype = ContentType.objects.get_for_model(line.item)
+        record = stock.get((ctype.id, line.item.pk))
+        if record:
+            entry = required.setdefault(record.pk, [record, 0])
+            entry[1] += line.quantity
+
+    return OrderedDict((record, qty) for record, qty in
+                       sorted(required.values(), key=lambda e: e[0].pk))
+
+
+def held_quantities(order):
+    """Quantities currently held for an order, keyed by Stock pk. """
+
+    if not order or not order.pk:
+        return {}
+
+    qs = Reservation.objects.filter(order=order,
+                                    status=Reservation.STATUS_HELD)
+    return dict(qs.order_by().values('stock')
+                  .annotate(total=Sum('quantity'))
+                  .values_list('stock', 'total'))
+
+
+def cart_errors(cart):
+    """Check the cart against available stock, allowing for anything already
+       held for the cart's order. This is only advisory - stock is actually
+       claimed by reserve(). """
+
+    if isinstance(cart, Order):
+        order = cart
+    else:
+        order = getattr(cart, 'order_obj', None)
+
+    required = get_quantities(cart.get_lines())
+    if not required:
+        return []
+
+    held = held_quantities(order)
+    errors = []
+    for record, quantity in required.items():
+        available = record.available + held.get(record.pk, 0)
+        if quantity > available:
+            errors.append(stock_error(record, available))
+    return errors
+
+
+def stock_error(record, available):
+    if available > 0:
+        return u'Only %s of %s available' % (available, record.item)
+    return u'%s is sold out' % record.item
+
+
+@transaction.atomic
+def reserve(order):
+    """Claim stock for each line of the order, replacing any reservations
+       previously held for it. Each claim is a conditional decrement, so
+       stock can never go below zero. If anything is unavailable, nothing is
+       claimed and a list of error strings is returned. """
+
+    release(order)
+
+    required = get_quantities(order.get_lines())
+    expires = timezone.now() + \
+        timedelta(seconds=shoptools_settings.RESERVATION_TIMEOUT)
+
+    errors = []
+    reservations = []
+    for record, quantity in required.items():
+        claimed = Stock.objects \
+            .filter(pk=record.pk, available__gte=quantity) \
+            .update(available=F('available') - quantity)
+        if claimed:
+            reservations.append(Reservation(
+                order=order, stock=record, quantity=quantity,
+                expires=expires))
+        else:
+            record.refresh_from_db(fields=['available'])
+            errors.append(stock_error(record, record.available))
+
+    if errors:
+        transaction.set_rollback(True)
+        return errors
+
+    Reservation.objects.bulk_create(reservations)
+    return []
+
+
+@transaction.atomic
+def commit(order):
+    """Mark the order's reservations as committed, after payment. If any
+       expired before payment completed, their stock has already been
+       returned, so it's taken again - unconditionally, since the order has
+       been paid for. This may leave stock negative, i.e. oversold. """
+
+    # commit held reservations first, so they can't expire part way through
+    Reservation.objects.filter(order=order, status=Reservation.STATUS_HELD) \
+        .update(status=Reservation.STATUS_COMMITTED)
+
+    expired = Reservation.objects.filter(
+        order=order, status=Reservation.STATUS_EXPIRED)
+    for reservation in expired.select_for_update():
+        Stock.objects.filter(pk=reservation.stock_id) \
+            .update(available=F('available') - reservation.quantity)
+    expired.update(status=Reservation.STATUS_COMMITTED)
+
+
+def release_reservations(reservations, status=Reservation.STATUS_RELEASED):
+    """Return held stock for the given reservations. Each reservation is
+       released by a conditional update on its status, so a reservation
+       can't be released twice by concurrent requests or sweeps. Returns the
+       number released. """
+
+    released = 0
+    for reservation in reservations.filter(status=Reservation.STATUS_HELD):
+        with transaction.atomic():
+            updated = Reservation.objects \
+                .filter(pk=reservation.pk, status=Reservation.STATUS_HELD) \
+                .update(status=status)
+            if updated:
+                Stock.objects.filter(pk=reservation.stock_id) \
+                    .update(available=F('available') + reservation.quantity)
+                released += 1
+    return released
+
+
+def release(order):
+    if not order.pk:
+        return 0
+    return release_reservations(Reservation.objects.filter(order=order))
+
+
+def release_expired(now=None):
+    qs = Reservation.objects.filter(expires__lte=now or timezone.now())
+    return release_reservations(qs, status=Reservation.STATUS_EXPIRED)
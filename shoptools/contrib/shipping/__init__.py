@@ -11,6 +11,16 @@ def available_countries(cart):
     return available_countries(cart)
 
 
+def get_quote(cart):
+    from .util import get_quote
+    return get_quote(cart)
+
+
+def get_estimates(cart_value):
+    from .util import get_estimates
+    return get_estimates(cart_value)
+
+
 def available_options(cart):
     from .util import available_options
     return available_options(cart)
@@ -23,7 +33,11 @@ def get_context(request):
 
 def get_shipping_option_instance(shipping_option_id):
     from .models import ShippingOption
-    return ShippingOption.objects.get(id=shipping_option_id)
+    from .util import get_shipping_option
+    shipping_option = get_shipping_option(shipping_option_id)
+    if shipping_option is None:
+        raise ShippingOption.DoesNotExist()
+    return shipping_option
 
 
 def get_region_inlines():
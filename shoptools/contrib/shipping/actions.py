@@ -1,5 +1,5 @@
 from shoptools.cart.actions import cart_action
-from .util import available_options_qs
+from .util import get_available_options
 
 
 @cart_action(params=(
@@ -7,8 +7,7 @@ from .util import available_options_qs
 ))
 def change_option(cart, option_id):
     """Set shipping option for the given cart """
-    available_options = available_options_qs(cart)
-    if available_options.filter(id=option_id).count():
+    if option_id in [o.id for o in get_available_options(cart)]:
         cart.set_shipping_option(option_id)
         return (True, None)
     else:
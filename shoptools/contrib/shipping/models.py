@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 
 from shoptools.contrib.regions.models import Region
 
@@ -38,3 +39,13 @@ class ShippingOption(models.Model):
 
     class Meta:
         ordering = ('region__name', 'option', )
+
+
+def invalidate_rate_table(sender, **kwargs):
+    from .rates import rate_table
+    rate_table.invalidate()
+
+
+for model in (Option, ShippingOption):
+    post_save.connect(invalidate_rate_table, sender=model)
+    post_delete.connect(invalidate_rate_table, sender=model)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Every ShippingOption, compiled into an in-memory rate table per region so
+   finding the options available for a cart value is a bisect rather than a
+   query. The table is cached per process and rebuilt when any Option or
+   ShippingOption changes - see shoptools.contrib.regions.cache.
+"""
+
+from bisect import bisect_left
+
+from shoptools.contrib.regions.cache import ProcessCache
+
+from .models import ShippingOption
+
+
+class RegionRates(object):
+    """Shipping options for one region. The cart value bounds of all options
+       split the possible cart values into points (the bounds themselves)
+       and the gaps between them. The options available are worked out once
+       for each point and gap, so a lookup only has to find the right one.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.bounds = sorted(set(
+            [o.min_cart_value for o in options] +
+            [o.max_cart_value for o in options
+             if o.max_cart_value is not None]))
+
+        self.points = [self.available(b, b) for b in self.bounds]
+        # gap i is between bounds i - 1 and i, with gaps before the first
+        # and after the last
+        self.gaps = [self.available(
+            self.bounds[i - 1] if i else None,
+            self.bounds[i] if i < len(self.bounds) else None)
+            for i in range(len(self.bounds) + 1)]
+
+    def available(self, low, high):
+        """Options available for every cart value between low and high, where
+           None means unbounded. """
+
+        return tuple(
+            o for o in self.options
+            if low is not None and o.min_cart_value <= low and
+            (o.max_cart_value is None or
+             (high is not None and o.max_cart_value >= high)))
+
+    def lookup(self, value):
+        i = bisect_left(self.bounds, value)
+        if i < len(self.bounds) and self.bounds[i] == value:
+            return self.points[i]
+        return self.gaps[i]
+
+
+class RateTable(object):
+    """All regions' rates. The bounds of every region together split cart
+       values into bands (the bounds themselves and the gaps between), in
+       which the options available in every region are the same - so
+       estimates for all regions are worked out once per band, on first
+       use. """
+
+    def __init__(self):
+        options = ShippingOption.objects.select_related('option') \
+            .order_by('option__sort_order', 'option__name', 'pk')
+
+        by_region = {}
+        self.by_id = {}
+        self.by_option = {}
+        for shipping_option in options:
+            by_region.setdefault(shipping_option.region_id, []) \
+                .append(shipping_option)
+            self.by_id[shipping_option.pk] = shipping_option
+            self.by_option.setdefault(shipping_option.option_id, []) \
+                .append(shipping_option)
+
+        self.regions = {region_id: RegionRates(region_options)
+                        for region_id, region_options in by_region.items()}
+        self.bounds = sorted(set(b for rates in self.regions.values()
+                                 for b in rates.bounds))
+        # band -> estimates, filled in lazily. Adding a key is the only
+        # change made to a shared table, and is safe across threads
+        self.bands = {}
+
+    def available(self, region, cart_value):
+        """Return a tuple of the region's ShippingOptions available for the
+           cart value, in option order. """
+
+        rates = self.regions.get(region.pk if region else None)
+        return rates.lookup(cart_value) if rates else ()
+
+    def band(self, cart_value):
+        """Return the band containing cart_value, as (low, high) where None
+           means unbounded. Every cart value in the band gets the same
+           options. """
+
+        i = bisect_left(self.bounds, cart_value)
+        if i < len(self.bounds) and self.bounds[i] == cart_value:
+            return (self.bounds[i], self.bounds[i])
+        return (self.bounds[i - 1] if i else None,
+                self.bounds[i] if i < len(self.bounds) else None)
+
+    def estimates(self, cart_value):
+        """Return a dict of region id to the tuple of ShippingOptions
+           available for cart_value, for every region with options. """
+
+        band = self.band(cart_value)
+        estimates = self.bands.get(band)
+        if estimates is None:
+            estimates = {region_id: rates.lookup(cart_value)
+                         for region_id, rates in self.regions.items()}
+            self.bands[band] = estimates
+        return estimates
+
+
+rate_table = ProcessCache('shoptools-shipping:version', RateTable)
+get_rate_table = rate_table.get
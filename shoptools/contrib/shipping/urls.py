@@ -11,4 +11,5 @@ urlpatterns = [
     url(r'^_change$', views.change_option, {
         'get_html_snippet': get_html_snippet,
     }, 'shipping_change_option'),
+    url(r'^estimates$', views.estimates, name='shipping_estimates'),
 ]
@@ -5,11 +5,12 @@ product's get_shipping_cost method, and restricts shipping destination to
 countries within the current region.
 """
 
-from django.db.models import Q
-
+from shoptools.abstractions.models import ShippingQuote
+from shoptools.contrib.regions.cache import get_data
 from shoptools.contrib.regions.util import get_region
 from .models import ShippingOption
 from .forms import ShippingOptionSelectionForm
+from .rates import get_rate_table
 
 
 def available_countries(cart):
@@ -18,22 +19,23 @@ def available_countries(cart):
     """
 
     region = get_region(cart.request)
-    return [(c.country.code, c.country.name) for c in region.countries.all()]
+    countries = get_data().region_countries.get(region.pk, [])
+    return [(c.country.code, c.country.name) for c in countries]
 
 
-def available_options_qs(cart):
-    """Return available Options for this cart """
+def get_available_options(cart):
+    """Return a tuple of the ShippingOptions available for this cart, from
+       the rate table. """
 
-    region = get_region(cart.request)
+    return get_rate_table().available(get_region(cart.request),
+                                      cart.subtotal)
 
-    region_query = Q(region=region)
-    min_query = Q(min_cart_value__lte=cart.subtotal)
-    max_query = \
-        Q(max_cart_value__isnull=True) | \
-        Q(max_cart_value__gte=cart.subtotal)
+
+def available_options_qs(cart):
+    """Return available Options for this cart, as a queryset. """
 
     return ShippingOption.objects.filter(
-        region_query, min_query, max_query).distinct()
+        pk__in=[o.pk for o in get_available_options(cart)])
 
 
 def available_options(cart):
@@ -41,7 +43,13 @@ def available_options(cart):
        Choices should be of the form
        (shipping_option_id, shipping_option_id)
     """
-    return available_options_qs(cart).values_list('id', 'option__name')
+    return [(o.id, o.option.name) for o in get_available_options(cart)]
+
+
+def get_shipping_option(shipping_option_id):
+    """Return a ShippingOption from the rate table, or None. """
+
+    return get_rate_table().by_id.get(shipping_option_id)
 
 
 def calculate(cart):
@@ -50,34 +58,86 @@ def calculate(cart):
     if not hasattr(cart, 'get_shipping_option'):
         raise NotImplementedError()
     option_id = cart.get_shipping_option()
-    region = get_region(cart.request)
 
-    region_query = Q(region=region)
-    min_query = Q(min_cart_value__lte=cart.subtotal)
-    max_query = Q(max_cart_value__isnull=True) | \
-        Q(max_cart_value__gte=cart.subtotal)
+    for option in get_available_options(cart):
+        if option.id == option_id:
+            return option.cost
 
-    options = ShippingOption.objects.filter(
-        region_query, min_query, max_query, id=option_id)
-    option = options.order_by('cost').first()
+    return 0
 
-    if option:
-        return option.cost
 
-    return 0
+def get_quote(cart):
+    """Resolve the cart's shipping in one go - see ICart.shipping_quote. If
+       the cart has no option, or its option isn't available, the first
+       available option is used, preferring one with the same Option as the
+       current one, i.e. after the cart's region changes. """
+
+    options = get_available_options(cart)
+    if not options:
+        return ShippingQuote(errors=['There are no valid shipping options '
+                                     'for your current order.'])
+
+    current_id = cart.get_shipping_option()
+    option = next((o for o in options if o.id == current_id), None)
+    errors = []
+    if option is None:
+        if not current_id:
+            option = options[0]
+        else:
+            current = get_shipping_option(current_id)
+            option = next((o for o in options
+                           if current and o.option_id == current.option_id),
+                          None)
+            if option is None:
+                errors.append('Please select a shipping option.')
+
+    return ShippingQuote(
+        options=options,
+        choices=[(o.id, o.option.name) for o in options],
+        option=option,
+        option_id=option.id if option else current_id,
+        cost=option.cost if option else 0,
+        errors=errors)
+
+
+def get_estimates(cart_value):
+    """Return the shipping options and costs for every region, for a cart
+       worth cart_value, e.g. for "shipping to your country from $X" on a
+       product page. Returns a dict for json serialization, including the
+       band of cart values the same estimates apply to. Doesn't query the
+       database, once the region data and rate table are loaded. """
+
+    table = get_rate_table()
+    estimates = table.estimates(cart_value)
+    data = get_data()
+    low, high = table.band(cart_value)
+
+    regions = []
+    for region in data.regions:
+        options = estimates.get(region.pk, ())
+        regions.append(dict(region.as_dict(), **{
+            'countries': [c.country.code
+                          for c in data.region_countries[region.pk]],
+            'options': [{'id': o.id, 'name': o.option.name, 'cost': o.cost}
+                        for o in options],
+            'cost_from': min(o.cost for o in options) if options else None,
+        }))
+
+    return {
+        'cart_value': cart_value,
+        'band': {'min': low, 'max': high},
+        'regions': regions,
+    }
 
 
 def shipping_context(cart):
     """Return shipping related context for use in cart related html.
     """
-    available_shipping_options = list(available_options(cart))
-    selected_option_id = cart.get_shipping_option()
-    selected_shipping_option = None
-    try:
-        selected_shipping_option = \
-            ShippingOption.objects.get(id=selected_option_id)
-    except ShippingOption.DoesNotExist:
-        pass
+    quote = cart.shipping_quote
+    available_shipping_options = quote.choices
+    selected_option_id = quote.option_id
+    selected_shipping_option = \
+        quote.option or get_shipping_option(selected_option_id)
 
     initial = {}
 
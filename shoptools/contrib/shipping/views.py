@@ -1,9 +1,50 @@
 # -*- coding: utf-8 -*-
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import require_GET
+
+from shoptools import settings as shoptools_settings
+from shoptools.cart import get_cart
 from shoptools.cart.views import cart_view
 
 from .import actions
+from .util import get_estimates
 
 
 all_actions = ('change_option', )
 for action in all_actions:
     locals()[action] = cart_view(getattr(actions, action))
+
+
+@require_GET
+def estimates(request):
+    """Shipping costs for every region and option, as json, for the cart
+       value given as ?value=, or the current cart's subtotal. Responses
+       for a given value are public, so can be cached by a proxy. """
+
+    value = request.GET.get('value')
+    if value is None:
+        cart_value = get_cart(request).subtotal
+    else:
+        try:
+            cart_value = Decimal(value)
+        except InvalidOperation:
+            return HttpResponseBadRequest('Invalid value')
+        if not cart_value.is_finite():
+            return HttpResponseBadRequest('Invalid value')
+
+    response = HttpResponse(
+        json.dumps(get_estimates(cart_value), cls=DjangoJSONEncoder),
+        content_type="application/json")
+    if value is None:
+        patch_vary_headers(response, ('Cookie', ))
+        patch_cache_control(response, private=True)
+    else:
+        patch_cache_control(
+            response, public=True,
+            max_age=shoptools_settings.SHIPPING_ESTIMATES_MAX_AGE)
+    return response
@@ -2,17 +2,25 @@
 
 from datetime import date
 
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
 try:
     from django.urls import reverse
 except ImportError:
     from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.template.response import TemplateResponse
 from django.utils.text import mark_safe
 
+from shoptools import settings as shoptools_settings
+
 from .models import PercentageVoucher, FixedVoucher, Discount, \
     FreeShippingVoucher
-from .export import generate_csv
+from .export import stream_csv, stream_codes_csv
+from .generate import generate_vouchers, copy_fields, check_code_space, \
+    clean_alphabet
 
 
 @admin.register(Discount)
@@ -32,14 +40,75 @@ class DiscountInline(admin.TabularInline):
     readonly_fields = ('base_voucher', 'amount', )
 
 
+class GenerateCodesForm(forms.Form):
+    count = forms.IntegerField(min_value=1)
+    length = forms.IntegerField(
+        min_value=4, max_value=32,
+        initial=shoptools_settings.VOUCHER_CODE_LENGTH)
+    alphabet = forms.CharField(
+        initial=shoptools_settings.VOUCHER_CODE_ALPHABET)
+
+    def clean(self):
+        data = super(GenerateCodesForm, self).clean()
+        if not self.errors:
+            try:
+                check_code_space(data['count'], data['length'],
+                                 clean_alphabet(data['alphabet']))
+            except ValueError as e:
+                raise forms.ValidationError(str(e))
+        return data
+
+
 class VoucherAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'limit_', 'minimum_spend', 'code',
                     'created', )
     list_filter = ('created', )
+    actions = ('generate_codes', )
 
     def limit_(self, obj):
         return obj.limit or ''
 
+    def generate_codes(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, 'Select a single voucher to generate '
+                                       'codes like.', messages.ERROR)
+            return None
+
+        voucher = queryset.get()
+        if 'generate' in request.POST:
+            form = GenerateCodesForm(request.POST)
+            if form.is_valid():
+                # generate all the codes within the request's transaction,
+                # rather than as the response is streamed, and only stream
+                # the csv
+                with transaction.atomic():
+                    vouchers = list(generate_vouchers(
+                        type(voucher), form.cleaned_data['count'],
+                        length=form.cleaned_data['length'],
+                        alphabet=form.cleaned_data['alphabet'],
+                        **copy_fields(voucher)))
+                filename = 'Vouchers_' + date.today().strftime('%Y%m%d')
+
+                response = StreamingHttpResponse(stream_codes_csv(vouchers),
+                                                 content_type='text/csv')
+                response['Content-Disposition'] = \
+                    "attachment; filename=%s.csv" % filename
+                return response
+        else:
+            form = GenerateCodesForm()
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            voucher=voucher,
+            form=form,
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+        )
+        return TemplateResponse(request, 'admin/vouchers/generate_codes.html',
+                                context)
+    generate_codes.short_description = 'Generate codes like the selected ' \
+                                       'voucher'
+
 
 admin.site.register(PercentageVoucher, VoucherAdmin)
 admin.site.register(FreeShippingVoucher, VoucherAdmin)
@@ -51,11 +120,19 @@ class FixedVoucherAdmin(VoucherAdmin):
         'order', 'amount_redeemed', 'amount_remaining', )
     readonly_fields = ('currency_code', )
     exclude = ('limit', )
-    actions = ('csv_export', )
+    actions = ('csv_export', 'generate_codes', )
+
+    def get_queryset(self, request):
+        qs = super(FixedVoucherAdmin, self).get_queryset(request)
+        return qs.with_usage().select_related('order_line__parent_object')
+
+    def amount_redeemed(self, obj):
+        return obj.redeemed
+    amount_redeemed.admin_order_field = 'redeemed'
 
     def amount_remaining(self, obj):
-        val = obj.amount_remaining()
-        return val if val is not None else ''
+        return obj.remaining
+    amount_remaining.admin_order_field = 'remaining'
 
     def order(self, obj):
         if obj.order_line:
@@ -68,10 +145,8 @@ class FixedVoucherAdmin(VoucherAdmin):
     def csv_export(self, request, queryset):
         filename = 'Vouchers_' + date.today().strftime('%Y%m%d')
 
-        # response = HttpResponse()
-        response = HttpResponse(content_type='text/csv')
+        response = StreamingHttpResponse(stream_csv(queryset),
+                                         content_type='text/csv')
         response['Content-Disposition'] = \
             "attachment; filename=%s.csv" % filename
-
-        generate_csv(queryset, response)
         return response
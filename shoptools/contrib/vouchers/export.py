@@ -2,6 +2,8 @@
 
 import csv
 
+from shoptools.checkout.export import Echo
+
 
 FIELDS = (
     ('Amount', 'amount'),
@@ -11,24 +13,64 @@ FIELDS = (
     ('Order', 'order_line.parent_object'),
     ('Order ID', 'order_line.parent_object.pk'),
     ('Amount Redeemed', 'amount_redeemed'),
-    ('Amount Remaining', lambda o: o.amount_remaining()
-        if o.amount_remaining() is not None else ''),
+    ('Amount Remaining', 'amount_remaining'),
+)
+
+CODE_FIELDS = (
+    ('Code', 'code'),
+    ('Discount', 'discount_text'),
+    ('Limit', 'limit'),
+    ('Minimum Spend', 'minimum_spend'),
+    ('Expiry Date', 'expiry_date'),
 )
 
 
+def generate_rows(qs):
+    """Yield the header and a row per voucher. Redeemed and remaining
+       amounts come from the with_usage() annotations and orders are
+       selected in the same query, so the export costs a single query,
+       streamed from the database cursor. """
+
+    yield [f[0] for f in FIELDS]
+
+    qs = qs.with_usage().select_related('order_line__parent_object')
+    for obj in qs.iterator():
+        yield [getval(obj, getter) for name, getter in FIELDS]
+
+
 def generate_csv(qs, file_object):
     csvfile = csv.writer(file_object)
-    header = [f[0] for f in FIELDS]
-    csvfile.writerow(header)
+    for row in generate_rows(qs):
+        csvfile.writerow(row)
 
-    for obj in qs:
-        row = []
-        for name, getter in FIELDS:
-            row.append(getval(obj, getter))
 
+def stream_csv(qs):
+    """Return an iterator of csv lines, for a StreamingHttpResponse. """
+
+    csvfile = csv.writer(Echo())
+    return (csvfile.writerow(row) for row in generate_rows(qs))
+
+
+def generate_code_rows(vouchers):
+    """Yield the header and a row per voucher, for an iterable of vouchers
+       such as generate_vouchers() returns. """
+
+    yield [f[0] for f in CODE_FIELDS]
+    for obj in vouchers:
+        yield [getval(obj, getter) for name, getter in CODE_FIELDS]
+
+
+def generate_codes_csv(vouchers, file_object):
+    csvfile = csv.writer(file_object)
+    for row in generate_code_rows(vouchers):
         csvfile.writerow(row)
 
 
+def stream_codes_csv(vouchers):
+    csvfile = csv.writer(Echo())
+    return (csvfile.writerow(row) for row in generate_code_rows(vouchers))
+
+
 def getval(obj, getter):
     """Gets a value from an object, using a getter which
        can be a callable, an attribute, or a dot-separated
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""Generate vouchers with random codes in bulk, e.g. single-use codes for a
+   campaign. Codes are checked for collisions in memory and against the
+   database a batch at a time, then inserted with bulk_create.
+"""
+
+import random
+
+from django.db import connection, transaction
+
+from shoptools import settings as shoptools_settings
+
+from .models import BaseVoucher, normalize_code
+
+
+BATCH_SIZE = 500
+
+_random = random.SystemRandom()
+
+
+def clean_alphabet(alphabet):
+    """Codes are case-insensitive, so generate them in upper case, without
+       duplicate characters. """
+
+    return ''.join(sorted(set(normalize_code(alphabet))))
+
+
+def random_code(length, alphabet):
+    return ''.join(_random.choice(alphabet) for i in range(length))
+
+
+def generate_vouchers(voucher_cls, count, length=None, alphabet=None,
+                      batch_size=BATCH_SIZE, **fields):
+    """Create count vouchers of voucher_cls with random, unique codes, and
+       the given field values. Returns an iterator which inserts and yields
+       the vouchers a batch at a time, so the codes can be streamed out as
+       they're created. """
+
+    length = length or shoptools_settings.VOUCHER_CODE_LENGTH
+    alphabet = clean_alphabet(
+        alphabet or shoptools_settings.VOUCHER_CODE_ALPHABET)
+    check_code_space(count, length, alphabet)
+    return _generate_vouchers(voucher_cls, count, length, alphabet,
+                              batch_size, fields)
+
+
+def check_code_space(count, length, alphabet):
+    """Raise ValueError unless there are plenty of possible codes, so codes
+       are hard to guess and collisions stay rare. """
+
+    if count > len(alphabet) ** length // 2:
+        raise ValueError('Not enough possible codes for %s vouchers - use '
+                         'a longer code or bigger alphabet' % count)
+
+
+def _generate_vouchers(voucher_cls, count, length, alphabet, batch_size,
+                       fields):
+    seen = set()
+    created = 0
+    while created < count:
+        codes = set()
+        while len(codes) < min(batch_size, count - created):
+            code = random_code(length, alphabet)
+            if code not in seen:
+                seen.add(code)
+                codes.add(code)
+
+        codes -= set(BaseVoucher.objects.filter(normalized_code__in=codes)
+                     .values_list('normalized_code', flat=True))
+        if codes:
+            vouchers = insert_vouchers(voucher_cls, sorted(codes), fields)
+            created += len(vouchers)
+            for voucher in vouchers:
+                yield voucher
+
+
+def copy_fields(voucher):
+    """Field values for generating more vouchers like voucher. """
+
+    fields = {
+        'limit': voucher.limit,
+        'minimum_spend': voucher.minimum_spend,
+        'expiry_date': voucher.expiry_date,
+    }
+    for field in voucher._meta.local_concrete_fields:
+        # not the parent link, or the order a gift voucher was bought with
+        if not field.primary_key and field.name != 'order_line':
+            fields[field.attname] = getattr(voucher, field.attname)
+    return fields
+
+
+@transaction.atomic
+def insert_vouchers(voucher_cls, codes, fields):
+    """Insert vouchers with the given codes. Django can't bulk_create
+       multi-table inherited models, so the BaseVoucher rows are bulk
+       created first, then the subclass rows inserted the same way. """
+
+    vouchers = [voucher_cls(code=code, normalized_code=normalize_code(code),
+                            **fields)
+                for code in codes]
+
+    base_fields = BaseVoucher._meta.concrete_fields
+    bases = [BaseVoucher(**{f.attname: getattr(voucher, f.attname)
+                            for f in base_fields})
+             for voucher in vouchers]
+    BaseVoucher.objects.bulk_create(bases, batch_size=BATCH_SIZE)
+
+    # not all databases return ids from a bulk insert. Look them up by code,
+    # which is unique, unlike the normalized code
+    pks = dict(BaseVoucher.objects
+               .filter(code__in=[v.code for v in vouchers])
+               .values_list('code', 'pk'))
+    for voucher, base in zip(vouchers, bases):
+        voucher.pk = voucher.id = pks[voucher.code]
+        voucher.created = base.created
+        voucher._state.adding = False
+
+    local_fields = voucher_cls._meta.local_concrete_fields
+    step = connection.ops.bulk_batch_size(local_fields, vouchers)
+    for i in range(0, len(vouchers), step):
+        voucher_cls._base_manager._insert(vouchers[i:i + step],
+                                          fields=local_fields, raw=True)
+    return vouchers
@@ -0,0 +1,78 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from shoptools import settings as shoptools_settings
+from shoptools.contrib.vouchers.export import generate_codes_csv
+from shoptools.contrib.vouchers.generate import generate_vouchers
+from shoptools.contrib.vouchers.models import \
+    PercentageVoucher, FixedVoucher, FreeShippingVoucher
+
+
+VOUCHER_TYPES = {
+    'percentage': PercentageVoucher,
+    'fixed': FixedVoucher,
+    'shipping': FreeShippingVoucher,
+}
+
+
+class Command(BaseCommand):
+    help = 'Generate vouchers with random codes in bulk, and write the ' \
+           'codes out as csv. Vouchers are single use unless --limit is ' \
+           'given (fixed vouchers have unlimited uses, up to their amount).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('type', choices=sorted(VOUCHER_TYPES))
+        parser.add_argument('count', type=int)
+        parser.add_argument('--amount',
+                            help='Percentage or dollar amount, for '
+                                 'percentage and fixed vouchers')
+        parser.add_argument('--limit', type=int, default=1,
+                            help='Number of uses per code, 0 for unlimited')
+        parser.add_argument('--minimum-spend', type=int, default=0)
+        parser.add_argument('--expiry-date', help='YYYY-MM-DD')
+        parser.add_argument('--length', type=int,
+                            default=shoptools_settings.VOUCHER_CODE_LENGTH)
+        parser.add_argument('--alphabet',
+                            default=shoptools_settings.VOUCHER_CODE_ALPHABET)
+        parser.add_argument('--output', help='Csv file to write, instead of '
+                                             'standard output')
+
+    def handle(self, type, count, **options):
+        voucher_cls = VOUCHER_TYPES[type]
+        fields = {
+            'minimum_spend': options['minimum_spend'],
+            'expiry_date': None,
+        }
+
+        if options['expiry_date']:
+            fields['expiry_date'] = parse_date(options['expiry_date'])
+            if not fields['expiry_date']:
+                raise CommandError('Invalid expiry date')
+
+        if voucher_cls is FixedVoucher:
+            fields['limit'] = None
+        else:
+            fields['limit'] = options['limit'] or None
+
+        if voucher_cls is not FreeShippingVoucher:
+            if not options['amount']:
+                raise CommandError('--amount is required for %s vouchers'
+                                   % type)
+            if voucher_cls is FixedVoucher:
+                fields['amount'] = Decimal(options['amount'])
+            else:
+                fields['amount'] = int(options['amount'])
+
+        try:
+            vouchers = generate_vouchers(
+                voucher_cls, count, length=options['length'],
+                alphabet=options['alphabet'], **fields)
+            if options['output']:
+                with open(options['output'], 'w', newline='') as f:
+                    generate_codes_csv(vouchers, f)
+            else:
+                generate_codes_csv(vouchers, self.stdout)
+        except ValueError as e:
+            raise CommandError(e)
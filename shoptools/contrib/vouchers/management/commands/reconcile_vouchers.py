@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shoptools.contrib.vouchers.util import reconcile_usage
+
+
+class Command(BaseCommand):
+    help = 'Recount each voucher\'s uses and redeemed amount from its ' \
+           'discounts, correcting any which are out of step, e.g. after ' \
+           'discounts were changed with raw SQL.'
+
+    def handle(self, **options):
+        corrected = reconcile_usage()
+        if options['verbosity'] > 1:
+            self.stdout.write('Corrected %s vouchers' % corrected)
@@ -0,0 +1,26 @@
+# Generated by Django 2.1.15 on 2026-10-18 02:58
+
+from django.db import migrations, models
+
+
+def normalize_codes(apps, schema_editor):
+    BaseVoucher = apps.get_model('vouchers', 'BaseVoucher')
+    for voucher in BaseVoucher.objects.only('code').iterator():
+        BaseVoucher.objects.filter(pk=voucher.pk).update(
+            normalized_code=voucher.code.strip().upper())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vouchers', '0002_auto_20180723_1412'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basevoucher',
+            name='normalized_code',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=32),
+        ),
+        migrations.RunPython(normalize_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.1.15 on 2026-10-18 03:02
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def count_usage(apps, schema_editor):
+    BaseVoucher = apps.get_model('vouchers', 'BaseVoucher')
+    Discount = apps.get_model('vouchers', 'Discount')
+    usage = Discount.objects.order_by().values('base_voucher') \
+        .annotate(count=Count('pk'), total=Sum('amount'))
+    for row in usage.iterator():
+        BaseVoucher.objects.filter(pk=row['base_voucher']).update(
+            uses_count=row['count'], redeemed_amount=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vouchers', '0003_normalized_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basevoucher',
+            name='redeemed_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8),
+        ),
+        migrations.AddField(
+            model_name='basevoucher',
+            name='uses_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_usage, migrations.RunPython.noop),
+    ]
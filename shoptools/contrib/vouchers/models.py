@@ -2,10 +2,12 @@
 import uuid
 
 from django.db import models
+from django.db.models.signals import post_delete
 from django.template.defaultfilters import floatformat
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
-from model_utils.managers import InheritanceManager
+from django.db.models.functions import Coalesce
+from model_utils.managers import InheritanceManager, InheritanceQuerySet
 
 from shoptools import settings as shoptools_settings
 from shoptools.checkout.models import Order, OrderLine
@@ -16,15 +18,70 @@ def make_code():
     return str(u).replace('-', '')[:8]
 
 
+def normalize_code(code):
+    """Vouchers codes are case-insensitive, and are looked up by their
+       normalized form. """
+
+    return code.strip().upper()
+
+
+class VoucherQuerySetMixin(object):
+    def with_usage(self):
+        """Annotate each voucher with its use count (use_count), total amount
+           redeemed (redeemed), and for fixed vouchers, the remaining balance
+           (remaining), so listing vouchers doesn't need queries per
+           voucher. These are counted from discounts, unlike the
+           denormalized uses_count and redeemed_amount fields. """
+
+        if 'redeemed' in self.query.annotations:
+            return self
+
+        amount_field = models.DecimalField(max_digits=8, decimal_places=2)
+        qs = self.annotate(
+            use_count=models.Count('discount'),
+            redeemed=Coalesce(models.Sum('discount__amount'),
+                              models.Value(0), output_field=amount_field))
+        if issubclass(self.model, FixedVoucher):
+            qs = qs.annotate(remaining=models.ExpressionWrapper(
+                models.F('amount') - models.F('redeemed'),
+                output_field=amount_field))
+        return qs
+
+
+class VoucherQuerySet(VoucherQuerySetMixin, models.QuerySet):
+    pass
+
+
+class BaseVoucherQuerySet(VoucherQuerySetMixin, InheritanceQuerySet):
+    pass
+
+
+class BaseVoucherManager(InheritanceManager):
+    def get_queryset(self):
+        return BaseVoucherQuerySet(self.model, using=self._db)
+
+    def with_usage(self):
+        return self.get_queryset().with_usage()
+
+
 class BaseVoucher(models.Model):
     code = models.CharField(max_length=32, blank=True, unique=True,
                             help_text="Leave blank to auto-generate")
+    normalized_code = models.CharField(max_length=32, editable=False,
+                                       db_index=True, default='')
     created = models.DateTimeField(auto_now_add=True)
     limit = models.PositiveSmallIntegerField(null=True, blank=True)
     minimum_spend = models.PositiveIntegerField(default=0)
     expiry_date = models.DateField(blank=True, null=True)
 
-    objects = InheritanceManager()
+    # denormalized from Discount, and updated as discounts are saved and
+    # deleted, so checking a voucher doesn't need to count its uses. See
+    # the reconcile_vouchers command.
+    uses_count = models.PositiveIntegerField(default=0, editable=False)
+    redeemed_amount = models.DecimalField(max_digits=8, decimal_places=2,
+                                          default=0, editable=False)
+
+    objects = BaseVoucherManager()
 
     @property
     def voucher(self):
@@ -36,16 +93,26 @@ class BaseVoucher(models.Model):
         return BaseVoucher.objects.get(pk=self.pk)
 
     def uses(self, exclude={}):
+        # subclasses share the base voucher's pk
         return Discount.objects.exclude(**exclude) \
-                               .filter(base_voucher=self.base_voucher)
+                               .filter(base_voucher_id=self.pk)
 
     def available(self, exclude={}):
-        # FixedVoucher always unlimited uses
-        if self.limit is None or isinstance(self.voucher, FixedVoucher):
+        # FixedVoucher always unlimited uses. Base vouchers check for the
+        # subclass row rather than loading the subclass instance
+        if self.limit is None or isinstance(self, FixedVoucher):
+            return True
+        if type(self) is BaseVoucher and hasattr(self, 'fixedvoucher'):
             return True
+        if not exclude:
+            return self.uses_count < self.limit
         return bool(self.limit - self.uses(exclude).count())
 
     def amount_redeemed(self, exclude={}):
+        # use the with_usage() annotation if present, or the denormalized
+        # total
+        if not exclude:
+            return getattr(self, 'redeemed', self.redeemed_amount)
         uses = self.uses(exclude)
         return uses.aggregate(models.Sum('amount'))['amount__sum'] or 0
 
@@ -54,14 +121,16 @@ class BaseVoucher(models.Model):
            If not, return None to indicate an unlimited amount remaining.
         """
 
-        if not isinstance(self.voucher, FixedVoucher):
+        voucher = self if isinstance(self, FixedVoucher) else self.voucher
+        if not isinstance(voucher, FixedVoucher):
             return None
 
-        return self.amount - self.amount_redeemed(exclude)
+        return voucher.amount - self.amount_redeemed(exclude)
 
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = make_code()
+        self.normalized_code = normalize_code(self.code)
         return super(BaseVoucher, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -70,7 +139,7 @@ class BaseVoucher(models.Model):
 
 class FixedVoucher(BaseVoucher):
     # need to declare explicitly so it doesn't inherit BaseVoucher's manager
-    objects = models.Manager()
+    objects = VoucherQuerySet.as_manager()
 
     amount = models.DecimalField(max_digits=6, decimal_places=2)
     # Save code itself instead of a foreignKey to Currency, as regions app may
@@ -93,7 +162,7 @@ class FixedVoucher(BaseVoucher):
 
 class PercentageVoucher(BaseVoucher):
     # need to declare explicitly so it doesn't inherit BaseVoucher's manager
-    objects = models.Manager()
+    objects = VoucherQuerySet.as_manager()
 
     amount = models.PositiveSmallIntegerField(
         validators=[MinValueValidator(0), MaxValueValidator(100)])
@@ -105,7 +174,7 @@ class PercentageVoucher(BaseVoucher):
 
 class FreeShippingVoucher(BaseVoucher):
     # need to declare explicitly so it doesn't inherit BaseVoucher's manager
-    objects = models.Manager()
+    objects = VoucherQuerySet.as_manager()
 
     @property
     def discount_text(self):
@@ -120,16 +189,21 @@ class Discount(models.Model):
     def __init__(self, *args, **kwargs):
         voucher = kwargs.pop('voucher', None)
         if voucher:
-            kwargs['base_voucher'] = voucher.base_voucher
+            # subclasses share the base voucher's pk
+            kwargs['base_voucher_id'] = voucher.pk
         super(Discount, self).__init__(*args, **kwargs)
+        self._voucher = voucher
 
     @property
     def voucher(self):
-        return self.base_voucher.voucher
+        if self._voucher is None:
+            self._voucher = self.base_voucher.voucher
+        return self._voucher
 
     @voucher.setter
     def voucher(self, voucher_obj):
-        self.base_voucher = voucher_obj.base_voucher
+        self.base_voucher_id = voucher_obj.pk
+        self._voucher = voucher_obj
 
     def clean(self):
         """Verify that the voucher doesn't violate
@@ -158,3 +232,16 @@ class Discount(models.Model):
             return "%s: %s" % (self.order, self.voucher)
         else:
             return str(self.voucher)
+
+
+def discount_deleted(sender, instance, **kwargs):
+    """Return a deleted discount to its voucher's usage, however it was
+       deleted - released by save_discounts, deleted with its order, or in
+       the admin. """
+
+    BaseVoucher.objects.filter(pk=instance.base_voucher_id).update(
+        uses_count=models.F('uses_count') - 1,
+        redeemed_amount=models.F('redeemed_amount') - instance.amount)
+
+
+post_delete.connect(discount_deleted, sender=Discount)
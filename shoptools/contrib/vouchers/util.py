@@ -1,22 +1,57 @@
 import decimal
 from datetime import date
-from functools import reduce
 
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import \
+    Count, DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 
 from shoptools.util import get_vouchers_module
 from shoptools.abstractions.models import ICart
 from shoptools.checkout.models import Order
 
 from .models import \
-    BaseVoucher, FreeShippingVoucher, Discount, FixedVoucher, PercentageVoucher
+    BaseVoucher, FreeShippingVoucher, Discount, FixedVoucher, \
+    PercentageVoucher, normalize_code
 
 
 def get_vouchers(codes):
+    """Return vouchers for the given codes, in a single query on the
+       normalized code index. """
+
     qs = BaseVoucher.objects.select_subclasses()
     if not len(codes):
         return qs.none()
-    return qs.filter(reduce(Q.__or__, [Q(code__iexact=c) for c in codes]))
+    codes = set(normalize_code(c) for c in codes)
+    return qs.filter(normalized_code__in=codes)
+
+
+def get_valid_vouchers(codes, subtotal, order=None):
+    """As get_vouchers, but excludes vouchers which are expired, used up, or
+       whose minimum spend is more than subtotal. If order is given, its own
+       discounts don't count towards vouchers' usage, since they'll be
+       replaced when it's saved - the amount they redeemed is annotated on
+       each voucher as order_redeemed. """
+
+    qs = get_vouchers(codes)
+    if order is not None and order.pk:
+        own = Q(discount__order=order)
+        amount_field = DecimalField(max_digits=8, decimal_places=2)
+        qs = qs.annotate(
+            order_uses=Count('discount', filter=own),
+            order_redeemed=Coalesce(Sum('discount__amount', filter=own),
+                                    Value(0), output_field=amount_field))
+        uses_count = F('uses_count') - F('order_uses')
+    else:
+        uses_count = F('uses_count')
+
+    return qs.filter(
+        Q(expiry_date__isnull=True) | Q(expiry_date__gte=date.today()),
+        # fixed vouchers have unlimited uses
+        Q(limit__isnull=True) | Q(fixedvoucher__isnull=False) |
+        Q(limit__gt=uses_count),
+        minimum_spend__lte=subtotal,
+    )
 
 
 def calculate_discounts(obj, codes, include_shipping=True):
@@ -33,8 +68,8 @@ def calculate_discounts(obj, codes, include_shipping=True):
 
     assert isinstance(obj, ICart)
 
-    codes = set([c.upper() for c in codes])  # normalise and remove duplicates
-    vouchers = get_vouchers(codes)
+    # normalise and remove duplicates
+    codes = set([normalize_code(c) for c in codes])
 
     discounts = []
     total = obj.subtotal + (decimal.Decimal(obj.shipping_cost)
@@ -52,16 +87,10 @@ def calculate_discounts(obj, codes, include_shipping=True):
         else:
             defaults = {}
 
-    # filter out any that have already been used
-    vouchers = [v for v in vouchers if v.available(exclude=defaults)]
-
-    # filter out any that are expired
-    vouchers = [v for v in vouchers if
-                (not v.expiry_date or v.expiry_date >= date.today())]
-
-    # filter out any under their minimum_spend value
-    # invalid_spend = [v for v in vouchers if obj.subtotal < v.minimum_spend]
-    vouchers = [v for v in vouchers if obj.subtotal >= v.minimum_spend]
+    # fetch valid vouchers in one query, excluding any that have been used
+    # up or expired, or are under their minimum_spend value
+    vouchers = list(get_valid_vouchers(codes, obj.subtotal,
+                                       defaults.get('order')))
 
     if include_shipping:
         # apply free shipping (only one)
@@ -109,7 +138,7 @@ def calculate_discounts(obj, codes, include_shipping=True):
     if p_voucher:
         # percentage discounts can't be used for some products, i.e. gift cards
         p_total = decimal.Decimal(sum([
-            line.total for line in obj.get_lines()
+            line.total for line in obj.pricing.lines
             if getattr(line.item, 'allow_discounts', True)]))
 
         # apply percentage to the smaller of p_total and the running total,
@@ -123,33 +152,113 @@ def calculate_discounts(obj, codes, include_shipping=True):
 
     # apply fixed vouchers, smallest remaining amount first
     fixed = [v for v in vouchers if isinstance(v, FixedVoucher)]
-    fixed.sort(key=lambda v: v.amount_remaining(exclude=defaults))
+    remaining = {v.pk: v.amount - v.redeemed_amount +
+                 getattr(v, 'order_redeemed', 0)
+                 for v in fixed}
+    fixed.sort(key=lambda v: remaining[v.pk])
 
+    cart_currency_code, _ = obj.get_currency()
     for voucher in fixed:
         # exclude any vouchers that do not match the cart's currency
-        cart_currency_code, _ = obj.get_currency()
         if voucher.currency_code != cart_currency_code:
             continue
 
-        amount = min(total, voucher.amount,
-                     voucher.amount_remaining(exclude=defaults))
+        amount = min(total, voucher.amount, remaining[voucher.pk])
         if amount == 0:
             continue
         total -= amount
         discounts.append(Discount(voucher=voucher, amount=amount, **defaults))
 
     # identify bad codes and add to the list
-    valid_codes = [d.voucher.code.upper() for d in discounts]
+    valid_codes = [normalize_code(d.voucher.code) for d in discounts]
     invalid_codes = [c for c in codes if c not in valid_codes]
     return discounts, invalid_codes
 
 
+def redeem(discount):
+    """Add an unsaved discount to its voucher's usage, with a conditional
+       update so concurrent checkouts can't take the voucher past its limit,
+       or a fixed voucher past its balance. Returns True if the discount
+       could be redeemed. """
+
+    voucher = discount.voucher
+    qs = BaseVoucher.objects.filter(pk=voucher.pk)
+    if isinstance(voucher, FixedVoucher):
+        # fixed vouchers have unlimited uses
+        qs = qs.filter(redeemed_amount__lte=voucher.amount - discount.amount)
+    else:
+        qs = qs.filter(Q(limit__isnull=True) | Q(uses_count__lt=F('limit')))
+
+    return bool(qs.update(
+        uses_count=F('uses_count') + 1,
+        redeemed_amount=F('redeemed_amount') + discount.amount))
+
+
+def release_discounts(order):
+    """Delete the order's discounts, returning them to their vouchers' usage
+       via the post_delete receiver. The discounts are locked first, so
+       concurrent requests can't release them twice. """
+
+    with transaction.atomic():
+        pks = list(order.discount_set.select_for_update()
+                   .values_list('pk', flat=True))
+        if pks:
+            Discount.objects.filter(pk__in=pks).delete()
+
+
+@transaction.atomic
 def save_discounts(obj, codes):
+    """Replace the order's discounts with those calculated for codes.
+       Discounts which can no longer be redeemed, because another order
+       used the voucher up in the meantime, are dropped. Returns a tuple of
+       (discounts, invalid codes). """
+
     assert isinstance(obj, Order)
 
+    release_discounts(obj)
     discounts, invalid = calculate_discounts(obj, codes)
+
+    saved = []
     for discount in discounts:
-        discount.save()
+        if redeem(discount):
+            discount.save()
+            saved.append(discount)
+        else:
+            invalid.append(normalize_code(discount.voucher.code))
+    return saved, invalid
+
+
+def reconcile_usage(queryset=None, batch_size=500):
+    """Recount the denormalized usage of vouchers in queryset (all vouchers by
+       default) from their discounts, correcting any which are out of step,
+       e.g. because discounts were changed with raw SQL. Returns the number of
+       vouchers corrected. """
+
+    discounts = Discount.objects.filter(base_voucher=OuterRef('pk')) \
+        .order_by().values('base_voucher')
+    amount_field = DecimalField(max_digits=8, decimal_places=2)
+    actual = {
+        'uses_count': Coalesce(Subquery(
+            discounts.annotate(count=Count('pk')).values('count')), 0),
+        'redeemed_amount': Coalesce(Subquery(
+            discounts.annotate(total=Sum('amount')).values('total'),
+            output_field=amount_field), 0),
+    }
+
+    if queryset is None:
+        queryset = BaseVoucher.objects.all()
+    wrong = list(queryset.order_by('pk')
+                 .annotate(actual_uses=actual['uses_count'],
+                           actual_redeemed=actual['redeemed_amount'])
+                 .exclude(uses_count=F('actual_uses'),
+                          redeemed_amount=F('actual_redeemed'))
+                 .values_list('pk', flat=True))
+
+    # recount in the update itself, in case of discounts saved in between
+    for i in range(0, len(wrong), batch_size):
+        BaseVoucher.objects.filter(pk__in=wrong[i:i + batch_size]) \
+            .update(**actual)
+    return len(wrong)
 
 
 def vouchers_context(request):
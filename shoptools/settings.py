@@ -10,10 +10,73 @@ VOUCHERS_MODULE = getattr(settings, 'SHOPTOOLS_VOUCHERS_MODULE', None)
 FAVOURITES_MODULE = getattr(settings, 'SHOPTOOLS_FAVOURITES_MODULE', None)
 PAYMENT_MODULE = getattr(settings, 'SHOPTOOLS_PAYMENT_MODULE', None)
 EMAIL_MODULE = getattr(settings, 'SHOPTOOLS_EMAIL_MODULE', None)
+RESERVATIONS_MODULE = getattr(settings, 'SHOPTOOLS_RESERVATIONS_MODULE',
+                              None)
 
 DEFAULT_SESSION_KEY = getattr(settings, 'SHOPTOOLS_CART_DEFAULT_SESSION_KEY',
                               'cart')
 
+# zlib compress cart data stored in the session. Worthwhile for large carts
+# with db-backed sessions
+CART_SESSION_COMPRESS = getattr(settings, 'SHOPTOOLS_CART_SESSION_COMPRESS',
+                                False)
+
+# Where SessionCart data is kept - see shoptools.cart.storage
+CART_STORE = getattr(settings, 'SHOPTOOLS_CART_STORE',
+                     'shoptools.cart.storage.SessionCartStore')
+CART_CACHE_ALIAS = getattr(settings, 'SHOPTOOLS_CART_CACHE_ALIAS', 'default')
+CART_CACHE_TIMEOUT = getattr(settings, 'SHOPTOOLS_CART_CACHE_TIMEOUT',
+                             60 * 60 * 24 * 30)
+
+# Seconds that stock reserved at checkout is held for, pending payment. See
+# shoptools.contrib.reservations
+RESERVATION_TIMEOUT = getattr(settings, 'SHOPTOOLS_RESERVATION_TIMEOUT',
+                              60 * 15)
+
+# How order side effects (emails, purchase hooks etc) run after the payment
+# transaction commits - 'thread', 'sync' or 'worker'. See
+# shoptools.checkout.tasks
+CHECKOUT_TASK_RUNNER = getattr(settings, 'SHOPTOOLS_CHECKOUT_TASK_RUNNER',
+                               'thread')
+CHECKOUT_TASK_THREADS = getattr(settings, 'SHOPTOOLS_CHECKOUT_TASK_THREADS', 2)
+CHECKOUT_TASK_MAX_ATTEMPTS = getattr(
+    settings, 'SHOPTOOLS_CHECKOUT_TASK_MAX_ATTEMPTS', 5)
+# seconds before the first retry, doubling for each subsequent retry
+CHECKOUT_TASK_RETRY_DELAY = getattr(
+    settings, 'SHOPTOOLS_CHECKOUT_TASK_RETRY_DELAY', 60)
+# seconds after which a running task is assumed to have died
+CHECKOUT_TASK_TIMEOUT = getattr(settings, 'SHOPTOOLS_CHECKOUT_TASK_TIMEOUT',
+                                60 * 60)
+
+# Regions, countries and currencies are cached in each process, and reloaded
+# when they change. The shared version key is kept in this cache, which
+# should be shared between processes (i.e. redis or memcached), and checked
+# at most every REGIONS_CACHE_CHECK_INTERVAL seconds. See
+# shoptools.contrib.regions.cache
+REGIONS_CACHE_ALIAS = getattr(settings, 'SHOPTOOLS_REGIONS_CACHE_ALIAS',
+                              'default')
+REGIONS_CACHE_CHECK_INTERVAL = getattr(
+    settings, 'SHOPTOOLS_REGIONS_CACHE_CHECK_INTERVAL', 5)
+
+# Number of IP addresses whose GeoIP country lookup is remembered, per process
+GEOIP_CACHE_SIZE = getattr(settings, 'SHOPTOOLS_GEOIP_CACHE_SIZE', 10000)
+# Paths which RegionMiddleware ignores, since they don't need a location.
+# Paths ending in / are prefixes, others must match exactly
+REGIONS_MIDDLEWARE_SKIP_PATHS = getattr(
+    settings, 'SHOPTOOLS_REGIONS_MIDDLEWARE_SKIP_PATHS',
+    ('/static/', '/media/', '/admin/', '/favicon.ico', '/robots.txt',
+     '/health', '/health/'))
+# Seconds that shipping estimates for a given cart value may be cached by
+# browsers and proxies - see shoptools.contrib.shipping.views.estimates
+SHIPPING_ESTIMATES_MAX_AGE = getattr(
+    settings, 'SHOPTOOLS_SHIPPING_ESTIMATES_MAX_AGE', 300)
+
+# Codes generated in bulk by the generate_vouchers command and admin action.
+# The default alphabet leaves out easily confused characters (0/O, 1/I/L)
+VOUCHER_CODE_ALPHABET = getattr(settings, 'SHOPTOOLS_VOUCHER_CODE_ALPHABET',
+                                'ABCDEFGHJKMNPQRSTUVWXYZ23456789')
+VOUCHER_CODE_LENGTH = getattr(settings, 'SHOPTOOLS_VOUCHER_CODE_LENGTH', 8)
+
 LOGIN_ADDITIONAL_POST_DATA_KEY = \
     getattr(settings, 'SHOPTOOLS_LOGIN_ADDITIONAL_POST_DATA_KEY',
             'favourites_post')
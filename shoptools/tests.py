@@ -1,11 +1,606 @@
-from django.test import TestCase
+import csv
+import io
+import random
+import threading
+import json
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
+from django.db import connection, OperationalError
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.urls import reverse
+
+from shoptools import settings as shoptools_settings
+
+from shoptools.cart.session import SessionCart
+from shoptools.checkout.models import Order
+from shoptools.contrib.catalogue.models import Product
+from shoptools.contrib.regions import cache as regions_cache
+from shoptools.contrib.regions.models import Currency, Region, Country
+from shoptools.contrib.regions import util as regions_util
+from shoptools.contrib.regions.middleware import RegionMiddleware
+from shoptools.contrib.regions.util import get_region, get_region_id
+from shoptools.contrib.shipping import util as shipping_util
+from shoptools.contrib.shipping.models import Option, ShippingOption
+from shoptools.contrib.shipping.rates import RegionRates, rate_table
+from shoptools.contrib.vouchers.export import stream_csv
+from shoptools.contrib.vouchers.generate import generate_vouchers, \
+    insert_vouchers
+from shoptools.contrib.vouchers.util import \
+    calculate_discounts, redeem, save_discounts
+from shoptools.contrib.vouchers.models import \
+    BaseVoucher, FixedVoucher, PercentageVoucher, FreeShippingVoucher, \
+    Discount
 
 
 class ShoptoolsTestCase(TestCase):
     """Integration tests for shoptools apps. """
 
     def setUp(self):
-        pass
+        regions_cache.clear_all()
 
     def test_sample(self):
         self.assertEqual(1, 1)
+
+
+class VoucherTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        order = Order.objects.create()
+        self.vouchers = []
+        for i in range(5):
+            voucher = FixedVoucher.objects.create(amount=50)
+            for amount in (10, 15):
+                Discount.objects.create(order=order, voucher=voucher,
+                                        amount=amount)
+            self.vouchers.append(voucher)
+        FixedVoucher.objects.create(amount=20)
+        PercentageVoucher.objects.create(amount=10)
+
+    def test_with_usage(self):
+        with self.assertNumQueries(1):
+            vouchers = list(FixedVoucher.objects.with_usage().order_by('pk'))
+            self.assertEqual([v.use_count for v in vouchers],
+                             [2] * 5 + [0])
+            self.assertEqual([v.amount_redeemed() for v in vouchers],
+                             [25] * 5 + [0])
+            self.assertEqual([v.amount_remaining() for v in vouchers],
+                             [25] * 5 + [20])
+
+        vouchers = BaseVoucher.objects.with_usage().select_subclasses()
+        self.assertEqual(sorted(v.redeemed for v in vouchers),
+                         [0, 0] + [25] * 5)
+        self.assertIsNone(
+            PercentageVoucher.objects.with_usage().get().amount_remaining())
+
+    def test_export(self):
+        with self.assertNumQueries(1):
+            rows = list(csv.reader(stream_csv(FixedVoucher.objects.all())))
+        self.assertEqual(len(rows), 7)
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual(Decimal(row['Amount Redeemed']), 25)
+        self.assertEqual(Decimal(row['Amount Remaining']), 25)
+
+    def test_calculate_discounts(self):
+        order = Order.objects.create()
+        for i, voucher in enumerate(self.vouchers):
+            voucher.code = 'Code%s' % i
+            voucher.save()
+
+        # one query for the vouchers, however many codes
+        order.subtotal
+        with self.assertNumQueries(1):
+            calculate_discounts(order, ['code0'])
+        with self.assertNumQueries(1):
+            discounts, invalid = calculate_discounts(
+                order, [' code%s ' % i for i in range(5)] + ['missing'])
+
+        self.assertEqual(len(discounts), 0)  # the order has no subtotal
+        self.assertEqual(len(invalid), 6)
+
+
+class GenerateVouchersTestCase(TestCase):
+    def test_generate(self):
+        vouchers = list(generate_vouchers(
+            PercentageVoucher, 1200, batch_size=500, amount=20, limit=1))
+        self.assertEqual(len(vouchers), 1200)
+        self.assertEqual(PercentageVoucher.objects.count(), 1200)
+        codes = set(PercentageVoucher.objects.values_list('code', flat=True))
+        self.assertEqual(codes, set(v.code for v in vouchers))
+        self.assertEqual(len(list(codes)[0]), 8)
+
+        voucher = PercentageVoucher.objects.get(code=vouchers[0].code)
+        self.assertEqual(voucher.normalized_code, voucher.code)
+        self.assertEqual(voucher.amount, 20)
+        self.assertEqual(voucher.limit, 1)
+
+    def test_collisions(self):
+        FreeShippingVoucher.objects.create(code='aaaa')
+        vouchers = list(generate_vouchers(FreeShippingVoucher, 8, length=4,
+                                          alphabet='ab', batch_size=3))
+        codes = [v.code for v in vouchers]
+        self.assertEqual(len(set(codes)), 8)
+        self.assertNotIn('AAAA', codes)
+        self.assertEqual(FreeShippingVoucher.objects.count(), 9)
+
+        with self.assertRaises(ValueError):
+            generate_vouchers(FreeShippingVoucher, 9, length=4,
+                              alphabet='ab')
+
+    def test_insert(self):
+        # normalized codes needn't be unique, i.e. for codes created before
+        # they were case-insensitive
+        existing = FreeShippingVoucher.objects.create(code='abcd')
+        vouchers = insert_vouchers(FreeShippingVoucher, ['ABCD', 'EFGH'], {})
+        self.assertNotIn(existing.pk, [v.pk for v in vouchers])
+        self.assertEqual(
+            [FreeShippingVoucher.objects.get(pk=v.pk).code for v in vouchers],
+            ['ABCD', 'EFGH'])
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('generate_vouchers', 'fixed', '10', '--amount=25.50',
+                     stdout=out)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 11)
+        self.assertEqual(rows[1][1], '$25.50 voucher')
+        self.assertEqual(FixedVoucher.objects.filter(amount=Decimal('25.50'))
+                                             .count(), 10)
+
+    def test_admin_action(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com',
+                                             'password')
+        self.client.force_login(user)
+        voucher = PercentageVoucher.objects.create(code='template',
+                                                   amount=15, limit=2)
+        url = '/admin/vouchers/percentagevoucher/'
+        data = {'action': 'generate_codes', '_selected_action': voucher.pk}
+
+        response = self.client.post(url, data)
+        self.assertContains(response, 'Generate codes')
+
+        data.update(generate='yes', count=5, length=10, alphabet='abcdef')
+        response = self.client.post(url, data)
+        # the vouchers are created before the csv is streamed
+        self.assertEqual(PercentageVoucher.objects.filter(
+            amount=15, limit=2).count(), 6)
+        rows = list(csv.reader(io.StringIO(
+            b''.join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(len(rows[1][0]), 10)
+
+
+def make_order():
+    product = Product.objects.create(name='Product', price=100,
+                                     shipping_cost=0)
+    order = Order.objects.create()
+    order.add(product)
+    return order
+
+
+class RedemptionTestCase(TestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+
+    def test_limit(self):
+        voucher = PercentageVoucher.objects.create(code='half', amount=50,
+                                                   limit=1)
+        order = make_order()
+        discounts, invalid = save_discounts(order, ['HALF'])
+        self.assertEqual([d.amount for d in discounts], [50])
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.uses_count, 1)
+        self.assertEqual(voucher.redeemed_amount, 50)
+        self.assertFalse(voucher.available())
+
+        # resaving the order replaces its discount, rather than using the
+        # voucher again
+        discounts, invalid = save_discounts(order, ['HALF'])
+        self.assertEqual(len(discounts), 1)
+        self.assertEqual(order.discount_set.count(), 1)
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.uses_count, 1)
+
+        discounts, invalid = save_discounts(make_order(), ['HALF'])
+        self.assertEqual(discounts, [])
+        self.assertEqual(invalid, ['HALF'])
+
+    def test_balance(self):
+        voucher = FixedVoucher.objects.create(code='gift', amount=150)
+        save_discounts(make_order(), ['gift'])
+        discounts, invalid = save_discounts(make_order(), ['gift'])
+        self.assertEqual([d.amount for d in discounts], [50])
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.redeemed_amount, 150)
+        self.assertEqual(voucher.amount_remaining(), 0)
+
+    def test_order_obj(self):
+        PercentageVoucher.objects.create(code='half', amount=50, limit=1)
+        FixedVoucher.objects.create(code='gift', amount=20)
+        order = make_order()
+        discounts, invalid = save_discounts(order, ['half', 'gift'])
+        self.assertEqual(invalid, [])
+
+        # the order's own discounts don't use the vouchers up, for the order
+        # or the cart it came from
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        cart = SessionCart(request)
+        cart.add(order.get_lines()[0].item)
+        cart.order_obj = order
+        for obj in (order, cart):
+            discounts, invalid = calculate_discounts(obj, ['half', 'gift'])
+            self.assertEqual(invalid, [])
+            self.assertEqual(sorted(d.amount for d in discounts), [20, 50])
+
+        # but do for other orders
+        discounts, invalid = calculate_discounts(make_order(),
+                                                 ['half', 'gift'])
+        self.assertEqual(sorted(invalid), ['GIFT', 'HALF'])
+
+    def test_reconcile(self):
+        voucher = PercentageVoucher.objects.create(code='half', amount=50)
+        order = make_order()
+        save_discounts(order, ['half'])
+        other = PercentageVoucher.objects.create(code='other', amount=10)
+
+        amount = order.discount_set.get().amount
+
+        # i.e. discounts changed with raw SQL, which sends no signals
+        PercentageVoucher.objects.update(uses_count=3, redeemed_amount=0)
+
+        call_command('reconcile_vouchers')
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.uses_count, 1)
+        self.assertEqual(voucher.redeemed_amount, amount)
+        other.refresh_from_db()
+        self.assertEqual(other.uses_count, 0)
+
+    def test_delete(self):
+        voucher = PercentageVoucher.objects.create(code='half', amount=50,
+                                                   limit=1)
+        order = make_order()
+        save_discounts(order, ['half'])
+        voucher.refresh_from_db()
+        self.assertFalse(voucher.available())
+
+        # deleting the order, or a discount in the admin, returns the
+        # discount to the voucher's usage
+        order.delete()
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.uses_count, 0)
+        self.assertEqual(voucher.redeemed_amount, 0)
+        self.assertTrue(voucher.available())
+
+        order = make_order()
+        save_discounts(order, ['half'])
+        Discount.objects.get().delete()
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.uses_count, 0)
+
+        # checking availability doesn't load the subclass
+        base = BaseVoucher.objects.get(pk=voucher.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(base.available())
+
+
+class ConcurrentRedemptionTestCase(TransactionTestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+
+    def test_no_over_redemption(self):
+        limit = 3
+        voucher = PercentageVoucher.objects.create(code='launch', amount=10,
+                                                   limit=limit)
+        orders = [make_order() for i in range(8)]
+        start = threading.Barrier(len(orders))
+        redeemed = []
+
+        def checkout(order):
+            try:
+                # every checkout sees the voucher as available before any
+                # redeems it
+                discounts, invalid = calculate_discounts(order, ['launch'])
+                start.wait()
+                while True:
+                    try:
+                        if redeem(discounts[0]):
+                            discounts[0].save()
+                            redeemed.append(order)
+                        break
+                    except OperationalError:
+                        # i.e. sqlite "database table is locked"
+                        time.sleep(0.01)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(order, ))
+                   for order in orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(redeemed), limit)
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.uses_count, limit)
+        self.assertEqual(Discount.objects.count(), limit)
+
+
+class RegionsCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+        regions_cache.get_cache().delete(regions_cache.VERSION_KEY)
+
+        nzd = Currency.objects.create(code='NZD', symbol='$')
+        eur = Currency.objects.create(code='EUR', symbol='€')
+        self.nz = Region.objects.create(name='New Zealand', currency=nzd,
+                                        is_default=True)
+        self.europe = Region.objects.create(name='Europe', currency=eur)
+        Country.objects.create(region=self.europe, country='FR')
+
+    def make_request(self, region_id):
+        request = RequestFactory().get('/')
+        request.COOKIES[shoptools_settings.LOCATION_COOKIE_NAME] = \
+            json.dumps({'region_id': region_id})
+        return request
+
+    def test_cache(self):
+        get_region(self.make_request(None))
+        with self.assertNumQueries(0):
+            region = get_region(self.make_request(self.europe.pk))
+            self.assertEqual(region.currency.code, 'EUR')
+            self.assertEqual(get_region(self.make_request(999)), self.nz)
+            self.assertEqual(get_region_id('FR'), self.europe.pk)
+            self.assertEqual(get_region_id('AU'), self.nz.pk)
+
+        # saving reloads the data in this process straight away
+        self.europe.name = 'Eurozone'
+        self.europe.save()
+        region = get_region(self.make_request(self.europe.pk))
+        self.assertEqual(region.name, 'Eurozone')
+
+        Country.objects.create(region=self.europe, country='DE')
+        self.assertEqual(get_region_id('DE'), self.europe.pk)
+
+    def test_other_process(self):
+        get_region(self.make_request(None))
+
+        # simulate a change in another process, which doesn't send signals
+        # here but does bump the shared version
+        Region.objects.filter(pk=self.europe.pk).update(name='Eurozone')
+        regions_cache.get_cache().set(regions_cache.VERSION_KEY, 'changed')
+
+        # the version is only checked every few seconds
+        region = get_region(self.make_request(self.europe.pk))
+        self.assertEqual(region.name, 'Europe')
+
+        with mock.patch.object(shoptools_settings,
+                               'REGIONS_CACHE_CHECK_INTERVAL', 0):
+            region = get_region(self.make_request(self.europe.pk))
+        self.assertEqual(region.name, 'Eurozone')
+
+    def test_middleware(self):
+        middleware = RegionMiddleware()
+        get_region_id()
+
+        request = RequestFactory().get('/')
+        with self.assertNumQueries(0):
+            middleware.process_request(request)
+        info = json.loads(request.shoptools_region_info)
+        self.assertEqual(info['region_id'], self.nz.pk)
+
+        for path in ('/static/site.css', '/health', '/health/db',
+                     '/robots.txt'):
+            request = RequestFactory().get(path)
+            middleware.process_request(request)
+            self.assertFalse(hasattr(request, 'shoptools_region_info'))
+
+        # only the paths ending in / are prefixes
+        for path in ('/healthy-snacks/', '/robots.txt.html'):
+            request = RequestFactory().get(path)
+            middleware.process_request(request)
+            self.assertTrue(hasattr(request, 'shoptools_region_info'))
+
+        # paths are matched without the script prefix
+        request = RequestFactory(SCRIPT_NAME='/shop').get('/static/site.css')
+        self.assertEqual(request.path, '/shop/static/site.css')
+        middleware.process_request(request)
+        self.assertFalse(hasattr(request, 'shoptools_region_info'))
+
+    def test_country_lookup(self):
+        reader = mock.Mock()
+        reader.country.return_value = {'country_code': 'FR'}
+        regions_util.lookup_country_code.cache_clear()
+        self.addCleanup(regions_util.lookup_country_code.cache_clear)
+
+        with mock.patch.object(regions_util, 'get_geoip',
+                               return_value=reader):
+            for i in range(3):
+                self.assertEqual(
+                    regions_util.lookup_country_code('192.0.2.1'), 'FR')
+            regions_util.lookup_country_code('192.0.2.2')
+        self.assertEqual(reader.country.call_count, 2)
+        self.assertEqual(get_region_id('FR'), self.europe.pk)
+
+
+class ShippingRatesTestCase(TransactionTestCase):
+    def setUp(self):
+        regions_cache.clear_all()
+
+        currency = Currency.objects.create()
+        self.region = Region.objects.create(name='New Zealand',
+                                            currency=currency,
+                                            is_default=True)
+        Country.objects.create(region=self.region, country='NZ')
+        standard = Option.objects.create(name='Standard', sort_order=1)
+        express = Option.objects.create(name='Express', sort_order=2)
+        self.small = ShippingOption.objects.create(
+            option=standard, region=self.region, cost=10,
+            max_cart_value=100)
+        self.large = ShippingOption.objects.create(
+            option=standard, region=self.region, cost=0,
+            min_cart_value=100)
+        self.express = ShippingOption.objects.create(
+            option=express, region=self.region, cost=25)
+
+    def make_cart(self, subtotal, option_id=None):
+        request = RequestFactory().get('/')
+        return SimpleNamespace(request=request, subtotal=Decimal(subtotal),
+                               get_shipping_option=lambda: option_id)
+
+    def test_lookup(self):
+        shipping_util.available_options(self.make_cart(0))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                shipping_util.available_options(self.make_cart(50)),
+                [(self.small.pk, 'Standard'), (self.express.pk, 'Express')])
+            # both bounds are inclusive
+            self.assertEqual(
+                [o.pk for o in shipping_util.get_available_options(
+                    self.make_cart(100))],
+                [self.small.pk, self.large.pk, self.express.pk])
+            self.assertEqual(shipping_util.calculate(
+                self.make_cart(150, self.large.pk)), 0)
+            self.assertEqual(shipping_util.calculate(
+                self.make_cart(50, self.large.pk)), 0)
+            self.assertEqual(shipping_util.calculate(
+                self.make_cart(50, self.small.pk)), 10)
+            self.assertEqual(shipping_util.available_countries(
+                self.make_cart(50)), [('NZ', 'New Zealand')])
+
+        # changes rebuild the table
+        self.small.cost = 12
+        self.small.save()
+        self.assertEqual(shipping_util.calculate(
+            self.make_cart(50, self.small.pk)), 12)
+        self.express.delete()
+        self.assertEqual(len(shipping_util.available_options(
+            self.make_cart(50))), 1)
+
+    def test_intervals(self):
+        # compare against filtering every option, as the database did
+        rng = random.Random(1)
+        options = []
+        for i in range(30):
+            low = Decimal(rng.randint(0, 20) * 5)
+            high = rng.choice([None, low + rng.randint(0, 10) * 5])
+            options.append(SimpleNamespace(min_cart_value=low,
+                                           max_cart_value=high))
+        rates = RegionRates(options)
+
+        # every bound, and values between them
+        for value in range(-10, 320):
+            value = Decimal(value) / 2
+            expected = tuple(
+                o for o in options if o.min_cart_value <= value and
+                (o.max_cart_value is None or o.max_cart_value >= value))
+            self.assertEqual(rates.lookup(value), expected)
+
+    def test_quote(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        product = Product.objects.create(name='Product', price=40,
+                                         shipping_cost=0)
+        cart = SessionCart(request)
+        cart.add(product)
+        request.session.modified = False
+
+        with mock.patch.object(shipping_util, 'get_quote',
+                               wraps=shipping_util.get_quote) as get_quote:
+            self.assertEqual(cart.get_errors(), [])
+            self.assertEqual(cart.shipping_cost, 10)
+            self.assertEqual(cart.total, 50)
+            context = shipping_util.shipping_context(cart)
+        self.assertEqual(get_quote.call_count, 1)
+        self.assertEqual(context['selected_shipping_option'], self.small)
+
+        # the first option is selected, but not saved until the cart changes
+        self.assertEqual(cart.get_shipping_option(), self.small.pk)
+        self.assertFalse(request.session.modified)
+        self.assertNotIn('so', request.session['cart'])
+
+        cart.add(product, 2)
+        self.assertEqual(request.session['cart']['so'], self.small.pk)
+        self.assertEqual(cart.shipping_cost, 0)  # now over 100
+        self.assertEqual(cart.get_shipping_option(), self.large.pk)
+
+    def test_quote_errors(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        cart = SessionCart(request)
+        cart.set_shipping_option(self.express.pk)
+        self.assertEqual(cart.get_errors(), [])
+        self.assertEqual(cart.shipping_cost, 25)
+
+        # an option for another region can't be swapped for an equivalent
+        other = ShippingOption.objects.create(
+            option=Option.objects.create(name='Other'), cost=5,
+            region=Region.objects.create(name='Other',
+                                         currency=self.region.currency))
+        cart.set_shipping_option(other.pk)
+        self.assertEqual(cart.get_errors(), ['Please select a shipping '
+                                             'option.'])
+        self.assertEqual(cart.shipping_cost, 0)
+
+    def test_estimates(self):
+        other = Region.objects.create(name='Australia',
+                                      currency=self.region.currency)
+        Country.objects.create(region=other, country='AU')
+        ShippingOption.objects.create(
+            option=self.express.option, region=other, cost=30,
+            max_cart_value=75)
+        empty = Region.objects.create(name='Fiji',
+                                      currency=self.region.currency)
+
+        shipping_util.get_estimates(Decimal(0))
+        with self.assertNumQueries(0):
+            estimates = shipping_util.get_estimates(Decimal(50))
+        self.assertEqual(estimates['band'], {'min': 0, 'max': 75})
+        regions = {r['id']: r for r in estimates['regions']}
+        self.assertEqual(
+            [(o['id'], o['cost']) for o in regions[self.region.pk]['options']],
+            [(self.small.pk, 10), (self.express.pk, 25)])
+        self.assertEqual(regions[self.region.pk]['cost_from'], 10)
+        self.assertEqual(regions[self.region.pk]['countries'], ['NZ'])
+        self.assertEqual(regions[other.pk]['cost_from'], 30)
+        self.assertEqual(regions[empty.pk]['options'], [])
+        self.assertIsNone(regions[empty.pk]['cost_from'])
+
+        # estimates are shared by every value in a band, including bounds
+        table = rate_table.get()
+        self.assertIs(table.estimates(Decimal(60)), table.estimates(50))
+        self.assertEqual(table.band(Decimal(100)), (100, 100))
+        self.assertEqual(table.band(Decimal(500)), (100, None))
+        for value in (0, 50, 75, 80, 100, 150):
+            for region in (self.region, other, empty):
+                self.assertEqual(
+                    table.estimates(Decimal(value)).get(region.pk, ()),
+                    table.available(region, Decimal(value)))
+        self.assertEqual(
+            table.estimates(Decimal(100))[self.region.pk],
+            (self.small, self.large, self.express))
+
+        response = self.client.get(reverse('shipping_estimates'),
+                                   {'value': '120'})
+        self.assertEqual(response['Cache-Control'],
+                         'public, max-age=%s' %
+                         shoptools_settings.SHIPPING_ESTIMATES_MAX_AGE)
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['band'], {'min': '100.00', 'max': None})
+        self.assertEqual([r['name'] for r in data['regions']],
+                         ['Australia', 'Fiji', 'New Zealand'])
+        self.assertEqual(data['regions'][2]['options'][0]['cost'], '0.00')
+
+        self.assertEqual(self.client.get(reverse('shipping_estimates'),
+                                         {'value': 'x'}).status_code, 400)
+        # without a value, the current cart's subtotal is used
+        response = self.client.get(reverse('shipping_estimates'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertEqual(json.loads(response.content.decode())['cart_value'],
+                         '0')
@@ -22,6 +22,7 @@ get_vouchers_module = partial(get_module, 'VOUCHERS')
 get_favourites_module = partial(get_module, 'FAVOURITES')
 get_payment_module = partial(get_module, 'PAYMENT')
 get_email_module = partial(get_module, 'EMAIL')
+get_reservations_module = partial(get_module, 'RESERVATIONS')
 
 
 def make_uuid():
@@ -67,3 +68,27 @@ def unpack_instance_key(ctype, pk):
         instance = None
 
     return instance
+
+
+def unpack_instance_keys(keys):
+    """Batch version of unpack_instance_key. Takes an iterable of
+       (ctype, pk) keys and returns a dict mapping each key to its instance
+       (or None if it no longer exists), using one query per content type
+       rather than one per key. """
+
+    by_ctype = {}
+    for ctype, pk in keys:
+        by_ctype.setdefault(ctype, set()).add(pk)
+
+    rv = {}
+    for ctype, pks in by_ctype.items():
+        content_type = \
+            ContentType.objects.get_by_natural_key(*ctype.split('.'))
+        model = content_type.model_class()
+        to_python = model._meta.pk.to_python
+        instances = model._base_manager.in_bulk(
+            [to_python(pk) for pk in pks])
+        for pk in pks:
+            rv[(ctype, pk)] = instances.get(to_python(pk))
+
+    return rv